@@ -0,0 +1,149 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: bench_bm25.py
+# Description: Indexing and query latency of the BM25 index (and of the hybrid search) on the FSI corpus.
+# Usage: python lib/benchmarks/bench_bm25.py [--pdf-folder data/fsi/pdf] [--queries 2000] [--copies 1]
+#        (the chunks come from the ingestion/images/*.md artifacts if they exist, else from the PDF text)
+#-----------------------------------------------------------------------------------------------------------
+
+import argparse
+import glob
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+
+from its_a_rag.bm25 import BM25Index, tokenize
+from its_a_rag.doc_intelligence import IMAGE_STORE_FOLDER
+from its_a_rag.ingestion import advanced_text_splitter, find_figure_indices
+from its_a_rag.local_store import LocalVectorStore
+
+QUERIES = [
+    "MSFT total revenue fiscal year 2023",
+    "NVDA data center revenue 2022",
+    "AMZN operating income 2021",
+    "GOOGL advertising revenue",
+    "APPL iPhone net sales 2020",
+    "cash and cash equivalents end of year",
+    "diluted earnings per share",
+    "long-term debt maturities",
+    "research and development expenses",
+    "Form 10-K risk factors",
+]
+
+
+#########################################################
+# Class: Hashing Embeddings (local stand-in of the embedding model)
+#########################################################
+class HashingEmbeddings(Embeddings):
+    def __init__(self, dimensions=256):
+        self.dimensions = dimensions
+
+    def embed_query(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for token in tokenize(text):
+            vector[hash(token) % self.dimensions] += 1
+        return (vector + 1e-3).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+#########################################################
+# Load the chunks of the corpus
+#########################################################
+def load_chunks(markdown_paths, pdf_folder):
+    chunks = []
+    for file_path in sorted(f for f in glob.glob(markdown_paths) if not f.endswith("_init.md")):
+        with open(file_path) as f:
+            content = f.read()
+        images = {int(i): None for i in find_figure_indices(content)}
+        chunks += advanced_text_splitter([Document(page_content=content, metadata={"images": images})], os.path.basename(file_path))
+    if chunks:
+        return chunks, "markdown artifacts"
+
+    import pymupdf
+    for file_path in sorted(glob.glob(os.path.join(pdf_folder, "*.pdf"))):
+        with pymupdf.open(file_path) as pdf:
+            for page in pdf:
+                paragraph = ""
+                for block in page.get_text("blocks"):
+                    paragraph += block[4].strip() + "\n"
+                    if len(paragraph) > 1500:
+                        chunks.append(Document(page_content=paragraph, metadata={"source": os.path.basename(file_path), "header": "{}", "image": None}))
+                        paragraph = ""
+                if paragraph.strip():
+                    chunks.append(Document(page_content=paragraph, metadata={"source": os.path.basename(file_path), "header": "{}", "image": None}))
+    return chunks, "PDF text"
+
+
+def percentiles(timings):
+    timings = np.array(timings) * 1000
+    return f"p50 {np.percentile(timings, 50):7.3f} ms  p95 {np.percentile(timings, 95):7.3f} ms  p99 {np.percentile(timings, 99):7.3f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the BM25 index and the hybrid search on the FSI corpus.")
+    parser.add_argument("--markdown", default=os.path.join(IMAGE_STORE_FOLDER, "*.md"), help="Markdown artifacts of the ingestion")
+    parser.add_argument("--pdf-folder", default="data/fsi/pdf", help="PDFs used when there is no Markdown artifact")
+    parser.add_argument("--queries", type=int, default=2000, help="number of queries timed")
+    parser.add_argument("--copies", type=int, default=1, help="index the corpus several times to simulate a larger corpus")
+    parser.add_argument("--k", type=int, default=30)
+    args = parser.parse_args()
+
+    chunks, origin = load_chunks(args.markdown, args.pdf_folder)
+    if not chunks:
+        parser.error("no chunk to index")
+    ids = [f"{copy}-{i}" for copy in range(args.copies) for i in range(len(chunks))]
+    texts = [chunk.page_content for chunk in chunks] * args.copies
+    print(f"corpus: {len(texts)} chunks from {origin}, {sum(map(len, texts)) / 1e6:.1f} MB of text")
+
+    index = BM25Index()
+    start = time.perf_counter()
+    index.add_texts(ids, texts)
+    print(f"indexing: {time.perf_counter() - start:.2f} s ({len(index._terms)} terms)")
+
+    folder = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        index.save(folder)
+        saved = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+        start = time.perf_counter()
+        index = BM25Index.load(folder)
+        print(f"save: {saved * 1000:.0f} ms, load: {(time.perf_counter() - start) * 1000:.0f} ms, {size / 1e6:.1f} MB on disk")
+    finally:
+        shutil.rmtree(folder)
+
+    # Queries: the financial questions, then random combinations of corpus terms
+    rnd = random.Random(0)
+    vocabulary = list(index._terms)
+    queries = QUERIES + [" ".join(rnd.choice(vocabulary) for _ in range(rnd.randint(2, 6))) for _ in range(args.queries - len(QUERIES))]
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, args.k)
+        timings.append(time.perf_counter() - start)
+    print(f"BM25 search (k={args.k}):   {percentiles(timings)}")
+
+    store = LocalVectorStore(HashingEmbeddings())
+    store.add_texts(texts, [chunk.metadata for chunk in chunks] * args.copies, ids=ids)
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        store.hybrid_search(query, k=args.k)
+        timings.append(time.perf_counter() - start)
+    print(f"hybrid search (k={args.k}): {percentiles(timings)}")
+
+
+if __name__ == "__main__":
+    main()
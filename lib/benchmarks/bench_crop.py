@@ -0,0 +1,82 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: bench_crop.py
+# Description: Benchmark of the figure cropping path (per-call crop_image_from_file vs FigureCropper session).
+# Usage: python lib/benchmarks/bench_crop.py [--folder data/fsi/pdf] [--figures 60] [--dpi 300]
+#-----------------------------------------------------------------------------------------------------------
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import pymupdf
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.doc_intelligence import FigureCropper, crop_image_from_file
+
+DEFAULT_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../data/fsi/pdf'))
+
+
+#########################################################
+# Generate figure regions for a PDF, as Document Intelligence would report them
+# (page numbers are 0-indexed and the bounding boxes are in inches).
+# Figures of a report are clustered on a few pages, so the regions are
+# generated in page order with a few figures per page.
+#########################################################
+def generate_regions(pdf_path, n_figures, seed=0):
+    rnd = random.Random(seed)
+    with pymupdf.open(pdf_path) as doc:
+        page_count = doc.page_count
+        width, height = doc[0].rect.width / 72, doc[0].rect.height / 72
+    regions = []
+    page_number = 0
+    while len(regions) < n_figures:
+        page_number = min(page_count - 1, page_number + rnd.randint(0, 3))
+        for _ in range(rnd.randint(1, 3)):
+            x0, y0 = rnd.uniform(0, width / 2), rnd.uniform(0, height / 2)
+            regions.append((page_number, (x0, y0, x0 + rnd.uniform(1, width / 2), y0 + rnd.uniform(1, height / 2))))
+    return regions[:n_figures]
+
+
+def bench_per_call(pdf_path, regions):
+    start = time.perf_counter()
+    for page_number, bounding_box in regions:
+        crop_image_from_file(pdf_path, page_number, bounding_box)
+    return time.perf_counter() - start
+
+
+def bench_session(pdf_path, regions, dpi):
+    start = time.perf_counter()
+    with FigureCropper(pdf_path, dpi=dpi) as cropper:
+        for page_number, bounding_box in regions:
+            cropper.crop(page_number, bounding_box)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark figure cropping: per-call path vs cropping session.")
+    parser.add_argument("--folder", default=DEFAULT_FOLDER, help="folder containing the PDF files")
+    parser.add_argument("--figures", type=int, default=60, help="number of figures cropped per document")
+    parser.add_argument("--dpi", type=int, default=300, help="resolution of the session crops")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    files = sorted(f for f in os.listdir(args.folder) if f.lower().endswith(".pdf"))
+    total_per_call = total_session = 0.0
+    print(f"{'file':<24}{'per-call (s)':>14}{'session (s)':>14}{'speedup':>10}")
+    for f in files:
+        pdf_path = os.path.join(args.folder, f)
+        regions = generate_regions(pdf_path, args.figures, args.seed)
+        per_call = bench_per_call(pdf_path, regions)
+        session = bench_session(pdf_path, regions, args.dpi)
+        total_per_call += per_call
+        total_session += session
+        print(f"{f:<24}{per_call:>14.3f}{session:>14.3f}{per_call / session:>9.1f}x")
+    print(f"{'total':<24}{total_per_call:>14.3f}{total_session:>14.3f}{total_per_call / total_session:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: bench_figure_rewrite.py
+# Description: Micro-benchmark of the figure rewriting (update_figure_description per figure vs rewrite_figures).
+# Usage: python lib/benchmarks/bench_figure_rewrite.py [--figures 1000] [--text-size 4000]
+#-----------------------------------------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.doc_intelligence import rewrite_figures, update_figure_description
+
+
+#########################################################
+# Generate a synthetic Markdown document with figure tags and their spans
+#########################################################
+def generate_document(n_figures, text_size, seed=0):
+    rnd = random.Random(seed)
+    parts = []
+    figures = []
+    offset = 0
+    for idx in range(n_figures):
+        text = f"\n## Section {idx}\n\n" + "lorem ipsum dolor sit amet " * (rnd.randint(text_size // 2, text_size) // 27) + "\n\n"
+        figure = f"<figure>\n<figcaption>Figure {idx}</figcaption>\nchart labels {idx}\n</figure>"
+        parts.append(text)
+        offset += len(text)
+        figures.append(SimpleNamespace(spans=[SimpleNamespace(offset=offset, length=len(figure))]))
+        parts.append(figure)
+        offset += len(figure)
+    parts.append("\nEnd of document.\n")
+    descriptions = [f"<figcaption>Figure {idx}</figcaption>\n" + "The chart shows revenue by quarter. " * 10 for idx in range(n_figures)]
+    return "".join(parts), figures, descriptions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark figure rewriting: per-figure update vs single pass.")
+    parser.add_argument("--figures", type=int, default=1000, help="number of figures in the document")
+    parser.add_argument("--text-size", type=int, default=4000, help="approximate characters of text between figures")
+    args = parser.parse_args()
+
+    md_content, figures, descriptions = generate_document(args.figures, args.text_size)
+    print(f"document: {len(md_content) / 1e6:.1f} MB, {args.figures} figures")
+
+    start = time.perf_counter()
+    expected = md_content
+    with contextlib.redirect_stdout(io.StringIO()):
+        for idx, description in enumerate(descriptions):
+            expected = update_figure_description(expected, description, idx)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with_spans = rewrite_figures(md_content, descriptions, figures)
+    single_pass_spans = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with_scan = rewrite_figures(md_content, descriptions)
+    single_pass_scan = time.perf_counter() - start
+
+    assert with_spans == expected and with_scan == expected, "rewrite_figures output differs from update_figure_description"
+    print(f"update_figure_description x{args.figures}: {sequential * 1000:10.1f} ms")
+    print(f"rewrite_figures (spans):        {single_pass_spans * 1000:10.1f} ms ({sequential / single_pass_spans:.0f}x)")
+    print(f"rewrite_figures (tag scan):     {single_pass_scan * 1000:10.1f} ms ({sequential / single_pass_scan:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: bench_ingestion.py
+# Description: Ingestion benchmark suite against local stand-ins of the Azure services (see fake_services.py):
+#              layout analysis (whole or by page ranges), figure cropping, figure description, text splitting
+#              and end-to-end pipeline throughput.
+#              The report (JSON) records the environment, the corpus and the options, and can be compared
+#              with the report of a previous release to catch regressions.
+# Usage: python lib/benchmarks/bench_ingestion.py [--folder data/fsi/pdf] [--files 5] [--repeat 3]
+#                                                 [--output report.json] [--compare baseline.json]
+#-----------------------------------------------------------------------------------------------------------
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import metadata
+
+import pymupdf
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from azure.ai.documentintelligence.models import AnalyzeResult
+from langchain.schema import Document
+from langchain_openai import AzureOpenAIEmbeddings
+
+from fake_services import FakeAzureServices
+from its_a_rag.cache import file_sha256
+from its_a_rag.doc_intelligence import CROP_DPI, SHARD_CONCURRENCY, AzureAIDocumentIntelligenceParser, VisionClient, crop_image_from_pdf_page, include_figure_in_md
+from its_a_rag.image_store import LocalImageStore
+from its_a_rag.ingestion import advanced_text_splitter
+from its_a_rag.local_store import LocalVectorStore
+from its_a_rag.pipeline import IngestionPipeline
+from its_a_rag.telemetry import MemorySink, set_telemetry_sink
+
+DEFAULT_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../data/fsi/pdf'))
+
+BENCHMARKS = ["analyze", "crop", "figures", "splitter", "end_to_end"]
+
+# Options of the analysis requested by the pipeline (the recorded layouts are keyed on them)
+API_MODEL = "prebuilt-layout"
+ANALYSIS_FEATURES = ["ocrHighResolution"]
+API_VERSION = "2024-06-01"
+
+# Version of the report format
+REPORT_VERSION = 1
+
+
+#########################################################
+# Environment of the run (recorded in the report)
+#########################################################
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(__file__)).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, cwd=os.path.dirname(__file__)).stdout.strip())
+    except OSError:
+        commit, dirty = None, None
+    packages = {}
+    for name in ["pymupdf", "pillow", "numpy", "openai", "langchain", "azure-ai-documentintelligence"]:
+        try:
+            packages[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            packages[name] = None
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "packages": packages,
+    }
+
+
+#########################################################
+# Description of the corpus: the fingerprint changes with any file
+#########################################################
+def corpus_info(files):
+    hashes = [file_sha256(f) for f in files]
+    pages = 0
+    for f in files:
+        with pymupdf.open(f) as doc:
+            pages += doc.page_count
+    return {
+        "files": [os.path.basename(f) for f in files],
+        "pages": pages,
+        "bytes": sum(os.path.getsize(f) for f in files),
+        "fingerprint": hashlib.sha256("".join(hashes).encode()).hexdigest()[:16],
+    }
+
+
+#########################################################
+# Time a benchmark: warmup runs, then the median of the timed runs
+# Args:
+#   - run: function running the benchmark once, returning its counters
+# Returns:
+#   - dictionary with the seconds of each run, their median / min / max, and the counters
+#########################################################
+def measure(run, repeat, warmup):
+    for _ in range(warmup):
+        run()
+    runs = []
+    counters = {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        counters = run()
+        runs.append(time.perf_counter() - start)
+    median = statistics.median(runs)
+    return {
+        "seconds": round(median, 4),
+        "min": round(min(runs), 4),
+        "max": round(max(runs), 4),
+        "runs": [round(r, 4) for r in runs],
+        "counters": counters,
+        "throughput": {f"{name}/s": round(value / median, 2) for name, value in counters.items() if median},
+    }
+
+
+#########################################################
+# Benchmarks
+#########################################################
+def bench_analyze(files, services, args, pages):
+    # One file at a time: the time is the sum of the analysis latencies of the files
+    def run():
+        parser = AzureAIDocumentIntelligenceParser(
+            api_endpoint=services.endpoint,
+            api_key="fake",
+            api_model=API_MODEL,
+            analysis_features=ANALYSIS_FEATURES,
+            shard_pages=args.shard_pages,
+            shard_concurrency=args.shard_concurrency,
+        )
+        for file_path in files:
+            parser.analyze(file_path)
+        return {"files": len(files), "pages": pages}
+    return run
+
+
+def bench_crop(files, layouts, dpi):
+    def run():
+        figures = 0
+        for file_path in files:
+            for figure in layouts[file_path].figures or []:
+                for region in figure.bounding_regions:
+                    bounding_box = (region.polygon[0], region.polygon[1], region.polygon[4], region.polygon[5])
+                    crop_image_from_pdf_page(file_path, region.page_number - 1, bounding_box, dpi)
+                    figures += 1
+        return {"figures": figures}
+    return run
+
+
+def bench_figures(files, layouts, services, args, output_folder, markdowns):
+    def run():
+        figures = 0
+        vision_client = VisionClient("fake", services.endpoint, API_VERSION, "gpt-4o", pool_size=args.description_workers)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                for file_path in files:
+                    markdowns[os.path.basename(file_path)] = include_figure_in_md(file_path, layouts[file_path], output_folder, args.description_workers, args.dpi, vision_client=vision_client, deduplicate=args.dedup_figures, skip_decorative=args.skip_decorative)
+                    figures += len(layouts[file_path].figures or [])
+        finally:
+            vision_client.close()
+        return {"figures": figures}
+    return run
+
+
+def bench_splitter(markdowns):
+    def run():
+        chunks = 0
+        for file_name, (md_content, fig_metadata) in markdowns.items():
+            chunks += len(advanced_text_splitter([Document(page_content=md_content, metadata={"images": fig_metadata})], file_name))
+        return {"chunks": chunks, "MB": round(sum(len(md) for md, _ in markdowns.values()) / 1e6, 3)}
+    return run
+
+
+def bench_end_to_end(files, services, args, pages):
+    def run():
+        folder = tempfile.mkdtemp()
+        vision_client = VisionClient("fake", services.endpoint, API_VERSION, "gpt-4o", pool_size=args.description_workers)
+        try:
+            parser = AzureAIDocumentIntelligenceParser(
+                api_endpoint=services.endpoint,
+                api_key="fake",
+                api_model=API_MODEL,
+                analysis_features=ANALYSIS_FEATURES,
+                vision_client=vision_client,
+                deduplicate_figures=args.dedup_figures,
+                skip_decorative=args.skip_decorative,
+                shard_pages=args.shard_pages,
+                shard_concurrency=args.shard_concurrency,
+            )
+            embeddings = AzureOpenAIEmbeddings(
+                azure_endpoint=services.endpoint,
+                api_key="fake",
+                api_version=API_VERSION,
+                azure_deployment="text-embedding-3-large",
+                check_embedding_ctx_length=False,
+            )
+            vector_store = LocalVectorStore(embeddings, folder=os.path.join(folder, "vector_store"))
+            pipeline = IngestionPipeline(
+                parser,
+                vector_store,
+                analysis_workers=args.analysis_workers,
+                description_workers=args.description_workers,
+                output_folder=os.path.join(folder, "images"),
+                dpi=args.dpi,
+                progress=lambda result: None,
+                embeddings=embeddings,
+                image_store=LocalImageStore(os.path.join(folder, "image_store")),
+            )
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = pipeline.run(files)
+        finally:
+            vision_client.close()
+            shutil.rmtree(folder)
+        failed = [r for r in results if r.status == "failed"]
+        if failed:
+            raise RuntimeError(f"{failed[0].file_path} failed at stage {failed[0].stage}: {failed[0].error}")
+        return {"files": len(results), "pages": pages, "figures": sum(r.figures for r in results), "chunks": sum(r.chunks for r in results)}
+    return run
+
+
+#########################################################
+# Compare a report with a baseline report
+# Returns:
+#   - list of the names of the regressed benchmarks
+#########################################################
+def compare(report, baseline, tolerance):
+    for section in ["corpus", "config"]:
+        if report[section] != baseline.get(section):
+            print(f"warning: the {section} differs from the baseline, the timings may not be comparable")
+    regressions = []
+    print(f"\n{'benchmark':<14}{'baseline (s)':>14}{'current (s)':>14}{'change':>10}")
+    for name, result in report["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            print(f"{name:<14}{'-':>14}{result['seconds']:>14.3f}{'new':>10}")
+            continue
+        change = result["seconds"] / previous["seconds"] - 1 if previous["seconds"] else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<14}{previous['seconds']:>14.3f}{result['seconds']:>14.3f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion against local stand-ins of Document Intelligence, the vision model and the embeddings.")
+    parser.add_argument("--folder", default=DEFAULT_FOLDER, help="folder containing the PDF files")
+    parser.add_argument("--files", type=int, default=0, help="number of files benchmarked (0: all the files of the folder)")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help=f"comma-separated benchmarks to run ({', '.join(BENCHMARKS)})")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of each benchmark (the median is reported)")
+    parser.add_argument("--warmup", type=int, default=0, help="untimed runs of each benchmark before the timed runs")
+    parser.add_argument("--dpi", type=int, default=CROP_DPI, help="resolution of the cropped figures")
+    parser.add_argument("--analysis-workers", type=int, default=4)
+    parser.add_argument("--description-workers", type=int, default=8)
+    parser.add_argument("--di-latency", type=float, default=1.0, help="duration of a layout analysis (seconds)")
+    parser.add_argument("--di-latency-per-page", type=float, default=0.0, help="additional duration of a layout analysis per page (seconds)")
+    parser.add_argument("--shard-pages", type=int, help="analyze the PDFs longer than this number of pages by page ranges of this size")
+    parser.add_argument("--shard-concurrency", type=int, default=SHARD_CONCURRENCY, help="page ranges of a PDF analyzed at the same time")
+    parser.add_argument("--vision-latency", type=float, default=0.5, help="duration of an image description (seconds)")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="duration of an embedding request (seconds)")
+    parser.add_argument("--embedding-latency-per-input", type=float, default=0.0005, help="additional duration per embedded text (seconds)")
+    parser.add_argument("--embedding-dimensions", type=int, default=256)
+    parser.add_argument("--dedup-figures", action="store_true", help="reuse the description of the near-duplicate figures of a document")
+    parser.add_argument("--skip-decorative", action="store_true", help="do not describe the decorative figures")
+    parser.add_argument("--max-figures-per-page", type=int, default=2, help="maximum figures of a page in the synthetic layouts")
+    parser.add_argument("--recordings", help="folder of recorded AnalyzeResults (<sha256 of the PDF>.json[.gz]) replayed instead of the synthetic layouts")
+    parser.add_argument("--telemetry", action="store_true", help="record the spans of the stages and add their summary to the report (adds a small overhead)")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="baseline report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="slowdown over the baseline reported as a regression")
+    args = parser.parse_args()
+
+    benchmarks = [name.strip() for name in args.benchmarks.split(",") if name.strip()]
+    unknown = set(benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    files = sorted(os.path.join(args.folder, f) for f in os.listdir(args.folder) if f.lower().endswith(".pdf"))
+    if args.files:
+        files = files[:args.files]
+    if not files:
+        parser.error("no PDF file to benchmark")
+
+    # Options changing the timings (the files are compared through the corpus)
+    config = {name: value for name, value in vars(args).items() if name not in ("folder", "files", "benchmarks", "repeat", "warmup", "telemetry", "output", "compare", "tolerance")}
+    report = {"version": REPORT_VERSION, "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "environment": environment(), "config": config, "corpus": corpus_info(files), "results": {}}
+    print(f"corpus: {len(files)} files, {report['corpus']['pages']} pages ({report['corpus']['fingerprint']}), commit {report['environment']['commit']}")
+
+    with FakeAzureServices(
+        di_latency=args.di_latency,
+        di_latency_per_page=args.di_latency_per_page,
+        vision_latency=args.vision_latency,
+        embedding_latency=args.embedding_latency,
+        embedding_latency_per_input=args.embedding_latency_per_input,
+        embedding_dimensions=args.embedding_dimensions,
+        recordings=args.recordings,
+        max_figures_per_page=args.max_figures_per_page,
+    ) as services:
+        # The layouts are computed before the timed runs
+        services.prepare(files, API_MODEL, "markdown", ANALYSIS_FEATURES, args.shard_pages)
+        layouts = {f: AnalyzeResult(services.layout(open(f, "rb").read(), API_MODEL, "markdown", ANALYSIS_FEATURES)) for f in files}
+        report["corpus"]["layouts"] = {"recorded": services.counters["replayed"], "synthetic": services.counters["synthetic"]}
+        report["corpus"]["figures"] = sum(len(layout.figures or []) for layout in layouts.values())
+
+        folder = tempfile.mkdtemp()
+        markdowns = {}
+        sink = MemorySink() if args.telemetry else None
+        set_telemetry_sink(sink)
+        try:
+            runs = {
+                "analyze": lambda: bench_analyze(files, services, args, report["corpus"]["pages"]),
+                "crop": lambda: bench_crop(files, layouts, args.dpi),
+                "figures": lambda: bench_figures(files, layouts, services, args, folder, markdowns),
+                "splitter": lambda: bench_splitter(markdowns),
+                "end_to_end": lambda: bench_end_to_end(files, services, args, report["corpus"]["pages"]),
+            }
+            if "splitter" in benchmarks and "figures" not in benchmarks:
+                # The splitter runs on the Markdown produced by the figure benchmark
+                bench_figures(files, layouts, services, args, folder, markdowns)()
+            for name in BENCHMARKS:
+                if name not in benchmarks:
+                    continue
+                result = measure(runs[name](), args.repeat, args.warmup)
+                report["results"][name] = result
+                throughput = ", ".join(f"{value} {unit}" for unit, value in result["throughput"].items())
+                print(f"{name:<12} {result['seconds']:9.3f} s  (min {result['min']:.3f}, max {result['max']:.3f})  {throughput}")
+        finally:
+            set_telemetry_sink(None)
+            shutil.rmtree(folder)
+        report["services"] = dict(services.counters)
+        if sink is not None:
+            report["telemetry"] = {"spans": sink.summary(), "counters": sink.counters, "slowest_files": {name: sink.slowest(name, 5) for name in ["analyze", "crop", "describe", "split"]}}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"report written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"regressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
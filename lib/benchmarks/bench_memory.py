@@ -0,0 +1,136 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: bench_memory.py
+# Description: Peak memory of N concurrent layout analyses of large PDFs against a local stand-in of
+#              Document Intelligence (see fake_services.py, run in its own process): request body streamed
+#              from the file, whole file read in memory first, and page ranges (--shard-pages).
+# Usage: python lib/benchmarks/bench_memory.py [--files 8] [--size-mb 40] [--modes stream,in-memory,sharded]
+#-----------------------------------------------------------------------------------------------------------
+
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pymupdf
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fake_services import FakeAzureServices
+from its_a_rag.doc_intelligence import AzureAIDocumentIntelligenceParser
+
+MODES = ["stream", "in-memory", "sharded"]
+
+
+#########################################################
+# Write a PDF of about size_mb megabytes (pages of incompressible images)
+#########################################################
+def make_large_pdf(path, size_mb, pages, seed=0):
+    rng = np.random.default_rng(seed)
+    side = int((size_mb * 1e6 / pages / 3) ** 0.5)
+    doc = pymupdf.open()
+    for page_number in range(pages):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.integers(0, 256, (side, side, 3), dtype=np.uint8)).save(buffer, "PNG", compress_level=0)
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Page {page_number + 1}", fontsize=24)
+        page.insert_image(pymupdf.Rect(72, 100, 540, 568), stream=buffer.getvalue())
+    doc.save(path)
+    doc.close()
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1e6 if sys.platform == "darwin" else 1e3)
+
+
+def serve(files, shard_pages, di_latency, endpoint_queue, stop):
+    with FakeAzureServices(di_latency=di_latency) as services:
+        services.prepare(files, shard_pages=shard_pages)
+        endpoint_queue.put(services.endpoint)
+        stop.wait()
+
+
+#########################################################
+# Analyze the files concurrently in a fresh process
+# Returns (through the queue):
+#   - (peak memory over the baseline in MB, seconds)
+#########################################################
+def client(mode, endpoint, files, warmup_file, shard_pages, result_queue):
+    parser = AzureAIDocumentIntelligenceParser(endpoint, "fake", shard_pages=shard_pages if mode == "sharded" else None)
+
+    def analyze(file_path):
+        if mode == "in-memory":
+            with open(file_path, "rb") as f:
+                data = f.read()
+            return parser.client.begin_analyze_document(parser.api_model, io.BytesIO(data), content_type="application/octet-stream", output_content_format="markdown").result()
+        return parser.analyze(file_path)
+
+    # The first request loads the modules and the connection pool of the client
+    analyze(warmup_file)
+    baseline = max_rss_mb()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        results = list(executor.map(analyze, files))
+    seconds = time.perf_counter() - start
+    assert all(result.pages for result in results)
+    result_queue.put((max_rss_mb() - baseline, seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the peak memory of concurrent layout analyses of large PDFs.")
+    parser.add_argument("--files", type=int, default=8, help="number of concurrent analyses")
+    parser.add_argument("--size-mb", type=float, default=40, help="size of the generated PDFs")
+    parser.add_argument("--pages", type=int, default=8, help="pages of the generated PDFs")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"comma-separated upload modes ({', '.join(MODES)})")
+    parser.add_argument("--shard-pages", type=int, default=2, help="pages of the ranges in the sharded mode")
+    parser.add_argument("--di-latency", type=float, default=0.5, help="duration of a layout analysis (seconds)")
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(sorted(unknown))}")
+
+    folder = tempfile.mkdtemp()
+    context = multiprocessing.get_context("spawn")
+    stop = context.Event()
+    try:
+        files = []
+        for n in range(args.files):
+            files.append(os.path.join(folder, f"large_{n}.pdf"))
+            make_large_pdf(files[-1], args.size_mb, args.pages, seed=n)
+        warmup_file = os.path.join(folder, "warmup.pdf")
+        make_large_pdf(warmup_file, 0.1, 1, seed=args.files)
+        size_mb = sum(os.path.getsize(f) for f in files) / 1e6
+
+        # The stand-in server holds the request bodies: it runs in its own process
+        endpoint_queue = context.Queue()
+        server = context.Process(target=serve, args=(files + [warmup_file], args.shard_pages, args.di_latency, endpoint_queue, stop), daemon=True)
+        server.start()
+        endpoint = endpoint_queue.get()
+
+        print(f"{args.files} concurrent analyses of {size_mb / args.files:.1f} MB PDFs ({size_mb:.0f} MB in total)")
+        print(f"{'mode':<12}{'peak MB':>10}{'MB/file':>10}{'seconds':>10}")
+        for mode in modes:
+            result_queue = context.Queue()
+            process = context.Process(target=client, args=(mode, endpoint, files, warmup_file, args.shard_pages, result_queue))
+            process.start()
+            peak, seconds = result_queue.get()
+            process.join()
+            print(f"{mode:<12}{peak:>10.1f}{peak / args.files:>10.1f}{seconds:>10.2f}")
+    finally:
+        stop.set()
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: bench_rate_limit.py
+# Description: Image descriptions against a throttled local vision deployment (see fake_services.py):
+#              SDK retries only vs the RateLimiter scheduler (429 responses, failures, throughput vs quota).
+# Usage: python lib/benchmarks/bench_rate_limit.py [--images 200] [--quota-rpm 600] [--concurrency 16]
+#-----------------------------------------------------------------------------------------------------------
+
+import argparse
+import base64
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fake_services import FakeAzureServices
+from its_a_rag.doc_intelligence import VisionClient
+from its_a_rag.rate_limit import RateLimiter
+
+
+def make_data_url(width=800, height=600):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), "white").save(buffer, "PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def run(services, client, images, concurrency, data_url):
+    failures = 0
+
+    def describe(_):
+        nonlocal failures
+        try:
+            client.describe(data_url, "")
+        except Exception:
+            failures += 1
+
+    services.reset_counters()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(describe, range(images)))
+    return time.perf_counter() - start, failures, services.counters["throttled"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rate limit scheduler against a throttled vision deployment.")
+    parser.add_argument("--images", type=int, default=200, help="number of images described")
+    parser.add_argument("--quota-rpm", type=float, default=600, help="requests per minute quota of the fake deployment")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight")
+    parser.add_argument("--latency", type=float, default=0.05, help="duration of a description (seconds)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data_url = make_data_url()
+    ideal = max(0.0, args.images - args.quota_rpm / 6) / (args.quota_rpm / 60)
+    print(f"{args.images} images, quota {args.quota_rpm:.0f} rpm ({args.quota_rpm / 6:.0f} per 10 s burst), ideal {ideal:.1f} s")
+    print(f"{'client':<12}{'seconds':>10}{'failed':>8}{'429':>8}{'req/min':>10}")
+    for name in ["sdk", "scheduler"]:
+        with FakeAzureServices(vision_latency=args.latency, vision_quota_rpm=args.quota_rpm) as services:
+            limiter = RateLimiter(requests_per_minute=args.quota_rpm, seed=args.seed) if name == "scheduler" else None
+            client = VisionClient("fake", services.endpoint, "2024-06-01", "gpt-4o", pool_size=args.concurrency, rate_limiter=limiter)
+            try:
+                seconds, failed, throttled = run(services, client, args.images, args.concurrency, data_url)
+            finally:
+                client.close()
+        print(f"{name:<12}{seconds:>10.2f}{failed:>8}{throttled:>8}{(args.images - failed) / seconds * 60:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
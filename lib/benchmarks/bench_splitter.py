@@ -0,0 +1,108 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: bench_splitter.py
+# Description: Benchmark of advanced_text_splitter (header splitter + figure splitter vs single pass).
+# Usage: python lib/benchmarks/bench_splitter.py [ingestion/images/*_init.md ...] [--repeat 5]
+#        (without files, a synthetic document of --size MB is generated)
+#-----------------------------------------------------------------------------------------------------------
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from langchain.schema import Document
+from langchain.text_splitter import MarkdownHeaderTextSplitter
+
+from its_a_rag.doc_intelligence import IMAGE_STORE_FOLDER
+from its_a_rag.ingestion import HEADERS_TO_SPLIT_ON, CustomCharacterTextSplitter, advanced_text_splitter, find_figure_indices
+
+
+#########################################################
+# Previous implementation of advanced_text_splitter (one document)
+#########################################################
+def legacy_text_splitter(docs, pdf_file_name):
+    text_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=HEADERS_TO_SPLIT_ON)
+    docs_result = text_splitter.split_text(docs[0].page_content)
+    text_splitter = CustomCharacterTextSplitter(separator=r'(<figure>.*?</figure>)', is_separator_regex=True)
+    child_docs = text_splitter.split_documents(docs_result)
+    image_metadata = docs[0].metadata['images']
+    lst_docs = []
+    for doc in child_docs:
+        figure_indices = find_figure_indices(doc.page_content)
+        if figure_indices:
+            for figure_indice in figure_indices:
+                lst_docs.append(Document(page_content=doc.page_content, metadata={"header": json.dumps(doc.metadata), "source": pdf_file_name, "image": image_metadata[figure_indice]}))
+        else:
+            lst_docs.append(Document(page_content=doc.page_content, metadata={"header": json.dumps(doc.metadata), "source": pdf_file_name, "image": None}))
+    return lst_docs
+
+
+#########################################################
+# Generate a synthetic Markdown document with headers, tables and figures
+#########################################################
+def generate_document(size, seed=0):
+    rnd = random.Random(seed)
+    parts = []
+    length = 0
+    idx = 0
+    while length < size:
+        level = rnd.randint(1, 4)
+        text = f"\n{'#' * level} Section {idx}\n\n"
+        for _ in range(rnd.randint(1, 6)):
+            text += "lorem ipsum dolor sit amet " * rnd.randint(2, 30) + "\n\n"
+        if rnd.random() < 0.3:
+            text += "| Year | Revenue |\n| --- | --- |\n" + "".join(f"| {2000 + i} | {rnd.randint(1, 999)} |\n" for i in range(rnd.randint(2, 10))) + "\n"
+        if rnd.random() < 0.4:
+            text += f"<figure>\n<figcaption>Figure {idx}</figcaption>\n![](figures/{idx})\nThe chart shows revenue by quarter.\n</figure>\n\n"
+        parts.append(text)
+        length += len(text)
+        idx += 1
+    images = {i: f"data:image/png;base64,{i}" for i in range(idx)}
+    return "".join(parts), images
+
+
+def load_documents(paths, size):
+    files = sorted({f for path in paths for f in glob.glob(path)})
+    if files:
+        for file_path in files:
+            with open(file_path) as f:
+                content = f.read()
+            images = {int(i): None for i in find_figure_indices(content)}
+            yield os.path.basename(file_path), content, images
+    else:
+        content, images = generate_document(size * 1024 * 1024)
+        yield "synthetic.md", content, images
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark advanced_text_splitter against the previous implementation.")
+    parser.add_argument("paths", nargs="*", default=[os.path.join(IMAGE_STORE_FOLDER, "*_init.md")], help="Markdown files (default: the *_init.md artifacts)")
+    parser.add_argument("--size", type=int, default=8, help="size in MB of the synthetic document when there is no file")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, content, images in load_documents(args.paths, args.size):
+        docs = [Document(page_content=content, metadata={"images": images})]
+        timings = {}
+        results = {}
+        for label, splitter in (("previous", legacy_text_splitter), ("single pass", advanced_text_splitter)):
+            best = float("inf")
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results[label] = splitter(docs, name)
+                best = min(best, time.perf_counter() - start)
+            timings[label] = best
+        assert results["previous"] == results["single pass"], f"{name}: the chunks differ"
+        print(f"{name}: {len(content) / 1e6:.1f} MB, {len(results['previous'])} chunks")
+        print(f"  previous:    {timings['previous'] * 1000:10.1f} ms")
+        print(f"  single pass: {timings['single pass'] * 1000:10.1f} ms ({timings['previous'] / timings['single pass']:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: fake_services.py
+# Description: Local stand-ins of Document Intelligence, the vision model and the embedding model for the benchmarks.
+#              A single HTTP server speaks the REST protocol of the three services, so the real clients
+#              (DocumentIntelligenceClient, VisionClient, AzureOpenAIEmbeddings) run unchanged against it.
+# Usage: with FakeAzureServices(di_latency=1.0, vision_latency=0.5) as services:
+#            AzureAIDocumentIntelligenceParser(api_endpoint=services.endpoint, api_key="fake", ...)
+#-----------------------------------------------------------------------------------------------------------
+
+import base64
+import gzip
+import hashlib
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pymupdf
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.bm25 import tokenize
+from its_a_rag.cache import ANALYSIS_CACHE_FOLDER
+from its_a_rag.doc_intelligence import PAGE_BREAK, STRING_INDEX_TYPE, split_pdf_pages
+from its_a_rag.rate_limit import TokenBucket
+
+# Minimum size of a vector drawing reported as a figure (in inches)
+MIN_FIGURE_SIZE = (1.5, 1.0)
+
+DI_PATTERN = re.compile(r"^/documentintelligence/documentModels/(?P<model>[^/:]+)(?::analyze|/analyzeResults/(?P<result>[^/?]+))$")
+OPENAI_PATTERN = re.compile(r"^/openai/deployments/(?P<deployment>[^/]+)/(?P<operation>chat/completions|embeddings)$")
+
+
+#########################################################
+# Find the figures of a PDF page: the embedded images and the clusters
+# of vector drawings large enough to be charts
+# Returns:
+#   - list of pymupdf.Rect (in points), top to bottom
+#########################################################
+def find_figure_rects(page, max_figures):
+    rects = [pymupdf.Rect(info["bbox"]) for info in page.get_image_info()]
+    rects += page.cluster_drawings()
+    rects = [r for r in rects if r.width >= MIN_FIGURE_SIZE[0] * 72 and r.height >= MIN_FIGURE_SIZE[1] * 72 and not r.is_infinite]
+    kept = []
+    for rect in sorted(rects, key=lambda r: -r.get_area()):
+        if not any(rect.intersects(other) for other in kept):
+            kept.append(rect)
+    return sorted(kept[:max_figures], key=lambda r: (r.y0, r.x0))
+
+
+#########################################################
+# Build a synthetic AnalyzeResult of a PDF, shaped like the prebuilt-layout
+# Markdown output: the larger fonts become headers, the figures are
+# <figure> tags holding the text drawn inside them, and each figure has
+# its bounding region (in inches) and its span in the content.
+# Args:
+#   - pdf_bytes: content of the PDF
+#   - model_id: model reported in the result
+#   - max_figures_per_page: maximum number of figures of a page
+# Returns:
+#   - AnalyzeResult as a JSON dictionary
+#########################################################
+def synthetic_layout(pdf_bytes, model_id="prebuilt-layout", max_figures_per_page=2):
+    content = []
+    length = 0
+    pages = []
+    figures = []
+
+    def append(text):
+        nonlocal length
+        content.append(text)
+        length += len(text)
+
+    with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page_number, page in enumerate(doc, start=1):
+            page_start = length
+            blocks = [b for b in page.get_text("dict")["blocks"] if b["type"] == 0]
+            sizes = [span["size"] for b in blocks for line in b["lines"] for span in line["spans"] if span["text"].strip()]
+            body_size = statistics.median(sizes) if sizes else 10
+            rects = find_figure_rects(page, max_figures_per_page)
+            inside = {i: [] for i in range(len(rects))}
+            items = []
+            for block in blocks:
+                text = "\n".join(" ".join(span["text"] for span in line["spans"]).strip() for line in block["lines"]).strip()
+                if not text:
+                    continue
+                box = pymupdf.Rect(block["bbox"])
+                owner = next((i for i, rect in enumerate(rects) if rect.contains(box.tl) and rect.contains(box.br)), None)
+                if owner is not None:
+                    inside[owner].append(text)
+                    continue
+                size = max(span["size"] for line in block["lines"] for span in line["spans"])
+                if len(text) < 120 and size >= body_size * 1.4:
+                    text = "# " + text.replace("\n", " ")
+                elif len(text) < 120 and size >= body_size * 1.15:
+                    text = "## " + text.replace("\n", " ")
+                items.append((box.y0, box.x0, "text", text))
+            items += [(rect.y0, rect.x0, "figure", i) for i, rect in enumerate(rects)]
+            for n, (_, _, kind, value) in enumerate(sorted(items, key=lambda item: (item[0], item[1]))):
+                if n:
+                    append("\n\n")
+                if kind == "text":
+                    append(value)
+                    continue
+                rect = rects[value]
+                tag = "<figure>\n" + "\n".join(inside[value]) + "\n</figure>"
+                x0, y0, x1, y1 = (round(v / 72, 4) for v in rect)
+                figures.append({
+                    "id": f"{page_number}.{value + 1}",
+                    "boundingRegions": [{"pageNumber": page_number, "polygon": [x0, y0, x1, y0, x1, y1, x0, y1]}],
+                    "spans": [{"offset": length, "length": len(tag)}],
+                    "elements": [],
+                })
+                append(tag)
+            pages.append({
+                "pageNumber": page_number,
+                "angle": 0,
+                "width": round(page.rect.width / 72, 4),
+                "height": round(page.rect.height / 72, 4),
+                "unit": "inch",
+                "spans": [{"offset": page_start, "length": length - page_start}],
+            })
+            if page_number < doc.page_count:
+                append(PAGE_BREAK)
+    return {
+        "apiVersion": "2024-11-30",
+        "modelId": model_id,
+        "stringIndexType": STRING_INDEX_TYPE,
+        "content": "".join(content),
+        "contentFormat": "markdown",
+        "pages": pages,
+        "figures": figures,
+    }
+
+
+#########################################################
+# Deterministic embedding of a text (hashed tokens, normalized)
+#########################################################
+def hashed_embedding(text, dimensions):
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for token in tokenize(text):
+        vector[int.from_bytes(hashlib.blake2b(token.encode(), digest_size=4).digest(), "little") % dimensions] += 1
+    vector += 1e-3
+    return vector / np.linalg.norm(vector)
+
+
+#########################################################
+# Class: Fake Azure Services
+# HTTP server standing in for Document Intelligence (analyze + polling),
+# the chat completions of the vision model and the embeddings.
+# The layouts are replayed from recorded AnalyzeResults when available
+# (the analysis cache of previous real runs, or <sha256 of the PDF>.json[.gz]
+# files), else generated from the PDF by synthetic_layout.
+# Each request takes at least its configured latency; the analysis
+# latency grows with the number of pages, the embedding latency with the
+# number of inputs.
+# Args:
+#   - di_latency: duration of a layout analysis (seconds)
+#   - di_latency_per_page: additional duration per analyzed page (seconds)
+#   - vision_latency: duration of an image description (seconds)
+#   - embedding_latency: duration of an embedding request (seconds)
+#   - embedding_latency_per_input: additional duration per embedded text (seconds)
+#   - embedding_dimensions: dimension of the embedding vectors
+#   - recordings: folder of recorded AnalyzeResults
+#   - analysis_cache_folder: folder of the AnalysisResultCache replayed
+#   - max_figures_per_page: maximum number of figures of a page in the synthetic layouts
+#   - vision_quota_rpm, embedding_quota_rpm: optional request quotas of the deployments,
+#     the requests over the quota get a 429 response with a retry-after-ms header
+#########################################################
+class FakeAzureServices:
+    def __init__(self, di_latency=1.0, di_latency_per_page=0.0, vision_latency=0.5, embedding_latency=0.05, embedding_latency_per_input=0.0, embedding_dimensions=256, recordings=None, analysis_cache_folder=ANALYSIS_CACHE_FOLDER, max_figures_per_page=2, vision_quota_rpm=None, embedding_quota_rpm=None):
+        self.di_latency = di_latency
+        self.di_latency_per_page = di_latency_per_page
+        self.vision_latency = vision_latency
+        self.embedding_latency = embedding_latency
+        self.embedding_latency_per_input = embedding_latency_per_input
+        self.embedding_dimensions = embedding_dimensions
+        self.recordings = recordings
+        self.analysis_cache_folder = analysis_cache_folder
+        self.max_figures_per_page = max_figures_per_page
+        self._quotas = {
+            "chat": TokenBucket(vision_quota_rpm) if vision_quota_rpm else None,
+            "embeddings": TokenBucket(embedding_quota_rpm) if embedding_quota_rpm else None,
+        }
+        self.counters = {"analyze": 0, "poll": 0, "chat": 0, "embeddings": 0, "embedded_texts": 0, "throttled": 0, "replayed": 0, "synthetic": 0}
+        self._layouts = {}       # (sha256 of the PDF, model, output format) -> AnalyzeResult dictionary
+        self._operations = {}    # result id -> (ready time, AnalyzeResult dictionary)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """Start the server on a free local port."""
+        services = self
+
+        class Handler(_Handler):
+            pass
+        Handler.services = services
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the server."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def reset_counters(self):
+        with self._lock:
+            for name in self.counters:
+                self.counters[name] = 0
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    # Layouts
+    def _recorded_layout(self, file_hash, model_id, output_format, features, string_index_type):
+        # Same key as AnalysisResultCache.key, computed from the uploaded bytes
+        options = json.dumps([model_id, output_format, sorted(features), string_index_type])
+        key = hashlib.sha256(f"{file_hash}:{options}".encode()).hexdigest()
+        candidates = [os.path.join(self.analysis_cache_folder, key[:2], f"{key}.json.gz")] if self.analysis_cache_folder else []
+        if self.recordings:
+            candidates += [os.path.join(self.recordings, f"{file_hash}.json.gz"), os.path.join(self.recordings, f"{file_hash}.json")]
+        for path in candidates:
+            if os.path.exists(path):
+                with (gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path)) as f:
+                    return json.load(f)
+        return None
+
+    def layout(self, pdf_bytes, model_id="prebuilt-layout", output_format="markdown", features=(), string_index_type=STRING_INDEX_TYPE):
+        """Return the AnalyzeResult of a PDF (recorded, else synthetic), computed once per content."""
+        file_hash = hashlib.sha256(pdf_bytes).hexdigest()
+        # The features and string index type are only part of the key of the recordings (the client may not send them)
+        key = (file_hash, model_id, output_format)
+        with self._lock:
+            layout = self._layouts.get(key)
+        if layout is None:
+            layout = self._recorded_layout(file_hash, model_id, output_format, features, string_index_type)
+            self._count("replayed" if layout is not None else "synthetic")
+            if layout is None:
+                layout = synthetic_layout(pdf_bytes, model_id, self.max_figures_per_page)
+            with self._lock:
+                self._layouts[key] = layout
+        return layout
+
+    def prepare(self, file_paths, model_id="prebuilt-layout", output_format="markdown", features=(), shard_pages=None):
+        """Compute the layouts of the files ahead of the timed runs (and of their page ranges, see split_pdf_pages)."""
+        for file_path in file_paths:
+            with open(file_path, "rb") as f:
+                self.layout(f.read(), model_id, output_format, features)
+            if shard_pages:
+                with tempfile.TemporaryDirectory() as folder:
+                    for _, shard_path in split_pdf_pages(file_path, shard_pages, folder):
+                        with open(shard_path, "rb") as f:
+                            self.layout(f.read(), model_id, output_format, features)
+
+    # Requests
+    def analyze(self, model_id, query, body):
+        start = time.monotonic()
+        self._count("analyze")
+        layout = self.layout(body, model_id, query.get("outputContentFormat", ["text"])[0], query.get("features", [""])[0].split(",") if query.get("features", [""])[0] else (), query.get("stringIndexType", ["textElements"])[0])
+        result_id = str(uuid.uuid4())
+        with self._lock:
+            self._operations[result_id] = (start + self.di_latency + self.di_latency_per_page * len(layout["pages"]), layout)
+        return result_id
+
+    def poll(self, result_id):
+        self._count("poll")
+        with self._lock:
+            ready, layout = self._operations[result_id]
+        # Long polling: the request returns once the analysis is "done"
+        time.sleep(max(0.0, ready - time.monotonic()))
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        return {"status": "succeeded", "createdDateTime": now, "lastUpdatedDateTime": now, "analyzeResult": layout}
+
+    def throttle(self, operation):
+        """Return the seconds to wait if the request is over the quota of the operation, else None."""
+        bucket = self._quotas.get(operation)
+        if bucket is None:
+            return None
+        with self._lock:
+            wait = bucket.wait_time(1, time.monotonic())
+            if wait == 0:
+                bucket.take(1)
+                return None
+            self.counters["throttled"] += 1
+            return wait
+
+    def chat(self, deployment, request):
+        self._count("chat")
+        time.sleep(self.vision_latency)
+        parts = request["messages"][-1]["content"]
+        image_url = next((p["image_url"]["url"] for p in parts if p.get("type") == "image_url"), "")
+        digest = hashlib.sha256(image_url.encode()).hexdigest()[:16]
+        description = f"The image {digest} is a bar chart of the revenue by quarter, in millions of dollars, with an upward trend."
+        return {
+            "id": f"chatcmpl-{digest}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": description}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1000, "completion_tokens": len(description) // 4, "total_tokens": 1000 + len(description) // 4},
+        }
+
+    def embeddings(self, deployment, request):
+        inputs = request["input"]
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        # Token arrays (tiktoken-enabled clients) are embedded from their token ids
+        texts = [text if isinstance(text, str) else " ".join(map(str, text)) for text in inputs]
+        self._count("embeddings")
+        self._count("embedded_texts", len(texts))
+        time.sleep(self.embedding_latency + self.embedding_latency_per_input * len(texts))
+        dimensions = request.get("dimensions") or self.embedding_dimensions
+        data = []
+        for i, text in enumerate(texts):
+            vector = hashed_embedding(text, dimensions)
+            if request.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(text) // 4 for text in texts)
+        return {"object": "list", "data": data, "model": deployment, "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    services = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload=None, headers=None):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self._body()
+        match = DI_PATTERN.match(url.path)
+        if match and match["result"] is None:
+            result_id = self.services.analyze(match["model"], query, body)
+            location = f"{self.services.endpoint}/documentintelligence/documentModels/{match['model']}/analyzeResults/{result_id}?{url.query}"
+            return self._send(202, headers={"Operation-Location": location, "Retry-After": "0", "apim-request-id": result_id})
+        match = OPENAI_PATTERN.match(url.path)
+        if match:
+            request = json.loads(body)
+            wait = self.services.throttle("embeddings" if match["operation"] == "embeddings" else "chat")
+            if wait is not None:
+                return self._send(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}}, {"retry-after-ms": str(int(wait * 1000) + 1), "retry-after": str(int(wait) + 1)})
+            if match["operation"] == "embeddings":
+                return self._send(200, self.services.embeddings(match["deployment"], request))
+            return self._send(200, self.services.chat(match["deployment"], request))
+        self._send(404, {"error": {"code": "NotFound", "message": url.path}})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = DI_PATTERN.match(url.path)
+        if match and match["result"] is not None:
+            try:
+                return self._send(200, self.services.poll(match["result"]))
+            except KeyError:
+                pass
+        self._send(404, {"error": {"code": "NotFound", "message": url.path}})
@@ -0,0 +1,244 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: bm25.py
+# Description: Incremental BM25 inverted index of the chunks and reciprocal rank fusion with the vector results.
+# Version: 2025-02-03
+# Author: Francesco Sodano
+#-----------------------------------------------------------------------------------------------------------
+
+from __future__ import annotations
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+# Lowercase words and numbers, keeping the inner punctuation of tokens such as 10-k or 1,234.5
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.,\-][a-z0-9]+)*")
+
+# Constant of the reciprocal rank fusion (score = sum of 1 / (RRF_K + rank))
+RRF_K = 60
+
+# Term frequencies are stored as uint16
+MAX_TERM_FREQUENCY = 65535
+
+
+#########################################################
+# Split a text into BM25 tokens
+# Args:
+#   - text: text to tokenize
+# Returns:
+#   - list of tokens
+#########################################################
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+#########################################################
+# Fuse several rankings with reciprocal rank fusion
+# Args:
+#   - rankings: lists of ids, best first
+#   - k: RRF constant (higher values flatten the contribution of the top ranks)
+#   - weights: optional weight of each ranking
+# Returns:
+#   - list of (id, fused score) tuples, best first
+#########################################################
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = RRF_K, weights: Optional[List[float]] = None) -> List[Tuple[str, float]]:
+    scores: Dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights or [1.0] * len(rankings)):
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + weight / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+#########################################################
+# Class: BM25 Index
+# Inverted index of the chunks, updated incrementally: the posting list of
+# each term is a pair of compact arrays (uint32 document numbers, uint16
+# term frequencies). Deleted documents are tombstoned and removed from the
+# posting lists when the index is compacted (on save).
+# Args:
+#   - k1: term frequency saturation
+#   - b: document length normalization
+#########################################################
+class BM25Index:
+    def __init__(self, k1: float = 1.2, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._terms: Dict[str, int] = {}                # term -> term id
+        self._postings_docs: List[array] = []           # term id -> document numbers
+        self._postings_tfs: List[array] = []            # term id -> term frequencies
+        self._df = array("I")                           # term id -> number of live documents
+        self._keys: List[Optional[str]] = []            # document number -> id (None once deleted)
+        self._numbers: Dict[str, int] = {}              # id -> document number
+        self._lengths = array("I")                      # document number -> number of tokens
+        self._doc_terms: List[array] = []               # document number -> term ids (to delete it)
+        self._total_length = 0
+        self._norm: Optional[np.ndarray] = None         # length normalization, cached until the next change
+
+    def __len__(self) -> int:
+        return len(self._numbers)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._numbers
+
+    # Writing
+    def add(self, key: str, text: str) -> None:
+        """Index a text (an existing id is replaced)."""
+        counts = Counter(tokenize(text))
+        with self._lock:
+            if key in self._numbers:
+                self._delete(key)
+            number = len(self._keys)
+            term_ids = array("I")
+            for term, tf in counts.items():
+                term_id = self._terms.get(term)
+                if term_id is None:
+                    term_id = self._terms[term] = len(self._postings_docs)
+                    self._postings_docs.append(array("I"))
+                    self._postings_tfs.append(array("H"))
+                    self._df.append(0)
+                self._postings_docs[term_id].append(number)
+                self._postings_tfs[term_id].append(min(tf, MAX_TERM_FREQUENCY))
+                self._df[term_id] += 1
+                term_ids.append(term_id)
+            length = sum(counts.values())
+            self._keys.append(key)
+            self._numbers[key] = number
+            self._lengths.append(length)
+            self._doc_terms.append(term_ids)
+            self._total_length += length
+            self._norm = None
+
+    def add_texts(self, keys: Iterable[str], texts: Iterable[str]) -> None:
+        """Index several texts."""
+        for key, text in zip(keys, texts):
+            self.add(key, text)
+
+    def add_documents(self, documents: List[Document], ids: Optional[List[str]] = None) -> None:
+        """Index chunks (from advanced_text_splitter) under their ids."""
+        self.add_texts(ids or [doc.id for doc in documents], [doc.page_content for doc in documents])
+
+    def delete(self, keys: Iterable[str]) -> None:
+        """Remove documents from the index."""
+        with self._lock:
+            for key in keys:
+                if key in self._numbers:
+                    self._delete(key)
+
+    def _delete(self, key: str) -> None:
+        number = self._numbers.pop(key)
+        self._keys[number] = None
+        for term_id in self._doc_terms[number]:
+            self._df[term_id] -= 1
+        self._doc_terms[number] = array("I")
+        self._total_length -= self._lengths[number]
+        self._norm = None
+
+    def compact(self) -> None:
+        """Remove the deleted documents from the posting lists and renumber the documents."""
+        with self._lock:
+            if len(self._numbers) == len(self._keys):
+                return
+            alive = np.array([key is not None for key in self._keys], dtype=bool)
+            renumber = np.cumsum(alive, dtype=np.int64) - 1
+            for term_id, (docs, tfs) in enumerate(zip(self._postings_docs, self._postings_tfs)):
+                docs_np = np.frombuffer(docs, dtype=np.uint32)
+                keep = alive[docs_np]
+                self._postings_docs[term_id] = array("I", renumber[docs_np[keep]].astype(np.uint32).tobytes())
+                self._postings_tfs[term_id] = array("H", np.frombuffer(tfs, dtype=np.uint16)[keep].tobytes())
+            self._keys = [key for key in self._keys if key is not None]
+            self._numbers = {key: number for number, key in enumerate(self._keys)}
+            self._lengths = array("I", np.frombuffer(self._lengths, dtype=np.uint32)[alive].tobytes())
+            self._doc_terms = [terms for terms, keep in zip(self._doc_terms, alive) if keep]
+            self._norm = None
+
+    # Search
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """Return the ids and BM25 scores of the k best documents."""
+        term_ids = {self._terms[term] for term in tokenize(query) if term in self._terms}
+        with self._lock:
+            live = len(self._numbers)
+            if not term_ids or live == 0 or k <= 0:
+                return []
+            if self._norm is None:
+                lengths = np.frombuffer(self._lengths, dtype=np.uint32).astype(np.float32)
+                average = self._total_length / live or 1
+                self._norm = (self.k1 * (1 - self.b + self.b * lengths / average)).astype(np.float32)
+            norm = self._norm
+            scores = np.zeros(len(self._keys), dtype=np.float32)
+            for term_id in term_ids:
+                df = self._df[term_id]
+                if df == 0:
+                    continue
+                idf = math.log(1 + (live - df + 0.5) / (df + 0.5))
+                docs = np.frombuffer(self._postings_docs[term_id], dtype=np.uint32)
+                tfs = np.frombuffer(self._postings_tfs[term_id], dtype=np.uint16).astype(np.float32)
+                # Document numbers are unique in a posting list, so the fancy-indexed += is safe
+                scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm[docs])
+            if live < len(self._keys):
+                scores[[number for number, key in enumerate(self._keys) if key is None]] = 0
+            candidates = np.flatnonzero(scores)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+            candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+            return [(self._keys[number], float(scores[number])) for number in candidates]
+
+    # Persistence
+    def save(self, folder: str) -> None:
+        """Save the index in a folder (bm25.json and bm25.npz)."""
+        os.makedirs(folder, exist_ok=True)
+        with self._lock:
+            self.compact()
+            terms = sorted(self._terms, key=self._terms.get)
+            offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(docs) for docs in self._postings_docs])
+            arrays = {
+                "offsets": offsets,
+                "docs": np.frombuffer(b"".join(docs.tobytes() for docs in self._postings_docs), dtype=np.uint32),
+                "tfs": np.frombuffer(b"".join(tfs.tobytes() for tfs in self._postings_tfs), dtype=np.uint16),
+                "lengths": np.frombuffer(self._lengths, dtype=np.uint32),
+            }
+            description = {"k1": self.k1, "b": self.b, "terms": terms, "keys": self._keys}
+            for name, write, mode in (
+                ("bm25.npz", lambda f: np.savez(f, **arrays), "wb"),
+                ("bm25.json", lambda f: json.dump(description, f), "w"),
+            ):
+                fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+                with os.fdopen(fd, mode) as f:
+                    write(f)
+                os.replace(tmp_path, os.path.join(folder, name))
+
+    @classmethod
+    def load(cls, folder: str) -> BM25Index:
+        """Load an index saved with save."""
+        with open(os.path.join(folder, "bm25.json")) as f:
+            description = json.load(f)
+        index = cls(description["k1"], description["b"])
+        with np.load(os.path.join(folder, "bm25.npz")) as arrays:
+            offsets, docs, tfs, lengths = arrays["offsets"], arrays["docs"], arrays["tfs"], arrays["lengths"]
+        index._terms = {term: term_id for term_id, term in enumerate(description["terms"])}
+        index._keys = description["keys"]
+        index._numbers = {key: number for number, key in enumerate(index._keys)}
+        index._lengths = array("I", lengths.astype(np.uint32).tobytes())
+        index._total_length = int(lengths.sum())
+        index._df = array("I", np.diff(offsets).astype(np.uint32).tobytes())
+        for term_id in range(len(description["terms"])):
+            start, end = offsets[term_id], offsets[term_id + 1]
+            index._postings_docs.append(array("I", docs[start:end].tobytes()))
+            index._postings_tfs.append(array("H", tfs[start:end].tobytes()))
+        # Forward index (term ids of each document), needed to delete documents
+        term_of_posting = np.repeat(np.arange(len(description["terms"]), dtype=np.uint32), np.diff(offsets))
+        order = np.argsort(docs, kind="stable")
+        bounds = np.searchsorted(docs[order], np.arange(len(index._keys) + 1))
+        sorted_terms = term_of_posting[order]
+        index._doc_terms = [array("I", sorted_terms[bounds[number]:bounds[number + 1]].tobytes()) for number in range(len(index._keys))]
+        return index
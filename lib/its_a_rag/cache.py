@@ -0,0 +1,539 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: cache.py
+# Description: Caches for the expensive steps of the Multimodal Ingestion System.
+# Version: 2025-02-03
+# Author: Francesco Sodano
+#-----------------------------------------------------------------------------------------------------------
+
+from __future__ import annotations
+import gzip
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import closing
+from typing import Any, Dict, Iterable, List, Optional
+import numpy as np
+from azure.ai.documentintelligence.models import AnalyzeResult
+from langchain_core.embeddings import Embeddings
+from PIL import Image
+from .image_store import ImageStore
+
+DESCRIPTION_CACHE_PATH = "ingestion/cache/image_descriptions.sqlite"
+
+# Default size bound of the description cache (sum of the stored descriptions, in bytes)
+DESCRIPTION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+ANALYSIS_CACHE_FOLDER = "ingestion/cache/analysis"
+
+EMBEDDING_DIMENSIONS_PATH = "ingestion/cache/embedding_dimensions.json"
+
+# Maximum number of query embeddings kept in memory
+QUERY_EMBEDDING_CACHE_SIZE = 4096
+
+FIGURE_INDEX_PATH = "ingestion/cache/figure_index.sqlite"
+
+# Side of the perceptual hash grid (PERCEPTUAL_HASH_SIZE ** 2 bits)
+PERCEPTUAL_HASH_SIZE = 16
+
+# Maximum number of different bits between the perceptual hashes of near-duplicate images
+DUPLICATE_MAX_DISTANCE = 6
+
+# Maximum difference of the aspect ratios of near-duplicate images (log of the ratio)
+DUPLICATE_ASPECT_TOLERANCE = 0.1
+
+
+#########################################################
+# Compute the hash of an image
+# Args:
+#   - image: cropped image (PIL.Image.Image) or raw image bytes
+#   - encoding: optional description of how the image is encoded for the model
+# Returns:
+#   - hex digest of the image
+#########################################################
+def image_hash(image, encoding: str = "") -> str:
+    digest = hashlib.sha256()
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        digest.update(image)
+    else:
+        # Hash the pixels (not the encoded file) so the hash does not depend on the image encoder version
+        digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}".encode())
+        digest.update(image.tobytes())
+    digest.update(encoding.encode("utf-8"))
+    return digest.hexdigest()
+
+
+#########################################################
+# Compute the cache key of an image description
+# Args:
+#   - image_hash: hash of the image sent to the model (see image_hash)
+#   - caption: caption sent with the image
+#   - system_context: system prompt used to describe the image
+#   - deployment_name: name of the vision model deployment
+# Returns:
+#   - hex digest identifying the description
+#########################################################
+def image_description_key(image_hash: str, caption: str, system_context: str, deployment_name: str) -> str:
+    digest = hashlib.sha256()
+    for part in (image_hash or "", caption or "", system_context or "", deployment_name or ""):
+        # Length-prefix the parts so that different splits of the same text do not collide
+        encoded = part.encode("utf-8")
+        digest.update(len(encoded).to_bytes(8, "little"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+#########################################################
+# Compute the perceptual hash of an image (difference hash)
+# Near-duplicate images (the same logo or chart rendered at another size,
+# resolution or compression) have hashes differing by a few bits.
+# Args:
+#   - image: cropped image (PIL.Image.Image)
+#   - size: side of the hash grid
+# Returns:
+#   - hash as an integer of size ** 2 bits
+#########################################################
+def perceptual_hash(image, size: int = PERCEPTUAL_HASH_SIZE) -> int:
+    pixels = np.asarray(image.convert("L").resize((size + 1, size), Image.BOX), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+#########################################################
+# Class: Image Description Cache
+# Content-addressed on-disk cache of the image descriptions, stored in a
+# SQLite database so that several ingestion processes can share it.
+# The least recently used entries are evicted when the stored descriptions
+# exceed max_bytes.
+# Args:
+#   - path: path of the SQLite database
+#   - max_bytes: size bound of the cache
+#########################################################
+class ImageDescriptionCache:
+    def __init__(self, path: str = DESCRIPTION_CACHE_PATH, max_bytes: int = DESCRIPTION_CACHE_MAX_BYTES) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS descriptions ("
+                " key TEXT PRIMARY KEY,"
+                " description TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS descriptions_last_access ON descriptions (last_access)")
+            # Running total of the stored sizes, maintained by triggers so that every process sees the same total
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta (name, value) SELECT 'total_size', COALESCE(SUM(size), 0) FROM descriptions")
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS descriptions_insert AFTER INSERT ON descriptions BEGIN"
+                " UPDATE meta SET value = value + NEW.size WHERE name = 'total_size'; END"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS descriptions_update AFTER UPDATE OF size ON descriptions BEGIN"
+                " UPDATE meta SET value = value + NEW.size - OLD.size WHERE name = 'total_size'; END"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS descriptions_delete AFTER DELETE ON descriptions BEGIN"
+                " UPDATE meta SET value = value - OLD.size WHERE name = 'total_size'; END"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per operation: connections are not shared between threads or processes
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached description, or None."""
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT description FROM descriptions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE descriptions SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return row[0]
+
+    def set(self, key: str, description: str) -> None:
+        """Store a description and evict the least recently used entries above the size bound."""
+        size = len(description.encode("utf-8"))
+        with closing(self._connect()) as conn, conn:
+            # An upsert (not a REPLACE) so that the size triggers see the previous size of the entry
+            conn.execute(
+                "INSERT INTO descriptions (key, description, size, last_access) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET description = excluded.description, size = excluded.size, last_access = excluded.last_access",
+                (key, description, size, time.time()),
+            )
+            excess = conn.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0] - self.max_bytes
+            if excess <= 0:
+                return
+            # Oldest entries first, until the total is back under the bound
+            evicted = []
+            for evicted_key, evicted_size in conn.execute("SELECT key, size FROM descriptions ORDER BY last_access"):
+                evicted.append((evicted_key,))
+                excess -= evicted_size
+                if excess <= 0:
+                    break
+            conn.executemany("DELETE FROM descriptions WHERE key = ?", evicted)
+
+    def total_size(self) -> int:
+        """Return the sum of the sizes of the stored descriptions, in bytes."""
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0]
+
+    def clear(self) -> None:
+        """Remove all the cached descriptions."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM descriptions")
+
+    def __len__(self) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM descriptions").fetchone()[0]
+
+
+#########################################################
+# Class: Perceptual Hash Index
+# In-memory index of near-duplicate images: an entry matches a hash with
+# the same key (e.g. caption and text of the figure) and a similar aspect
+# ratio, differing by at most max_distance bits. The hashes are split in
+# max_distance + 1 bands, and two hashes within that distance have at least
+# one identical band, so only the entries sharing a band are compared.
+# Args:
+#   - max_distance: maximum number of different bits
+#   - bits: number of bits of the hashes
+#########################################################
+class PerceptualHashIndex:
+    def __init__(self, max_distance: int = DUPLICATE_MAX_DISTANCE, bits: int = PERCEPTUAL_HASH_SIZE ** 2) -> None:
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        bounds = [bits * i // bands for i in range(bands + 1)]
+        self._bands = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self._buckets: Dict[tuple, List[tuple]] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _keys(self, key: str, phash: int):
+        for band, (shift, mask) in enumerate(self._bands):
+            yield (key, band, (phash >> shift) & mask)
+
+    def find(self, key: str, phash: int, aspect: float) -> Optional[Any]:
+        """Return the value of the closest near-duplicate entry (the earliest one on ties), or None."""
+        best = None
+        for bucket_key in self._keys(key, phash):
+            for entry_phash, entry_aspect, order, value in self._buckets.get(bucket_key, ()):
+                distance = (entry_phash ^ phash).bit_count()
+                if distance <= self.max_distance and abs(math.log(entry_aspect / aspect)) <= DUPLICATE_ASPECT_TOLERANCE:
+                    if best is None or (distance, order) < best[:2]:
+                        best = (distance, order, value)
+        return best[2] if best is not None else None
+
+    def add(self, key: str, phash: int, aspect: float, value: Any) -> None:
+        """Add an entry."""
+        entry = (phash, aspect, self._size, value)
+        for bucket_key in self._keys(key, phash):
+            self._buckets.setdefault(bucket_key, []).append(entry)
+        self._size += 1
+
+
+#########################################################
+# Class: Figure Index
+# Corpus-level index of the described figures, stored in a SQLite database
+# (only the hashes are loaded in memory when opened, the description and
+# image of a figure are read when it matches), so that the near-duplicates of a figure
+# described in a previous document (a logo, a recurring chart of the
+# yearly filings) reuse its description and image instead of a new vision
+# call. Other processes sharing the database see the new figures when they
+# open it.
+# Args:
+#   - path: path of the SQLite database
+#   - max_distance: maximum number of different bits of the perceptual hashes
+#   - image_store: optional image store, the figures then reference their image instead of holding its data URL
+#########################################################
+class FigureIndex:
+    def __init__(self, path: str = FIGURE_INDEX_PATH, max_distance: int = DUPLICATE_MAX_DISTANCE, image_store: Optional[ImageStore] = None) -> None:
+        self.path = path
+        self.image_store = image_store
+        self.hits = 0
+        self.misses = 0
+        self._index = PerceptualHashIndex(max_distance)
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS figures ("
+                " id INTEGER PRIMARY KEY,"
+                " key TEXT NOT NULL,"
+                " phash TEXT NOT NULL,"
+                " aspect REAL NOT NULL,"
+                " description TEXT NOT NULL,"
+                " image_url TEXT,"
+                " source TEXT)"
+            )
+            rows = conn.execute("SELECT id, key, phash, aspect FROM figures ORDER BY id").fetchall()
+        for figure_id, key, phash, aspect in rows:
+            self._index.add(key, int(phash, 16), aspect, figure_id)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._index)
+
+    def find(self, key: str, phash: int, aspect: float) -> Optional[tuple]:
+        """Return the (description, image URL, source) of a near-duplicate figure, or None."""
+        with self._lock:
+            figure_id = self._index.find(key, phash, aspect)
+        row = None
+        if figure_id is not None:
+            with closing(self._connect()) as conn:
+                row = conn.execute("SELECT description, image_url, source FROM figures WHERE id = ?", (figure_id,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return row
+
+    def add(self, key: str, phash: int, aspect: float, description: str, image_url: Optional[str], source: Optional[str] = None) -> None:
+        """Add a described figure (source identifies it, e.g. "<file>#<figure index>")."""
+        if self.image_store is not None:
+            image_url = self.image_store.put_data_url(image_url)
+        with closing(self._connect()) as conn, conn:
+            figure_id = conn.execute(
+                "INSERT INTO figures (key, phash, aspect, description, image_url, source) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, format(phash, "x"), aspect, description, image_url, source),
+            ).lastrowid
+        with self._lock:
+            self._index.add(key, phash, aspect, figure_id)
+
+    def clear(self) -> None:
+        """Remove all the figures."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM figures")
+        with self._lock:
+            self._index = PerceptualHashIndex(self._index.max_distance)
+
+
+#########################################################
+# Compute the hash of a file content
+# Args:
+#   - file_path: path of the file
+# Returns:
+#   - hex digest of the file content
+#########################################################
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+#########################################################
+# Class: Analysis Result Cache
+# Stores the Document Intelligence AnalyzeResult of a file on disk
+# (gzip compressed JSON) keyed by the file hash and the analysis options,
+# so that an unchanged file is never uploaded and analyzed again.
+# Args:
+#   - folder: folder where the results are stored
+#########################################################
+class AnalysisResultCache:
+    def __init__(self, folder: str = ANALYSIS_CACHE_FOLDER) -> None:
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, file_path: str, api_model: str, output_format: str, analysis_features: Optional[Iterable[str]] = None, string_index_type: str = "textElements") -> str:
+        """Return the cache key of the analysis of a file with the given options (the string index type defaults to the one of the service)."""
+        features = sorted(str(getattr(feature, "value", feature)) for feature in analysis_features or [])
+        options = json.dumps([api_model, str(getattr(output_format, "value", output_format)), features, string_index_type])
+        return hashlib.sha256(f"{file_sha256(file_path)}:{options}".encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, key[:2], f"{key}.json.gz")
+
+    def get(self, key: str) -> Optional[AnalyzeResult]:
+        """Return the stored analysis result, or None."""
+        try:
+            with gzip.open(self._path(key), "rt", encoding="utf-8") as f:
+                return AnalyzeResult(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, result: AnalyzeResult) -> None:
+        """Store an analysis result (written to a temporary file first so readers never see a partial file)."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8") as f:
+                json.dump(result.as_dict(), f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+#########################################################
+# Class: Embedding Dimension Cache
+# Remembers the dimension of the vectors of each embedding deployment
+# (JSON file), so that building the index schema does not need an
+# embedding call to find it out.
+# Args:
+#   - path: path of the JSON file
+#########################################################
+class EmbeddingDimensionCache:
+    def __init__(self, path: str = EMBEDDING_DIMENSIONS_PATH) -> None:
+        self.path = path
+
+    @staticmethod
+    def key(endpoint: str, deployment_name: str) -> str:
+        """Return the cache key of an embedding deployment."""
+        return f"{(endpoint or '').rstrip('/')}|{deployment_name}"
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, key: str) -> Optional[int]:
+        """Return the cached dimension, or None."""
+        return self._load().get(key)
+
+    def set(self, key: str, dimensions: int) -> None:
+        """Store the dimension of a deployment (written to a temporary file first so readers never see a partial file)."""
+        entries = self._load()
+        entries[key] = int(dimensions)
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+
+#########################################################
+# Class: Cached Embeddings
+# Embeddings wrapper keeping the query embeddings in a bounded LRU cache
+# (keyed on the deployment and the whitespace-normalized text), so that a
+# query searched several times is only embedded once. The documents are
+# embedded without the cache (an ingestion would evict all the queries).
+# Args:
+#   - embeddings: embedding model
+#   - deployment_name: name of the embedding deployment (part of the key)
+#   - max_entries: maximum number of cached embeddings
+#########################################################
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, deployment_name: Optional[str] = None, max_entries: int = QUERY_EMBEDDING_CACHE_SIZE) -> None:
+        self.embeddings = embeddings
+        self.deployment_name = deployment_name or getattr(embeddings, "deployment", None) or getattr(embeddings, "model", "")
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _key(self, text: str) -> tuple:
+        return (self.deployment_name, " ".join(unicodedata.normalize("NFC", text).split()))
+
+    def _get(self, key: tuple) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(vector)
+
+    def _set(self, key: tuple, vector: List[float]) -> None:
+        with self._lock:
+            self._entries[key] = list(vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def embed_query(self, text: str) -> List[float]:
+        """Return the embedding of a query, from the cache if possible."""
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._set(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """Async embed_query."""
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            self._set(key, vector)
+        return vector
+
+    def _split_misses(self, texts: List[str]) -> tuple:
+        keys = [self._key(text) for text in texts]
+        vectors: Dict[tuple, List[float]] = {}
+        misses: Dict[tuple, str] = {}
+        for key, text in zip(keys, texts):
+            if key in vectors or key in misses:
+                continue
+            vector = self._get(key)
+            if vector is None:
+                misses[key] = text
+            else:
+                vectors[key] = vector
+        return keys, vectors, misses
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Return the embeddings of several queries: the distinct misses are embedded in one request."""
+        keys, vectors, misses = self._split_misses(texts)
+        if misses:
+            for key, vector in zip(misses, self.embeddings.embed_documents(list(misses.values()))):
+                self._set(key, vector)
+                vectors[key] = vector
+        return [list(vectors[key]) for key in keys]
+
+    async def aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Async embed_queries."""
+        keys, vectors, misses = self._split_misses(texts)
+        if misses:
+            for key, vector in zip(misses, await self.embeddings.aembed_documents(list(misses.values()))):
+                self._set(key, vector)
+                vectors[key] = vector
+        return [list(vectors[key]) for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents (not cached)."""
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Async embed_documents (not cached)."""
+        return await self.embeddings.aembed_documents(texts)
+
+    def clear(self) -> None:
+        """Remove all the cached embeddings."""
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,240 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: context.py
+# Description: Token-budgeted packing of the retrieved documents into the multimodal prompt context.
+# Version: 2025-02-03
+# Author: Francesco Sodano
+#-----------------------------------------------------------------------------------------------------------
+
+from __future__ import annotations
+import base64
+import io
+import logging
+import math
+from functools import lru_cache
+from typing import List, Optional
+
+import tiktoken
+from PIL import Image
+from langchain.schema import Document
+
+from .image_store import ImageStore, get_default_image_store, is_image_reference
+
+# Default token budget of the context (texts and images, without the system message and the question)
+CONTEXT_TOKEN_BUDGET = 8000
+
+# Tokenizer of the chat model
+TOKEN_ENCODING = "o200k_base"
+
+# Characters per token when the tokenizer is not available
+CHARS_PER_TOKEN = 4
+
+# Chunks truncated to fit the remaining budget are kept only if at least this many tokens fit
+MIN_TRUNCATED_TOKENS = 32
+
+# Base64 characters of a data URL decoded first to read the size of the image (more are decoded if needed)
+IMAGE_HEADER_CHARS = 1024
+
+# Tokens of an image whose size cannot be read, such as a plain URL (high detail 1024x1024)
+DEFAULT_IMAGE_TOKENS = 765
+
+# Tokens of an image in low detail, whatever its size
+LOW_DETAIL_IMAGE_TOKENS = 85
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(encoding_name: str):
+    # tiktoken downloads the encoding on first use, fall back to an estimate when it cannot
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        logger.warning("Tokenizer %s not available (%s), estimating %d characters per token", encoding_name, type(e).__name__, CHARS_PER_TOKEN)
+        return None
+
+
+#########################################################
+# Count the tokens of a text
+# Args:
+#   - text: text to count
+#   - encoding_name: tiktoken encoding of the chat model
+# Returns:
+#   - number of tokens
+#########################################################
+def count_tokens(text: str, encoding_name: str = TOKEN_ENCODING) -> int:
+    encoding = _get_encoding(encoding_name)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+#########################################################
+# Truncate a text to a number of tokens
+# Args:
+#   - text: text to truncate
+#   - max_tokens: maximum number of tokens
+#   - encoding_name: tiktoken encoding of the chat model
+# Returns:
+#   - truncated text
+#########################################################
+def truncate_tokens(text: str, max_tokens: int, encoding_name: str = TOKEN_ENCODING) -> str:
+    encoding = _get_encoding(encoding_name)
+    if encoding is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+#########################################################
+# Estimate the tokens of an image sent to the vision model
+# (high detail: the image is scaled to fit 2048x2048, then its shortest
+# side to 768, and each 512x512 tile costs 170 tokens on top of 85)
+# Args:
+#   - width, height: size of the image in pixels
+#   - detail: "low", "high" or "auto"
+# Returns:
+#   - estimated number of tokens
+#########################################################
+def estimate_image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    if detail == "low":
+        return LOW_DETAIL_IMAGE_TOKENS
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+#########################################################
+# Get the size of the image of a data URL
+# Args:
+#   - data_url: data URL of the image
+# Returns:
+#   - (width, height) tuple, or None if the value is not a base64 data URL
+#     of an image that can be read (plain URL, image store reference, other payload)
+#########################################################
+def data_url_image_size(data_url: str) -> Optional[tuple]:
+    header, _, encoded = data_url.partition(",")
+    if not header.startswith("data:image/") or not header.endswith(";base64") or not encoded:
+        return None
+    # Only the start of the payload is decoded: the size is in the header of the image
+    # (a JPEG can have its size after large metadata, the prefix grows until it is found)
+    length = IMAGE_HEADER_CHARS
+    while length < len(encoded):
+        try:
+            with Image.open(io.BytesIO(base64.b64decode(encoded[:length]))) as image:
+                return image.size
+        except Exception:
+            length *= 8
+    try:
+        with Image.open(io.BytesIO(base64.b64decode(encoded))) as image:
+            return image.size
+    except Exception:
+        return None
+
+
+#########################################################
+# Estimate the tokens of the image of a URL sent to the vision model
+# Args:
+#   - url: URL of the image (data URL or plain URL)
+#   - detail: "low", "high" or "auto"
+# Returns:
+#   - estimated number of tokens (DEFAULT_IMAGE_TOKENS when the size cannot be read)
+#########################################################
+def estimate_image_url_tokens(url: str, detail: str = "auto") -> int:
+    if detail == "low":
+        return LOW_DETAIL_IMAGE_TOKENS
+    size = data_url_image_size(url)
+    if size is None:
+        return DEFAULT_IMAGE_TOKENS
+    return estimate_image_tokens(*size, detail)
+
+
+#########################################################
+# Load the data URL of an image of the index
+# Args:
+#   - image: "image" metadata of a chunk (image store reference, data URL or URL)
+#   - image_store: image store of the referenced images (default: get_default_image_store())
+# Returns:
+#   - URL of the image, or None if the referenced image is missing from the store
+#########################################################
+def load_image(image: str, image_store: Optional[ImageStore] = None) -> Optional[str]:
+    if not is_image_reference(image):
+        return image
+    try:
+        return (image_store or get_default_image_store()).get_data_url(image)
+    except (OSError, ValueError) as e:
+        logger.warning("Image %s not available (%s), left out of the context", image, type(e).__name__)
+        return None
+
+
+#########################################################
+# Convert the output of get_image_description to documents
+# Args:
+#   - context: dictionary containing the images and the texts
+# Returns:
+#   - list of documents (the texts, then the images), as expected by pack_context
+#########################################################
+def context_documents(context: dict) -> List[Document]:
+    docs = [Document(page_content=text, metadata={"image": None}) for text in context["texts"]]
+    docs.extend(Document(page_content="", metadata={"image": image}) for image in context["images"])
+    return docs
+
+
+#########################################################
+# Pack the retrieved documents into the prompt context
+# Drop-in replacement of get_image_description: the texts and images are
+# deduplicated and added in rank order until the token budget is used.
+# Args:
+#   - docs: documents from the retriever, in rank order
+#   - token_budget: maximum number of tokens of the texts and images (None: no budget)
+#   - max_chunk_tokens: optional maximum number of tokens of each text (longer texts are truncated)
+#   - truncate: truncate the text that does not fit in the remaining budget instead of skipping it
+#   - image_detail: detail level of the images ("low", "high" or "auto")
+#   - image_store: image store of the referenced images (default: get_default_image_store())
+#   - encoding_name: tiktoken encoding of the chat model
+# Returns:
+#   - dictionary containing the images (data URLs), the texts and the number of tokens
+#########################################################
+def pack_context(docs: List[Document], token_budget: Optional[int] = CONTEXT_TOKEN_BUDGET, max_chunk_tokens: Optional[int] = None, truncate: bool = True, image_detail: str = "auto", image_store: Optional[ImageStore] = None, encoding_name: str = TOKEN_ENCODING) -> dict:
+    images = []
+    texts = []
+    seen = set()
+    tokens = 0
+    for doc in docs:
+        remaining = token_budget - tokens if token_budget is not None else math.inf
+        if remaining <= 0:
+            break
+        image = doc.metadata.get('image')
+        if image:
+            if image in seen:
+                continue
+            seen.add(image)
+            # Only the images that fit in the budget are loaded from the image store
+            data_url = load_image(image, image_store)
+            if data_url is None:
+                continue
+            image_tokens = estimate_image_url_tokens(data_url, image_detail)
+            if image_tokens <= remaining:
+                images.append(data_url)
+                tokens += image_tokens
+            continue
+        text = doc.page_content
+        key = text.strip()
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        if max_chunk_tokens is not None:
+            text = truncate_tokens(text, max_chunk_tokens, encoding_name)
+        text_tokens = count_tokens(text, encoding_name)
+        if text_tokens > remaining:
+            if not truncate or remaining < MIN_TRUNCATED_TOKENS:
+                continue
+            text = truncate_tokens(text, remaining, encoding_name)
+            text_tokens = count_tokens(text, encoding_name)
+        texts.append(text)
+        tokens += text_tokens
+    return {"images": images, "texts": texts, "tokens": tokens}
@@ -8,24 +8,40 @@
 #-----------------------------------------------------------------------------------------------------------
 
 import logging
-from typing import Any, Iterator, List, Optional
+from typing import Any, Iterator, List, Optional, Tuple
+import bisect
+import contextvars
+import hashlib
+import io
 import os
 import re
+import tempfile
+import threading
+import time
 from langchain_core.documents import Document
 from langchain_community.document_loaders.base import BaseLoader
 from langchain_community.document_loaders.base import BaseBlobParser
-from langchain_community.document_loaders.blob_loaders import Blob
 from azure.ai.documentintelligence import DocumentIntelligenceClient
-from azure.ai.documentintelligence.models import DocumentAnalysisFeature, AnalyzeDocumentRequest
+from azure.ai.documentintelligence.models import DocumentAnalysisFeature, AnalyzeDocumentRequest, AnalyzeResult
 from azure.ai.documentintelligence.models import DocumentContentFormat
 from azure.core.credentials import AzureKeyCredential
 from PIL import Image
 import pymupdf
+import numpy as np
 import mimetypes
 import base64
 from mimetypes import guess_type
+import httpx
 from openai import AzureOpenAI
 from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from dataclasses import dataclass
+from contextlib import nullcontext
+from .ingestion import FIGURE_MARKS_KEY, find_header_boundaries
+from .cache import AnalysisResultCache, FigureIndex, ImageDescriptionCache, PerceptualHashIndex, image_description_key, image_hash, perceptual_hash
+from .rate_limit import BULK, RateLimiter, estimate_chat_tokens
+from .telemetry import count, current_span, span
 
 MAX_TOKENS = 2000
 
@@ -33,6 +49,29 @@ SYSTEM_CONTEXT = "You are a helpful assistant that describe images in in vivid,
 
 IMAGE_STORE_FOLDER = "ingestion/images"
 
+CROP_DPI = 300
+
+# Minimum size of the sections streamed by the parser (in characters)
+SECTION_SIZE = 20000
+
+# Pages after which a streamed section is cut at a page start when no header allows a cut
+SECTION_MAX_PAGES = 10
+
+# Separator of the pages in the Markdown content of the analysis
+PAGE_BREAK = "\n<!-- PageBreak -->\n"
+
+# Number of page ranges of a PDF analyzed at the same time
+SHARD_CONCURRENCY = 4
+
+# Offsets of the analysis results in code points, the indices of the Python strings
+# (whole files and merged page ranges then give the same result, cached under the same key)
+STRING_INDEX_TYPE = "unicodeCodePoint"
+
+# Figures without caption smaller than this (in inches, both sides) or with a lower entropy
+# (in bits, see image_entropy) are decorative (logos, icons, rules, signatures)
+DECORATIVE_MAX_INCHES = 0.75
+DECORATIVE_MAX_ENTROPY = 0.5
+
 logger = logging.getLogger(__name__)
 
 # Function to encode a local image into data URL 
@@ -49,6 +88,65 @@ def local_image_to_data_url(image_path):
     # Construct the data URL
     return f"data:{mime_type};base64,{base64_encoded_data}"
 
+
+####################################################################
+# Class: Encoding of the images sent to the vision model
+# Args:
+#    - format (str): The image format (PNG, JPEG or WEBP).
+#    - quality (int): The quality of the lossy formats (JPEG and WEBP).
+#    - max_size (tuple): Optional maximum (width, height), the aspect ratio is kept.
+####################################################################
+
+@dataclass(frozen=True)
+class ImageEncoding:
+    format: str = "PNG"
+    quality: int = 85
+    max_size: Optional[Tuple[int, int]] = None
+
+    @property
+    def mime_type(self) -> str:
+        return f"image/{self.format.lower()}"
+
+    @property
+    def extension(self) -> str:
+        return ".jpg" if self.format.upper() == "JPEG" else f".{self.format.lower()}"
+
+    def __str__(self) -> str:
+        return f"{self.format.upper()}:{self.quality}:{self.max_size}"
+
+
+DEFAULT_IMAGE_ENCODING = ImageEncoding()
+
+
+###################################################################
+# Encode an image in memory
+# Args:
+#    - image (PIL.Image.Image): The image to encode.
+#    - encoding (ImageEncoding): The format, quality and maximum size of the encoded image.
+# Returns:
+#    - image_bytes (bytes): The encoded image.
+###################################################################
+
+def encode_image(image, encoding=DEFAULT_IMAGE_ENCODING):
+    if encoding.max_size and (image.width > encoding.max_size[0] or image.height > encoding.max_size[1]):
+        image = image.copy()
+        image.thumbnail(encoding.max_size, Image.LANCZOS)
+    image_format = encoding.format.upper()
+    if image_format in ("JPEG", "WEBP") and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    if image_format == "PNG":
+        image.save(buffer, format=image_format)
+    else:
+        image.save(buffer, format=image_format, quality=encoding.quality)
+    return buffer.getvalue()
+
+
+# Function to encode an in-memory image into data URL
+def image_to_data_url(image, encoding=DEFAULT_IMAGE_ENCODING):
+    base64_encoded_data = base64.b64encode(encode_image(image, encoding)).decode('utf-8')
+    return f"data:{encoding.mime_type};base64,{base64_encoded_data}"
+
 ####################################################################
 # Crop an image from a TIFF file
 # Args:
@@ -77,24 +175,37 @@ def crop_image_from_image(image_path, page_number, bounding_box):
 #    - pdf_path (str): Path to the PDF file.
 #    - page_number (int): The page number to crop from (0-indexed).
 #    - bounding_box (tuple): A tuple of (x0, y0, x1, y1) coordinates for the bounding box.
+#    - dpi (int): The resolution used to render the cropped area.
 # Returns:
 #    - cropped_image (PIL.Image.Image): The cropped image.
 ###################################################################
 
-def crop_image_from_pdf_page(pdf_path, page_number, bounding_box):
+def crop_image_from_pdf_page(pdf_path, page_number, bounding_box, dpi=CROP_DPI):
     doc = pymupdf.open(pdf_path)
     page = doc.load_page(page_number)
-    
+    img = crop_image_from_loaded_page(page, bounding_box, dpi)
+    doc.close()
+
+    return img
+
+
+###################################################################
+# Crop an image from an already loaded PDF page
+# Args:
+#    - page (pymupdf.Page): The loaded page.
+#    - bounding_box (tuple): A tuple of (x0, y0, x1, y1) coordinates for the bounding box (in inches).
+#    - dpi (int): The resolution used to render the cropped area.
+# Returns:
+#    - cropped_image (PIL.Image.Image): The cropped image.
+###################################################################
+
+def crop_image_from_loaded_page(page, bounding_box, dpi=CROP_DPI):
     # Cropping the page. The rect requires the coordinates in the format (x0, y0, x1, y1).
     bbx = [x * 72 for x in bounding_box]
     rect = pymupdf.Rect(bbx)
-    pix = page.get_pixmap(matrix=pymupdf.Matrix(300/72, 300/72), clip=rect)
-    
-    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-    
-    doc.close()
+    pix = page.get_pixmap(matrix=pymupdf.Matrix(dpi/72, dpi/72), clip=rect)
 
-    return img
+    return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
 
 
 ###################################################################
@@ -115,49 +226,234 @@ def crop_image_from_file(file_path, page_number, bounding_box):
         return crop_image_from_image(file_path, page_number, bounding_box)
 
 
-###################################################################
-# Generate a description for an image using the GPT-4 family model
+####################################################################
+# Class: Cropping session over a single file
+# Keeps the PDF document (or the image) open for the whole document and
+# an LRU of the last loaded pages, instead of opening the file for every figure.
+# Args:
+#    - file_path (str): The path to the file.
+#    - dpi (int): The resolution used to render the PDF cropped areas.
+#    - max_cached_pages (int): The number of loaded pages kept in memory.
+####################################################################
+
+class FigureCropper:
+    def __init__(self, file_path: str, dpi: int = CROP_DPI, max_cached_pages: int = 4):
+        self.file_path = file_path
+        self.dpi = dpi
+        self.max_cached_pages = max_cached_pages
+        self.is_pdf = mimetypes.guess_type(file_path)[0] == "application/pdf"
+        self._pages = OrderedDict()
+        self._doc = None
+
+    def _open(self):
+        if self._doc is None:
+            self._doc = pymupdf.open(self.file_path) if self.is_pdf else Image.open(self.file_path)
+        return self._doc
+
+    def _get_page(self, page_number: int):
+        if page_number in self._pages:
+            self._pages.move_to_end(page_number)
+            return self._pages[page_number]
+        doc = self._open()
+        if self.is_pdf:
+            page = doc.load_page(page_number)
+        elif doc.format == "TIFF":
+            doc.seek(page_number)
+            page = doc.copy()
+        else:
+            page = doc
+        self._pages[page_number] = page
+        if len(self._pages) > self.max_cached_pages:
+            self._pages.popitem(last=False)
+        return page
+
+    def crop(self, page_number: int, bounding_box) -> Image.Image:
+        """Crop the bounding box (x0, y0, x1, y1) from the page (0-indexed)."""
+        page = self._get_page(page_number)
+        if self.is_pdf:
+            return crop_image_from_loaded_page(page, bounding_box, self.dpi)
+        return page.crop(bounding_box)
+
+    def close(self) -> None:
+        self._pages.clear()
+        if self._doc is not None:
+            self._doc.close()
+            self._doc = None
+
+    def __enter__(self) -> "FigureCropper":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+####################################################################
+# Class: Vision client used to describe the images
+# A long-lived Azure OpenAI client with its own HTTP connection pool,
+# created once per parser or pipeline instead of once per figure.
 # Args:
-#    - api_base (str): The base URL of the API.
 #    - api_key (str): The API key for authentication.
-#    - deployment_name (str): The name of the deployment.
+#    - endpoint (str): The Azure OpenAI endpoint.
 #    - api_version (str): The version of the API.
+#    - deployment_name (str): The name of the deployment.
+#    - pool_size (int): The maximum number of HTTP connections.
+#    - timeout (float): The timeout of a request (in seconds).
+#    - connect_timeout (float): The timeout of the connection (in seconds).
+#    - max_retries (int): The number of retries of the SDK (without rate limiter).
+#    - rate_limiter (RateLimiter): Optional scheduler of the requests of the deployment (it then handles the retries).
+#    - priority (int): Lane of the requests in the rate limiter.
+####################################################################
+
+class VisionClient:
+    def __init__(
+        self,
+        api_key: Optional[str],
+        endpoint: Optional[str],
+        api_version: Optional[str],
+        deployment_name: Optional[str],
+        pool_size: int = 16,
+        timeout: float = 120.0,
+        connect_timeout: float = 10.0,
+        max_retries: int = 2,
+        rate_limiter: Optional[RateLimiter] = None,
+        priority: int = BULK,
+    ):
+        self.deployment_name = deployment_name
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        )
+        self.client = AzureOpenAI(
+            api_key=api_key,
+            api_version=api_version,
+            base_url=f"{endpoint}/openai/deployments/{deployment_name}",
+            http_client=self.http_client,
+            max_retries=0 if rate_limiter is not None else max_retries,
+        )
+
+    @classmethod
+    def from_env(cls, **kwargs: Any) -> "VisionClient":
+        """Create the client from the AZURE_OPENAI_* environment variables."""
+        return cls(
+            api_key=os.getenv('AZURE_OPENAI_API_KEY'),
+            endpoint=os.getenv('AZURE_OPENAI_ENDPOINT'),
+            api_version=os.getenv('AZURE_OPENAI_API_VERSION'),
+            deployment_name=os.getenv('AZURE_OPENAI_DEPLOYMENT_NAME'),
+            **kwargs,
+        )
+
+    def describe(self, data_url: str, caption: str) -> str:
+        """Generate a description for an image encoded as data URL."""
+        messages = [
+            { "role": "system", "content": SYSTEM_CONTEXT },
+            { "role": "user", "content": [  
+                { 
+                    "type": "text", 
+                    "text": f"Describe this image (note: it has image caption: {caption}):" if caption else "Describe this image:"
+                },
+                { 
+                    "type": "image_url",
+                    "image_url": {
+                        "url": data_url
+                    }
+                }
+            ] } 
+        ]
+        create = lambda: self.client.chat.completions.create(model=self.deployment_name, messages=messages, max_tokens=MAX_TOKENS)
+        if self.rate_limiter is None:
+            response = create()
+        else:
+            response = self.rate_limiter.call(
+                create,
+                estimate_chat_tokens(messages, MAX_TOKENS),
+                self.priority,
+                usage=lambda response: response.usage.total_tokens if response.usage else None,
+            )
+        if response.usage is not None:
+            current_span().set(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+            count("vision.prompt_tokens", response.usage.prompt_tokens)
+            count("vision.completion_tokens", response.usage.completion_tokens)
+        return response.choices[0].message.content
+
+    def close(self) -> None:
+        self.http_client.close()
+
+
+####################################################################
+# Class: Local stand-in for the vision client (no network access)
+# Args:
+#    - latency (float): The simulated duration of a request (in seconds).
+#    - deployment_name (str): The deployment name reported to the caches.
+####################################################################
+
+class StubVisionClient:
+    def __init__(self, latency: float = 0.0, deployment_name: str = "stub"):
+        self.latency = latency
+        self.deployment_name = deployment_name
+        self.calls = 0
+
+    def describe(self, data_url: str, caption: str) -> str:
+        """Return a deterministic description of the image."""
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        digest = hashlib.sha256(data_url.encode("utf-8")).hexdigest()[:16]
+        return f"Description of image {digest}" + (f" with caption: {caption}" if caption else "")
+
+    def close(self) -> None:
+        pass
+
+
+_default_vision_client = None
+_default_vision_client_lock = threading.Lock()
+
+
+###################################################################
+# Get the vision client shared by the calls that do not provide one
+# (created on first use from the environment variables)
+###################################################################
+
+def get_default_vision_client():
+    global _default_vision_client
+    with _default_vision_client_lock:
+        if _default_vision_client is None:
+            _default_vision_client = VisionClient.from_env()
+        return _default_vision_client
+
+
+###################################################################
+# Generate a description for an image using the GPT-4 family model
+# Args:
 #    - image_path (str): The path to the image file.
 #    - caption (str): The caption for the image.
+#    - client (VisionClient): Optional vision client (the shared default client otherwise).
 # Returns:
 #    - img_description (str): The generated description for the image.
+#    - data_url (str): The data URL of the image.
 ###################################################################
 
-def understand_image_with_gptv(image_path, caption):
-    client = AzureOpenAI(
-        api_key=os.getenv('AZURE_OPENAI_API_KEY'),  
-        api_version=os.getenv('AZURE_OPENAI_API_VERSION'),
-        base_url=f"{os.getenv('AZURE_OPENAI_ENDPOINT')}/openai/deployments/{os.getenv('AZURE_OPENAI_DEPLOYMENT_NAME')}"
-    )
+def understand_image_with_gptv(image_path, caption, client=None):
     data_url = local_image_to_data_url(image_path)
-    response = client.chat.completions.create(
-                model=os.getenv('AZURE_OPENAI_DEPLOYMENT_NAME'),
-                messages=[
-                    { "role": "system", "content": SYSTEM_CONTEXT },
-                    { "role": "user", "content": [  
-                        { 
-                            "type": "text", 
-                            "text": f"Describe this image (note: it has image caption: {caption}):" if caption else "Describe this image:"
-                        },
-                        { 
-                            "type": "image_url",
-                            "image_url": {
-                                "url": data_url
-                            }
-                        }
-                    ] } 
-                ],
-                max_tokens=MAX_TOKENS
-            )
-    img_description = response.choices[0].message.content
+    img_description = describe_image_data_url(data_url, caption, client)
     return img_description, data_url
 
 
+###################################################################
+# Generate a description for an image already encoded as data URL
+# Args:
+#    - data_url (str): The data URL of the image.
+#    - caption (str): The caption for the image.
+#    - client (VisionClient): Optional vision client (the shared default client otherwise).
+# Returns:
+#    - img_description (str): The generated description for the image.
+###################################################################
+
+def describe_image_data_url(data_url, caption, client=None):
+    return (client or get_default_vision_client()).describe(data_url, caption)
+
+
 ###################################################################
 # Add figure description to the markdown content
 # Args:
@@ -192,93 +488,738 @@ def update_figure_description(md_content, img_description, idx):
 
 
 ###################################################################
-# Include figure description in the Markdown content
+# Find the content of the figure tags of the Markdown content
+# Args:
+#  - md_content (str): The Markdown content.
+#  - figures (list): Optional figures of the document analysis (their spans are used when they match the tags).
+# Returns:
+#  - list of (start, end) offsets of the text between each <figure> and </figure>,
+#    or None if the tags are not well formed.
+###################################################################
+
+def find_figure_tags(md_content, figures=None):
+    start_substring = "<figure>"
+    end_substring = "</figure>"
+    count = md_content.count(start_substring)
+    if count != md_content.count(end_substring):
+        return None
+    # Use the spans Document Intelligence returns when they point at the figure tags
+    if figures and len(figures) == count:
+        positions = []
+        previous_end = 0
+        for figure in figures:
+            if not figure.spans:
+                break
+            offset, length = figure.spans[0].offset, figure.spans[0].length
+            start_index = offset + len(start_substring)
+            end_index = offset + length - len(end_substring)
+            if (offset < previous_end
+                    or not md_content.startswith(start_substring, offset)
+                    or md_content.find(end_substring, start_index) != end_index):
+                break
+            positions.append((start_index, end_index))
+            previous_end = end_index
+        else:
+            return positions
+    # Otherwise scan the tags once
+    positions = []
+    start_index = md_content.find(start_substring)
+    while start_index != -1:
+        start_index += len(start_substring)
+        end_index = md_content.find(end_substring, start_index)
+        if end_index == -1:
+            break
+        next_start = md_content.find(start_substring, start_index)
+        if next_start != -1 and next_start < end_index:
+            return None
+        positions.append((start_index, end_index))
+        start_index = next_start
+    return positions
+
+
+###################################################################
+# Add all the figure descriptions to the markdown content in a single pass
+# (same output as calling update_figure_description for each figure in order)
+# Args:
+#  - md_content (str): The original Markdown content.
+#  - img_descriptions (list): The new descriptions, indexed by figure.
+#  - figures (list): Optional figures of the document analysis.
+# Returns:
+#  - new_md_content (str): The updated Markdown content.
+###################################################################
+
+def rewrite_figures(md_content, img_descriptions, figures=None):
+    positions = None
+    # A description containing figure tags changes which tag the next figures are matched with
+    if not any("<figure>" in d or "</figure>" in d for d in img_descriptions):
+        positions = find_figure_tags(md_content, figures)
+    if positions is None:
+        for idx, img_description in enumerate(img_descriptions):
+            md_content = update_figure_description(md_content, img_description, idx)
+        return md_content
+    replacements = [(start_index, end_index, idx, img_descriptions[idx]) for idx, (start_index, end_index) in enumerate(positions[:len(img_descriptions)])]
+    return splice_figures(md_content, replacements)
+
+
+###################################################################
+# Replace the content of figure tags in a part of the Markdown content
+# Args:
+#  - md_content (str): The Markdown content.
+#  - replacements (list): (start, end, idx, description) tuples sorted by offset (see find_figure_tags).
+#  - start (int): The start offset of the part.
+#  - end (int): The end offset of the part (end of the content if None).
+# Returns:
+#  - new_md_content (str): The updated part of the Markdown content.
+###################################################################
+
+def splice_figures(md_content, replacements, start=0, end=None):
+    parts = []
+    last_index = start
+    for start_index, end_index, idx, img_description in replacements:
+        parts.append(md_content[last_index:start_index])
+        parts.append(f"\n![](figures/{idx})\n{img_description}\n")
+        last_index = end_index
+    parts.append(md_content[last_index:end])
+    return "".join(parts)
+
+
+###################################################################
+# List the regions of a figure that have to be described
+# Args:
+#  - figure (DocumentFigure): The figure returned by the document analysis.
+# Returns:
+#  - list of (region, caption) tuples, in the order they are described (caption is None if the figure has no caption).
+###################################################################
+
+def get_figure_regions(figure):
+    # Note: figure bounding regions currently contain both the bounding region of figure caption and figure body
+    if figure.caption:
+        caption_region = figure.caption.bounding_regions
+        return [(region, figure.caption.content) for region in figure.bounding_regions if region not in caption_region]
+    return [(region, None) for region in figure.bounding_regions]
+
+
+###################################################################
+# Describe a list of images, optionally with several requests in flight
+# Args:
+#  - jobs (list): list of (data_url, caption) tuples.
+#  - max_concurrency (int): The maximum number of requests in flight.
+#  - executor (Executor): Optional executor shared with other documents (max_concurrency is then ignored).
+#  - client (VisionClient): Optional vision client (the shared default client otherwise).
+#  - attributes (list): Optional telemetry attributes of each job (e.g. file and figure).
+# Returns:
+#  - list of descriptions, in the same order as the jobs.
+###################################################################
+
+def describe_images(jobs, max_concurrency=1, executor=None, client=None, attributes=None):
+    client = client or get_default_vision_client()
+    attributes = attributes or [{} for _ in jobs]
+
+    def describe(job, job_attributes):
+        with span("describe", bytes=len(job[0]), **job_attributes):
+            return client.describe(*job)
+
+    def run_all(executor):
+        # Each job runs in a copy of the caller's context, so its span nests under the caller's span
+        futures = [executor.submit(contextvars.copy_context().run, describe, job, job_attributes) for job, job_attributes in zip(jobs, attributes)]
+        try:
+            return [future.result() for future in futures]
+        finally:
+            # The jobs not started yet are dropped when one fails (as with executor.map)
+            for future in futures:
+                future.cancel()
+
+    if executor is not None:
+        return run_all(executor)
+    if max_concurrency <= 1 or len(jobs) <= 1:
+        return [describe(job, job_attributes) for job, job_attributes in zip(jobs, attributes)]
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return run_all(executor)
+
+
+###################################################################
+# Compute the entropy of the gray levels of an image
+# Args:
+#  - image (PIL.Image.Image): The image.
+# Returns:
+#  - entropy (float): The entropy in bits (0 for a plain image, 5 at most).
+###################################################################
+
+def image_entropy(image):
+    pixels = np.asarray(image.convert("L").resize((64, 64), Image.BOX))
+    frequencies = np.bincount(pixels.flatten() // 8, minlength=32) / pixels.size
+    frequencies = frequencies[frequencies > 0]
+    return float(-(frequencies * np.log2(frequencies)).sum())
+
+
+###################################################################
+# Class: Cropped figure region waiting for its description
+###################################################################
+
+@dataclass
+class FigureCrop:
+    idx: int                          # index of the figure in the document analysis
+    caption: Optional[str]            # caption of the figure (None if the figure has no caption)
+    data_url: str                     # data URL of the cropped image
+    image_hash: Optional[str] = None  # hash of the image sent to the model (for the description cache)
+    description: Optional[str] = None
+    source: Optional[str] = None      # name of the document (telemetry)
+    size: Optional[Tuple[float, float]] = None  # (width, height) of the region, in inches for the PDFs
+    text: Optional[str] = None        # text of the figure in the analysis (whitespace-normalized)
+    perceptual_hash: Optional[int] = None
+    entropy: Optional[float] = None   # see image_entropy
+    duplicate_of: Optional[str] = None  # "<source>#<idx>" of the figure whose description is reused
+    decorative: bool = False          # not described (see is_decorative_figure)
+
+
+###################################################################
+# Crop the figures of a document and encode them in memory
 # Args:
 #  - input_file_path (str): The path to the input file.
-#  - result (DocumentAnalysisResult): The result of the document analysis.
+#  - figures (list): The figures of the document analysis.
 #  - output_folder (str): The folder where the cropped images will be saved.
+#  - dpi (int): The resolution used to render the cropped figures.
+#  - with_image_hashes (bool): Compute the hash of each crop (used by the description cache).
+#  - encoding (ImageEncoding): The encoding of the images sent to the vision model.
+#  - save_images (bool): Also save the encoded images in the output folder.
+#  - indices (list): Optional indices of the figures to crop (all the figures otherwise).
+#  - cropper (FigureCropper): Optional cropping session kept open by the caller.
+#  - with_perceptual_hashes (bool): Compute the perceptual hash of each crop (used by describe_figures to find the near-duplicates).
+#  - content (str): Optional content of the document analysis (the text of the figures is part of the near-duplicate key).
+#  - with_entropy (bool): Compute the entropy of each crop (used by is_decorative_figure).
 # Returns:
-#  - md_content (str): The updated Markdown content.
-#  - fig_metadata (dict): The metadata of the figures.
+#  - list of FigureCrop, in figure order.
 ###################################################################
 
-def include_figure_in_md(input_file_path, result, output_folder = IMAGE_STORE_FOLDER):
-    print(f"Processing figures in {input_file_path}...")
-
+def crop_figures(input_file_path, figures, output_folder = IMAGE_STORE_FOLDER, dpi = CROP_DPI, with_image_hashes = False, encoding = DEFAULT_IMAGE_ENCODING, save_images = True, indices = None, cropper = None, with_perceptual_hashes = False, content = None, with_entropy = False):
     base_name = os.path.basename(input_file_path)
     file_name_without_extension = os.path.splitext(base_name)[0]
+    if save_images:
+        os.makedirs(output_folder, exist_ok=True)
 
-    md_content = result.content
+    figures = figures or []
+    positions = find_figure_tags(content, figures) if content is not None and figures else None
+    crops = []
+    with (nullcontext(cropper) if cropper is not None else FigureCropper(input_file_path, dpi=dpi)) as cropper:
+        for idx in (range(len(figures)) if indices is None else indices):
+            for region, caption in get_figure_regions(figures[idx]):
+                boundingbox = (
+                        region.polygon[0],  # x0 (left)
+                        region.polygon[1],  # y0 (top)
+                        region.polygon[4],  # x1 (right)
+                        region.polygon[5]   # y1 (bottom)
+                    )
+                with span("crop", file=base_name, figure=idx, page=region.page_number) as crop_span:
+                    cropped_image = cropper.crop(region.page_number - 1, boundingbox) # page_number is 1-indexed
+                    image_bytes = encode_image(cropped_image, encoding)
+                    if save_images:
+                        output_file = f"{file_name_without_extension}_cropped_image_{idx}{encoding.extension}"
+                        with open(os.path.join(output_folder, output_file), "wb") as f:
+                            f.write(image_bytes)
+                    data_url = f"data:{encoding.mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+                    crop = FigureCrop(idx, caption, data_url, image_hash(cropped_image, str(encoding)) if with_image_hashes else None, source=base_name)
+                    crop.size = (boundingbox[2] - boundingbox[0], boundingbox[3] - boundingbox[1])
+                    if positions is not None and idx < len(positions):
+                        crop.text = " ".join(content[positions[idx][0]:positions[idx][1]].split())
+                    if with_entropy:
+                        crop.entropy = image_entropy(cropped_image)
+                    if with_perceptual_hashes:
+                        crop.perceptual_hash = perceptual_hash(cropped_image)
+                    crops.append(crop)
+                    crop_span.set(bytes=len(image_bytes), width=cropped_image.width, height=cropped_image.height)
+                count("crop.bytes", len(image_bytes), file=base_name)
+    return crops
 
-    # Dumping the initial Markdown we got from Document Intelligence
-    output_file = f"{file_name_without_extension}_init.md"
-    os.makedirs(output_folder, exist_ok=True)
-    with open(os.path.join(output_folder, output_file), "w") as f:
-        f.write(md_content)
 
+###################################################################
+# Check if a figure is decorative (not worth a description)
+# A figure with a caption is never decorative.
+# Args:
+#  - crop (FigureCrop): The cropped figure.
+# Returns:
+#  - True if the figure is smaller than DECORATIVE_MAX_INCHES or has an entropy below DECORATIVE_MAX_ENTROPY.
+###################################################################
+
+def is_decorative_figure(crop):
+    if crop.caption:
+        return False
+    if crop.size is not None and max(crop.size) < DECORATIVE_MAX_INCHES:
+        return True
+    return crop.entropy is not None and crop.entropy < DECORATIVE_MAX_ENTROPY
+
+
+###################################################################
+# Compute the near-duplicate key of a figure
+# Near-duplicate figures must have the same caption and the same text: the
+# same chart or table with other numbers has the same perceptual hash.
+# Args:
+#  - crop (FigureCrop): The cropped figure.
+#  - deployment_name (str): The vision model deployment describing the figures.
+# Returns:
+#  - key (str): The key, or None if the figure has no perceptual hash or no text.
+###################################################################
+
+def figure_duplicate_key(crop, deployment_name):
+    if crop.perceptual_hash is None or crop.text is None or not crop.size or not all(crop.size):
+        return None
+    return image_description_key(crop.text, crop.caption, SYSTEM_CONTEXT, deployment_name)
+
+
+###################################################################
+# Describe the cropped figures (checking the description cache first)
+# The crops with a perceptual hash (see crop_figures) reuse the description
+# and the image of a near-duplicate figure of the document, or of the
+# figure index, and are marked with duplicate_of.
+# Args:
+#  - crops (list): list of FigureCrop, their description is filled in place.
+#  - max_concurrency (int): The maximum number of image descriptions requested in parallel.
+#  - description_cache (ImageDescriptionCache): Optional cache checked before calling the model.
+#  - executor (Executor): Optional executor shared with other documents.
+#  - client (VisionClient): Optional vision client (the shared default client otherwise).
+#  - figure_index (FigureIndex): Optional corpus-level index of the described figures.
+#  - skip_decorative (bool): Do not describe the decorative figures (see is_decorative_figure), nor keep their image.
+#  - document_index (PerceptualHashIndex): Optional index of the figures of the document already seen
+#    (kept by the caller across the sections of a document).
+# Returns:
+#  - crops (list): The described crops.
+###################################################################
+
+def describe_figures(crops, max_concurrency = 1, description_cache = None, executor = None, client = None, figure_index = None, skip_decorative = False, document_index = None):
+    client = client or get_default_vision_client()
+    document_index = document_index if document_index is not None else PerceptualHashIndex()
+    pending = []
+    duplicates = []
+    new_figures = []
+    for crop in crops:
+        if skip_decorative and is_decorative_figure(crop):
+            crop.decorative, crop.description, crop.data_url = True, "", None
+            continue
+        key = figure_duplicate_key(crop, client.deployment_name)
+        if key is not None:
+            aspect = crop.size[0] / crop.size[1]
+            original = document_index.find(key, crop.perceptual_hash, aspect)
+            if original is not None:
+                crop.duplicate_of = f"{original.source}#{original.idx}"
+                duplicates.append((crop, original))
+                continue
+            document_index.add(key, crop.perceptual_hash, aspect, crop)
+            match = figure_index.find(key, crop.perceptual_hash, aspect) if figure_index is not None else None
+            if match is not None:
+                crop.description, crop.data_url, crop.duplicate_of = match
+                continue
+            new_figures.append((crop, key, aspect))
+        pending.append(crop)
+    decorative = sum(crop.decorative for crop in crops)
+    if decorative:
+        count("describe.decorative", decorative)
+    reused = len(crops) - decorative - len(pending)
+    if reused:
+        count("describe.duplicates", reused)
+
+    cache_keys = {}
+    if description_cache is not None:
+        for crop in pending:
+            if crop.image_hash:
+                cache_keys[id(crop)] = image_description_key(crop.image_hash, crop.caption, SYSTEM_CONTEXT, client.deployment_name)
+                crop.description = description_cache.get(cache_keys[id(crop)])
+    misses = [crop for crop in pending if crop.description is None]
+    if len(misses) < len(pending):
+        count("describe.cache_hits", len(pending) - len(misses))
+    attributes = [{"file": crop.source, "figure": crop.idx} for crop in misses]
+    descriptions = describe_images([(crop.data_url, crop.caption or "") for crop in misses], max_concurrency, executor, client, attributes)
+    for crop, description in zip(misses, descriptions):
+        crop.description = description
+        if id(crop) in cache_keys:
+            description_cache.set(cache_keys[id(crop)], description)
+    for crop, original in duplicates:
+        crop.description, crop.data_url = original.description, original.data_url
+    if figure_index is not None:
+        for crop, key, aspect in new_figures:
+            figure_index.add(key, crop.perceptual_hash, aspect, crop.description, crop.data_url, f"{crop.source}#{crop.idx}")
+    return crops
+
+
+###################################################################
+# Join the descriptions of the regions of a figure
+# Args:
+#  - crops (list): The described crops of the figure.
+#  - image_url (str): The image URL of the previous figure (kept if the figure has no crop).
+# Returns:
+#  - img_description (str): The description of the figure.
+#  - image_url (str): The image URL of the figure.
+###################################################################
+
+def join_figure_description(crops, image_url = None):
+    img_description = ""
+    for crop in crops:
+        image_url = crop.data_url
+        if crop.caption is not None:
+            img_description += f"<figcaption>{crop.caption}</figcaption>\n{crop.description}"
+        else:
+            img_description += crop.description
+    return img_description, image_url
+
+
+###################################################################
+# Collect the marks of the deduplicated and decorative figures
+# Args:
+#  - crops (list): The described crops.
+# Returns:
+#  - marks (dict): {figure index: {"duplicate_of": "<source>#<idx>"} or {"decorative": True}}
+###################################################################
+
+def figure_marks(crops):
+    marks = {}
+    for crop in crops:
+        if crop.decorative:
+            marks[crop.idx] = {"decorative": True}
+        elif crop.duplicate_of is not None:
+            marks[crop.idx] = {"duplicate_of": crop.duplicate_of}
+    return marks
+
+
+###################################################################
+# Put the figure descriptions in the Markdown content
+# Args:
+#  - input_file_path (str): The path to the input file.
+#  - result (DocumentAnalysisResult): The result of the document analysis.
+#  - crops (list): The described crops, in figure order.
+#  - output_folder (str): The folder where the descriptions will be saved.
+#  - save_files (bool): Save the descriptions and the updated Markdown in the output folder.
+# Returns:
+#  - md_content (str): The updated Markdown content.
+#  - fig_metadata (dict): The image URL of each figure, and the marks of the deduplicated
+#    and decorative figures under FIGURE_MARKS_KEY (see figure_marks).
+###################################################################
+
+def assemble_figures(input_file_path, result, crops, output_folder = IMAGE_STORE_FOLDER, save_files = True):
+    base_name = os.path.basename(input_file_path)
+    file_name_without_extension = os.path.splitext(base_name)[0]
+
+    md_content = result.content
     fig_metadata = {}
-    # if output folder does not exist, create it
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
     if result.figures:
-        for idx, figure in enumerate(result.figures):
-            figure_content = ""
-            img_description = ""
-            for i, span in enumerate(figure.spans):
-                figure_content += md_content[span.offset:span.offset + span.length]
-            # Note: figure bounding regions currently contain both the bounding region of figure caption and figure body
-            if figure.caption:
-                caption_region = figure.caption.bounding_regions
-                for region in figure.bounding_regions:
-                    if region not in caption_region:
-                        boundingbox = (
-                                region.polygon[0],  # x0 (left)
-                                region.polygon[1],  # y0 (top)
-                                region.polygon[4],  # x1 (right)
-                                region.polygon[5]   # y1 (bottom)
-                            )
-                        cropped_image = crop_image_from_file(input_file_path, region.page_number - 1, boundingbox) # page_number is 1-indexed
-                        # Get the base name of the file
-                        base_name = os.path.basename(input_file_path)
-                        # Remove the file extension
-                        file_name_without_extension = os.path.splitext(base_name)[0]
-                        output_file = f"{file_name_without_extension}_cropped_image_{idx}.png"
-                        cropped_image_filename = os.path.join(output_folder, output_file)
-                        cropped_image.save(cropped_image_filename)
-                        img_desc, image_url = understand_image_with_gptv(cropped_image_filename, figure.caption.content)
-                        img_description += f"<figcaption>{figure.caption.content}</figcaption>\n{img_desc}"
-            else:
-                for region in figure.bounding_regions:
-                    boundingbox = (
-                            region.polygon[0],  # x0 (left)
-                            region.polygon[1],  # y0 (top
-                            region.polygon[4],  # x1 (right)
-                            region.polygon[5]   # y1 (bottom)
-                        )
-                    cropped_image = crop_image_from_file(input_file_path, region.page_number - 1, boundingbox) # page_number is 1-indexed
-                    
-                    output_file = f"{file_name_without_extension}_cropped_image_{idx}.png"
-                    cropped_image_filename = os.path.join(output_folder, output_file)
-                    cropped_image.save(cropped_image_filename)
-
-                    img_desc, image_url = understand_image_with_gptv(cropped_image_filename, "")
-                    img_description += img_desc
+        described = {}
+        for crop in crops:
+            described.setdefault(crop.idx, []).append(crop)
+
+        # Put the descriptions back in figure order
+        image_url = None
+        img_descriptions = []
+        for idx in range(len(result.figures)):
+            img_description, image_url = join_figure_description(described.get(idx, []), image_url)
             fig_metadata[idx] = image_url
-            md_content = update_figure_description(md_content, img_description, idx)
-            output_file = f"{file_name_without_extension}_cropped_image_{idx}.txt"
-            with open(os.path.join(output_folder, output_file), "w") as f:
-                f.write(img_description)
+            img_descriptions.append(img_description)
+            if save_files:
+                save_figure_description(input_file_path, idx, img_description, output_folder)
+        md_content = rewrite_figures(md_content, img_descriptions, result.figures)
+        marks = figure_marks(crops)
+        if marks:
+            fig_metadata[FIGURE_MARKS_KEY] = marks
 
     # Dumping the updated Markdown after inserting LLM computed image descriptions
-    output_file = f"{file_name_without_extension}.md"
-    with open(os.path.join(output_folder, output_file), "w") as f:
-        f.write(md_content)
+    if save_files:
+        output_file = f"{file_name_without_extension}.md"
+        os.makedirs(output_folder, exist_ok=True)
+        with open(os.path.join(output_folder, output_file), "w") as f:
+            f.write(md_content)
 
     return md_content, fig_metadata
 
 
+###################################################################
+# Save the description of a figure
+# Args:
+#  - input_file_path (str): The path to the input file.
+#  - idx (int): The index of the figure.
+#  - img_description (str): The description of the figure.
+#  - output_folder (str): The folder where the description will be saved.
+###################################################################
+
+def save_figure_description(input_file_path, idx, img_description, output_folder = IMAGE_STORE_FOLDER):
+    file_name_without_extension = os.path.splitext(os.path.basename(input_file_path))[0]
+    output_file = f"{file_name_without_extension}_cropped_image_{idx}.txt"
+    os.makedirs(output_folder, exist_ok=True)
+    with open(os.path.join(output_folder, output_file), "w") as f:
+        f.write(img_description)
+
+
+###################################################################
+# Dump the initial Markdown we got from Document Intelligence
+# Args:
+#  - input_file_path (str): The path to the input file.
+#  - result (DocumentAnalysisResult): The result of the document analysis.
+#  - output_folder (str): The folder where the Markdown will be saved.
+###################################################################
+
+def save_initial_markdown(input_file_path, result, output_folder = IMAGE_STORE_FOLDER):
+    base_name = os.path.basename(input_file_path)
+    file_name_without_extension = os.path.splitext(base_name)[0]
+    output_file = f"{file_name_without_extension}_init.md"
+    os.makedirs(output_folder, exist_ok=True)
+    with open(os.path.join(output_folder, output_file), "w") as f:
+        f.write(result.content)
+
+
+###################################################################
+# Include figure description in the Markdown content
+# Args:
+#  - input_file_path (str): The path to the input file.
+#  - result (DocumentAnalysisResult): The result of the document analysis.
+#  - output_folder (str): The folder where the cropped images will be saved.
+#  - max_concurrency (int): The maximum number of image descriptions requested in parallel.
+#  - dpi (int): The resolution used to render the cropped figures.
+#  - description_cache (ImageDescriptionCache): Optional cache checked before calling the model.
+#  - encoding (ImageEncoding): The encoding of the images sent to the vision model.
+#  - save_images (bool): Save the cropped images, the figure descriptions and the Markdown in the output folder
+#    (nothing is written to the output folder otherwise).
+#  - vision_client (VisionClient): Optional vision client (the shared default client otherwise).
+#  - deduplicate (bool): Reuse the description of the near-duplicate figures of the document (see describe_figures).
+#  - figure_index (FigureIndex): Optional corpus-level index of the described figures (implies deduplicate).
+#  - skip_decorative (bool): Do not describe the decorative figures (see is_decorative_figure).
+# Returns:
+#  - md_content (str): The updated Markdown content.
+#  - fig_metadata (dict): The metadata of the figures (see assemble_figures).
+###################################################################
+
+def include_figure_in_md(input_file_path, result, output_folder = IMAGE_STORE_FOLDER, max_concurrency = 1, dpi = CROP_DPI, description_cache = None, encoding = DEFAULT_IMAGE_ENCODING, save_images = True, vision_client = None, deduplicate = False, figure_index = None, skip_decorative = False):
+    print(f"Processing figures in {input_file_path}...")
+    with span("include_figures", file=os.path.basename(input_file_path), figures=len(result.figures or [])):
+        if save_images:
+            save_initial_markdown(input_file_path, result, output_folder)
+        with_perceptual_hashes = deduplicate or figure_index is not None
+        crops = crop_figures(input_file_path, result.figures, output_folder, dpi, description_cache is not None, encoding, save_images, with_perceptual_hashes=with_perceptual_hashes, content=result.content, with_entropy=skip_decorative)
+        describe_figures(crops, max_concurrency, description_cache, client=vision_client, figure_index=figure_index, skip_decorative=skip_decorative)
+        return assemble_figures(input_file_path, result, crops, output_folder, save_images)
+
+
+###################################################################
+# Find where the Markdown content is cut in streamed sections
+# Args:
+#  - md_content (str): The Markdown content.
+#  - result (DocumentAnalysisResult): The result of the document analysis.
+#  - mode (str): "section" cuts before headers (same chunks as the whole document),
+#                "page" cuts at every page start.
+#  - section_size (int): The minimum size of a section in "section" mode (in characters).
+#  - figure_ranges (list): The (start, end) offsets of the figure tags (cuts never fall inside).
+#  - max_pages (int): In "section" mode, a section spanning this many pages without a header
+#                     allowing a cut is cut at the next page start instead, which bounds the size
+#                     of the sections (the chunks around that cut may differ from the whole document).
+# Returns:
+#  - list of (start, end, headers) tuples, headers being the headers active at the start.
+###################################################################
+
+def find_stream_sections(md_content, result, mode = "section", section_size = SECTION_SIZE, figure_ranges = (), max_pages = SECTION_MAX_PAGES):
+    headers = find_header_boundaries(md_content)
+    header_offsets = [offset for offset, _, _, _ in headers]
+    page_starts = []
+    for page in (result.pages or [])[1:]:
+        if not page.spans:
+            continue
+        offset = page.spans[0].offset
+        # Headers active at the page start: the headers after the last header line before it
+        i = bisect.bisect_left(header_offsets, offset)
+        page_starts.append((offset, headers[i - 1][2] if i else {}))
+    if mode == "page":
+        candidates = [(offset, active_headers, True) for offset, active_headers in page_starts]
+    else:
+        candidates = [(offset, before, False) for offset, before, _, safe in headers if safe]
+        if max_pages:
+            # Page starts are the fallback cuts of the sections without header cut
+            candidates = sorted(candidates + [(offset, active_headers, True) for offset, active_headers in page_starts], key=lambda candidate: (candidate[0], candidate[2]))
+    page_offsets = [offset for offset, _ in page_starts]
+
+    sections = []
+    start, start_headers = 0, {}
+    figure_starts = [figure_start for figure_start, _ in figure_ranges]
+    for offset, active_headers, page_start in candidates:
+        if offset <= start or (mode == "section" and offset - start < section_size):
+            continue
+        if mode == "section" and page_start and bisect.bisect_right(page_offsets, offset) - bisect.bisect_right(page_offsets, start) < max_pages:
+            continue
+        i = bisect.bisect_right(figure_starts, offset) - 1
+        if i >= 0 and figure_ranges[i][0] < offset < figure_ranges[i][1]:
+            continue
+        sections.append((start, offset, start_headers))
+        start, start_headers = offset, active_headers
+    sections.append((start, len(md_content), start_headers))
+    return sections
+
+
+###################################################################
+# Include figure description in the Markdown content, section by section
+# Each section is yielded as soon as its figures are described, with the
+# headers active where it starts in metadata["headers"] and its figures in
+# metadata["images"] (see ingestion.advanced_text_splitter).
+# Args: same as include_figure_in_md, plus
+#  - mode (str): "section" or "page" (see find_stream_sections).
+#  - section_size (int): The minimum size of a section in "section" mode (in characters).
+#  - max_section_pages (int): The pages after which a section without header cut is cut at a page start (see find_stream_sections).
+#  - deduplicate, figure_index, skip_decorative: see include_figure_in_md (the near-duplicates are found across the sections).
+# Yields:
+#  - Document of each section.
+###################################################################
+
+def iter_sections_with_figures(input_file_path, result, output_folder = IMAGE_STORE_FOLDER, max_concurrency = 1, dpi = CROP_DPI, description_cache = None, encoding = DEFAULT_IMAGE_ENCODING, save_images = True, vision_client = None, mode = "section", section_size = SECTION_SIZE, deduplicate = False, figure_index = None, skip_decorative = False, max_section_pages = SECTION_MAX_PAGES):
+    print(f"Processing figures in {input_file_path}...")
+    if save_images:
+        save_initial_markdown(input_file_path, result, output_folder)
+    md_content = result.content
+    figures = result.figures or []
+    positions = find_figure_tags(md_content, figures) if figures else []
+    if positions is None:
+        # Figure tags not well formed: no streaming
+        md_content, fig_metadata = include_figure_in_md(input_file_path, result, output_folder, max_concurrency, dpi, description_cache, encoding, save_images, vision_client, deduplicate, figure_index, skip_decorative)
+        yield Document(page_content=md_content, metadata={"images": fig_metadata, "headers": {}})
+        return
+
+    base_name = os.path.basename(input_file_path)
+    file_name_without_extension = os.path.splitext(base_name)[0]
+    # Figures without a tag are processed with the last section
+    figure_offsets = [positions[idx][0] if idx < len(positions) else len(md_content) for idx in range(len(figures))]
+    figure_ranges = [(start_index - len("<figure>"), end_index + len("</figure>")) for start_index, end_index in positions]
+    sections = find_stream_sections(md_content, result, mode, section_size, figure_ranges, max_section_pages)
+
+    image_url = None
+    document_index = PerceptualHashIndex()
+    with FigureCropper(input_file_path, dpi=dpi) as cropper, \
+            (open(os.path.join(output_folder, f"{file_name_without_extension}.md"), "w") if save_images else nullcontext()) as md_file:
+        for n, (start, end, headers) in enumerate(sections):
+            last = n == len(sections) - 1
+            indices = [idx for idx, offset in enumerate(figure_offsets) if start <= offset < end or (last and offset == end)]
+            crops = crop_figures(input_file_path, figures, output_folder, dpi, description_cache is not None, encoding, save_images, indices, cropper, deduplicate or figure_index is not None, md_content, skip_decorative)
+            describe_figures(crops, max_concurrency, description_cache, client=vision_client, figure_index=figure_index, skip_decorative=skip_decorative, document_index=document_index)
+            described = {}
+            for crop in crops:
+                described.setdefault(crop.idx, []).append(crop)
+            fig_metadata = {}
+            replacements = []
+            for idx in indices:
+                img_description, image_url = join_figure_description(described.get(idx, []), image_url)
+                fig_metadata[idx] = image_url
+                if save_images:
+                    save_figure_description(input_file_path, idx, img_description, output_folder)
+                if idx < len(positions):
+                    replacements.append(positions[idx] + (idx, img_description))
+            marks = figure_marks(crops)
+            if marks:
+                fig_metadata[FIGURE_MARKS_KEY] = marks
+            section_content = splice_figures(md_content, replacements, start, end)
+            if md_file is not None:
+                md_file.write(section_content)
+            yield Document(page_content=section_content, metadata={"images": fig_metadata, "headers": headers})
+
+
+# PyMuPDF is not thread-safe: the PDFs are split by one thread at a time
+_PYMUPDF_LOCK = threading.Lock()
+
+
+###################################################################
+# Split a PDF into page ranges saved as files
+# The pages are counted and all the ranges written in a single pass, by one
+# thread at a time: only the range being written is in memory.
+# Args:
+#  - file_path (str): The path to the PDF file.
+#  - shard_pages (int): The number of pages of each range.
+#  - folder (str): The folder where the ranges are written.
+# Returns:
+#  - list of (first page index, path of the range) tuples, in page order
+#    (empty if the file is not a PDF longer than shard_pages).
+###################################################################
+
+def split_pdf_pages(file_path, shard_pages, folder):
+    shards = []
+    with _PYMUPDF_LOCK:
+        try:
+            doc = pymupdf.open(file_path)
+        except Exception:
+            return shards
+        with doc:
+            if not doc.is_pdf or doc.page_count <= shard_pages:
+                return shards
+            for first in range(0, doc.page_count, shard_pages):
+                shard_path = os.path.join(folder, f"{first + 1}.pdf")
+                with pymupdf.open() as shard:
+                    shard.insert_pdf(doc, from_page=first, to_page=min(first + shard_pages, doc.page_count) - 1)
+                    shard.save(shard_path, garbage=1, no_new_id=True)
+                shards.append((first, shard_path))
+    return shards
+
+
+_ELEMENT_REFERENCE = re.compile(r"^/(\w+)/(\d+)$")
+_FIGURE_ID = re.compile(r"^(\d+)\.(\d+)$")
+
+
+def _remap_analysis(value, content_offset, page_offset, element_offsets):
+    if isinstance(value, list):
+        return [_remap_analysis(item, content_offset, page_offset, element_offsets) for item in value]
+    if isinstance(value, str):
+        # References to the elements of the result (e.g. "/figures/3" in the sections)
+        match = _ELEMENT_REFERENCE.match(value)
+        if match and match.group(1) in element_offsets:
+            return f"/{match.group(1)}/{int(match.group(2)) + element_offsets[match.group(1)]}"
+        return value
+    if not isinstance(value, dict):
+        return value
+    remapped = {key: _remap_analysis(item, content_offset, page_offset, element_offsets) for key, item in value.items()}
+    if isinstance(remapped.get("offset"), int) and isinstance(remapped.get("length"), int):
+        remapped["offset"] += content_offset
+    if isinstance(remapped.get("pageNumber"), int):
+        remapped["pageNumber"] += page_offset
+    return remapped
+
+
+###################################################################
+# Merge the analysis results of consecutive page ranges of a document
+# The contents are joined with a page break, and the spans, page numbers,
+# figure ids and element references are remapped to the merged content, so
+# the result can be used as the analysis of the whole document. The offsets
+# are shifted in characters: the ranges must be analyzed with the
+# "unicodeCodePoint" string index type (STRING_INDEX_TYPE).
+# Args:
+#  - results (list): The AnalyzeResult of each range, in page order.
+#  - page_offsets (list): The index of the first page of each range.
+#  - separator (str): The separator of the contents (a newline for the text format).
+# Returns:
+#  - AnalyzeResult of the whole document.
+###################################################################
+
+def merge_analyze_results(results, page_offsets, separator=PAGE_BREAK):
+    merged = {}
+    content = []
+    length = 0
+    element_offsets = {}
+    for result, page_offset in zip(results, page_offsets):
+        shard = result.as_dict()
+        if content:
+            content.append(separator)
+            length += len(separator)
+        remapped = _remap_analysis(shard, length, page_offset, element_offsets)
+        for figure in remapped.get("figures", []):
+            match = _FIGURE_ID.match(figure.get("id", ""))
+            if match:
+                figure["id"] = f"{int(match.group(1)) + page_offset}.{match.group(2)}"
+        for key, value in remapped.items():
+            if key == "content":
+                continue
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+                element_offsets[key] = element_offsets.get(key, 0) + len(value)
+            else:
+                merged.setdefault(key, value)
+        content.append(shard.get("content") or "")
+        length += len(content[-1])
+    merged["content"] = "".join(content)
+    return AnalyzeResult(merged)
+
+
 ####################################################################
 # Class: Customized Azure AI Document Intelligence Parser
+# Args (besides the Azure AI Document Intelligence options):
+#    - shard_pages (int): Optional number of pages of the ranges of the PDFs
+#      analyzed concurrently (see analyze), the larger PDFs are analyzed whole otherwise.
+#    - shard_concurrency (int): The number of ranges of a PDF analyzed at the same time.
+#    - deduplicate_figures, figure_index, skip_decorative: see include_figure_in_md.
 ####################################################################
 
 class AzureAIDocumentIntelligenceParser(BaseBlobParser):
@@ -290,6 +1231,19 @@ class AzureAIDocumentIntelligenceParser(BaseBlobParser):
         api_model: str = "prebuilt-layout",
         mode: str = "markdown",
         analysis_features: Optional[List[str]] = None,
+        max_concurrency: int = 1,
+        description_cache: Optional[ImageDescriptionCache] = None,
+        analysis_cache: Optional[AnalysisResultCache] = None,
+        image_encoding: ImageEncoding = DEFAULT_IMAGE_ENCODING,
+        save_images: bool = True,
+        vision_client: Optional[VisionClient] = None,
+        section_size: int = SECTION_SIZE,
+        max_section_pages: int = SECTION_MAX_PAGES,
+        shard_pages: Optional[int] = None,
+        shard_concurrency: int = SHARD_CONCURRENCY,
+        deduplicate_figures: bool = False,
+        figure_index: Optional[FigureIndex] = None,
+        skip_decorative: bool = False,
     ):
         kwargs = {}
         if api_version is not None:
@@ -321,29 +1275,137 @@ class AzureAIDocumentIntelligenceParser(BaseBlobParser):
             **kwargs,
         )
         self.api_model = api_model
+        self.analysis_features = analysis_features
+        self.analysis_cache = analysis_cache
         self.mode = mode
-        assert self.mode in ["single", "markdown"]
+        # "section" and "page" stream the document in several Documents (see iter_sections_with_figures)
+        assert self.mode in ["single", "markdown", "section", "page"]
+        self.max_concurrency = max_concurrency
+        self.description_cache = description_cache
+        self.image_encoding = image_encoding
+        self.save_images = save_images
+        self.vision_client = vision_client
+        self.section_size = section_size
+        self.max_section_pages = max_section_pages
+        self.shard_pages = shard_pages
+        self.shard_concurrency = shard_concurrency
+        self.deduplicate_figures = deduplicate_figures
+        self.figure_index = figure_index
+        self.skip_decorative = skip_decorative
 
     def _generate_docs_single(self, file_path: str, result: Any) -> Iterator[Document]:
-        md_content, fig_metadata = include_figure_in_md(file_path, result)
+        md_content, fig_metadata = include_figure_in_md(
+            file_path,
+            result,
+            max_concurrency=self.max_concurrency,
+            description_cache=self.description_cache,
+            encoding=self.image_encoding,
+            save_images=self.save_images,
+            vision_client=self.vision_client,
+            deduplicate=self.deduplicate_figures,
+            figure_index=self.figure_index,
+            skip_decorative=self.skip_decorative,
+        )
         yield Document(page_content=md_content, metadata={"images": fig_metadata})
 
+    def _generate_docs_sections(self, file_path: str, result: Any) -> Iterator[Document]:
+        yield from iter_sections_with_figures(
+            file_path,
+            result,
+            max_concurrency=self.max_concurrency,
+            description_cache=self.description_cache,
+            encoding=self.image_encoding,
+            save_images=self.save_images,
+            vision_client=self.vision_client,
+            mode=self.mode,
+            section_size=self.section_size,
+            max_section_pages=self.max_section_pages,
+            deduplicate=self.deduplicate_figures,
+            figure_index=self.figure_index,
+            skip_decorative=self.skip_decorative,
+        )
+
+    def analyze(self, file_path: str) -> AnalyzeResult:
+        """Analyze the file, reusing the cached result when the file and the options did not change.
+        The PDFs longer than shard_pages are analyzed by page ranges, the merged result is cached like a whole one."""
+        output_format = "text" if self.mode == "single" else DocumentContentFormat.MARKDOWN
+        file_name = os.path.basename(file_path)
+        with span("analyze", file=file_name, bytes=os.path.getsize(file_path)) as analyze_span:
+            cache_key = None
+            if self.analysis_cache is not None:
+                cache_key = self.analysis_cache.key(file_path, self.api_model, output_format, self.analysis_features, STRING_INDEX_TYPE)
+                result = self.analysis_cache.get(cache_key)
+                if result is not None:
+                    analyze_span.set(cached=True)
+                    return result
+
+            result = self._analyze_sharded(file_path, output_format) if self.shard_pages else None
+            if result is None:
+                # The request body is streamed from the file (no copy of the document in memory)
+                with open(file_path, "rb") as file_obj:
+                    poller = self.client.begin_analyze_document(
+                        self.api_model,
+                        file_obj,
+                        content_type="application/octet-stream",
+                        output_content_format=output_format,
+                        string_index_type=STRING_INDEX_TYPE,
+                    )
+                    result = poller.result()
+            analyze_span.set(cached=False, pages=len(result.pages or []), figures=len(result.figures or []), characters=len(result.content or ""))
+            count("analyze.bytes", os.path.getsize(file_path), file=file_name)
+            count("analyze.pages", len(result.pages or []), file=file_name)
+
+            if cache_key is not None:
+                self.analysis_cache.set(cache_key, result)
+            return result
+
+    def _analyze_sharded(self, file_path: str, output_format: str) -> Optional[AnalyzeResult]:
+        """Analyze the page ranges of a PDF concurrently and merge their results (see merge_analyze_results),
+        or return None if the file is not a PDF longer than shard_pages. The ranges are written to temporary
+        files (see split_pdf_pages) before they are submitted, and their request bodies are streamed from the files."""
+        file_name = os.path.basename(file_path)
+
+        def analyze_shard(first, shard_path):
+            with span("analyze.shard", file=file_name, first_page=first + 1, bytes=os.path.getsize(shard_path)) as shard_span:
+                with open(shard_path, "rb") as file_obj:
+                    poller = self.client.begin_analyze_document(
+                        self.api_model,
+                        file_obj,
+                        content_type="application/octet-stream",
+                        output_content_format=output_format,
+                        string_index_type=STRING_INDEX_TYPE,
+                    )
+                result = poller.result()
+                shard_span.set(pages=len(result.pages or []))
+                return result
+
+        with tempfile.TemporaryDirectory(prefix="shards_") as folder:
+            shards = split_pdf_pages(file_path, self.shard_pages, folder)
+            if not shards:
+                return None
+            current_span().set(shards=len(shards))
+            with ThreadPoolExecutor(max_workers=self.shard_concurrency) as executor:
+                # Each task runs in a copy of the context, so the shard spans are nested in the analyze span
+                futures = [executor.submit(contextvars.copy_context().run, analyze_shard, first, shard_path) for first, shard_path in shards]
+                try:
+                    results = [future.result() for future in futures]
+                finally:
+                    # The ranges not submitted yet are dropped as soon as one failed
+                    for future in futures:
+                        future.cancel()
+        page_offsets = [first for first, _ in shards]
+        return merge_analyze_results(results, page_offsets, PAGE_BREAK if output_format == DocumentContentFormat.MARKDOWN else "\n")
+
     def lazy_parse(self, file_path: str) -> Iterator[Document]:
         """Lazily parse the blob."""
-        blob = Blob.from_path(file_path)
-        with blob.as_bytes_io() as file_obj:
-            poller = self.client.begin_analyze_document(
-                self.api_model,
-                file_obj,
-                content_type="application/octet-stream",
-                output_content_format=DocumentContentFormat.MARKDOWN if self.mode == "markdown" else "text",
-            )
-            result = poller.result()
+        result = self.analyze(file_path)
 
-            if self.mode in ["single", "markdown"]:
-                yield from self._generate_docs_single(file_path, result)
-            else:
-                raise ValueError(f"Invalid mode: {self.mode}")
+        if self.mode in ["single", "markdown"]:
+            yield from self._generate_docs_single(file_path, result)
+        elif self.mode in ["section", "page"]:
+            yield from self._generate_docs_sections(file_path, result)
+        else:
+            raise ValueError(f"Invalid mode: {self.mode}")
 
 
 ####################################################################
@@ -360,6 +1422,20 @@ class AzureAIDocumentIntelligenceLoader(BaseLoader):
         api_model: str = "prebuilt-layout",
         *,
         analysis_features: Optional[List[str]] = None,
+        max_concurrency: int = 1,
+        description_cache: Optional[ImageDescriptionCache] = None,
+        analysis_cache: Optional[AnalysisResultCache] = None,
+        image_encoding: ImageEncoding = DEFAULT_IMAGE_ENCODING,
+        save_images: bool = True,
+        vision_client: Optional[VisionClient] = None,
+        mode: str = "markdown",
+        section_size: int = SECTION_SIZE,
+        max_section_pages: int = SECTION_MAX_PAGES,
+        shard_pages: Optional[int] = None,
+        shard_concurrency: int = SHARD_CONCURRENCY,
+        deduplicate_figures: bool = False,
+        figure_index: Optional[FigureIndex] = None,
+        skip_decorative: bool = False,
     ) -> None:
         assert (
             file_path is not None
@@ -371,8 +1447,21 @@ class AzureAIDocumentIntelligenceLoader(BaseLoader):
             api_key=api_key,
             api_version=api_version,
             api_model=api_model,
-            mode="markdown",
+            mode=mode,
             analysis_features=analysis_features,
+            max_concurrency=max_concurrency,
+            description_cache=description_cache,
+            analysis_cache=analysis_cache,
+            image_encoding=image_encoding,
+            save_images=save_images,
+            vision_client=vision_client,
+            section_size=section_size,
+            max_section_pages=max_section_pages,
+            shard_pages=shard_pages,
+            shard_concurrency=shard_concurrency,
+            deduplicate_figures=deduplicate_figures,
+            figure_index=figure_index,
+            skip_decorative=skip_decorative,
         )
 
     def lazy_load(
@@ -380,6 +1469,6 @@ class AzureAIDocumentIntelligenceLoader(BaseLoader):
     ) -> Iterator[Document]:
         """Lazy load given path as pages."""
         if self.file_path is not None:
-            yield from self.parser.parse(self.file_path)
+            yield from self.parser.lazy_parse(self.file_path)
         else:
             raise ValueError(f"Only local path is supported for now.")
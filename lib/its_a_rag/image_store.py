@@ -0,0 +1,143 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: image_store.py
+# Description: Content-addressed store of the figure images, referenced from the search index.
+# Version: 2025-02-03
+# Author: Francesco Sodano
+#-----------------------------------------------------------------------------------------------------------
+
+from __future__ import annotations
+import base64
+import hashlib
+import mimetypes
+import os
+import tempfile
+import threading
+from typing import Optional
+
+IMAGE_STORE_PATH = "ingestion/image_store"
+
+# Prefix of the image references stored in the index instead of the data URLs
+IMAGE_REFERENCE_PREFIX = "image-store:"
+
+
+#########################################################
+# Check if an image value of the index is a reference to the image store
+# Args:
+#   - value: "image" metadata of a chunk (reference, data URL or None)
+# Returns:
+#   - True if the value is an image store reference
+#########################################################
+def is_image_reference(value: Optional[str]) -> bool:
+    return isinstance(value, str) and value.startswith(IMAGE_REFERENCE_PREFIX)
+
+
+#########################################################
+# Class: Image Store
+# Interface of the image stores: the images are stored once, under the
+# hash of their content, and the index only keeps the returned reference.
+# Subclasses implement _write, _read and _exists.
+#########################################################
+class ImageStore:
+    def put(self, data: bytes, mime_type: str) -> str:
+        """Store an image and return its reference."""
+        extension = (mimetypes.guess_extension(mime_type) or ".bin").lstrip(".")
+        name = f"{hashlib.sha256(data).hexdigest()}.{extension}"
+        if not self._exists(name):
+            self._write(name, data)
+        return IMAGE_REFERENCE_PREFIX + name
+
+    def get(self, reference: str) -> bytes:
+        """Return the content of a stored image."""
+        return self._read(self._name(reference))
+
+    def put_data_url(self, data_url: Optional[str]) -> Optional[str]:
+        """Store the image of a data URL and return its reference (None and references are returned as is)."""
+        if not data_url or is_image_reference(data_url):
+            return data_url
+        header, encoded = data_url.split(",", 1)
+        mime_type = header[len("data:"):].split(";")[0]
+        return self.put(base64.b64decode(encoded), mime_type)
+
+    def get_data_url(self, reference: Optional[str]) -> Optional[str]:
+        """Return the data URL of a stored image (None and data URLs are returned as is)."""
+        if not is_image_reference(reference):
+            return reference
+        name = self._name(reference)
+        mime_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        return f"data:{mime_type};base64,{base64.b64encode(self._read(name)).decode('utf-8')}"
+
+    @staticmethod
+    def _name(reference: str) -> str:
+        name = reference[len(IMAGE_REFERENCE_PREFIX):]
+        if not name or "/" in name or "\\" in name or name.startswith("."):
+            raise ValueError(f"Invalid image reference: {reference}")
+        return name
+
+    def _write(self, name: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    def _read(self, name: str) -> bytes:
+        raise NotImplementedError
+
+    def _exists(self, name: str) -> bool:
+        raise NotImplementedError
+
+
+#########################################################
+# Class: Local Image Store
+# Image store on the local filesystem (one file per image, in folders
+# named after the first two characters of the hash).
+# Args:
+#   - folder: folder of the images
+#########################################################
+class LocalImageStore(ImageStore):
+    def __init__(self, folder: str = IMAGE_STORE_PATH) -> None:
+        self.folder = folder
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.folder, name[:2], name)
+
+    def _write(self, name: str, data: bytes) -> None:
+        # Written to a temporary file first so readers never see a partial image
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _read(self, name: str) -> bytes:
+        with open(self._path(name), "rb") as f:
+            return f.read()
+
+    def _exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+
+_default_image_store: Optional[ImageStore] = None
+_default_image_store_lock = threading.Lock()
+
+
+#########################################################
+# Get the image store used to load the images of the search results
+# Returns:
+#   - the store set with set_default_image_store, or a LocalImageStore
+#########################################################
+def get_default_image_store() -> ImageStore:
+    global _default_image_store
+    with _default_image_store_lock:
+        if _default_image_store is None:
+            _default_image_store = LocalImageStore()
+        return _default_image_store
+
+
+#########################################################
+# Set the image store used to load the images of the search results
+# Args:
+#   - image_store: image store (None to use the default LocalImageStore)
+#########################################################
+def set_default_image_store(image_store: Optional[ImageStore]) -> None:
+    global _default_image_store
+    with _default_image_store_lock:
+        _default_image_store = image_store
@@ -0,0 +1,295 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: indexing.py
+# Description: Incremental indexing of the chunks in the multimodal vector store.
+# Version: 2025-02-03
+# Author: Francesco Sodano
+#-----------------------------------------------------------------------------------------------------------
+
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+from contextlib import closing
+from typing import Any, Dict, List, Optional
+
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+
+from .telemetry import count, span
+
+MANIFEST_PATH = "ingestion/manifest.sqlite"
+
+# Environment variable of the index version file, published by the ingestion and
+# watched by the semantic cache of the answers (on a storage shared by both)
+INDEX_VERSION_ENV = "AZURE_SEARCH_INDEX_VERSION_PATH"
+
+# Number of texts sent in each embedding request
+EMBED_BATCH_SIZE = 256
+
+# Number of chunks sent in each upload to the vector store
+UPLOAD_BATCH_SIZE = 500
+
+
+#########################################################
+# Compute the hash of a chunk (content and metadata)
+# Args:
+#   - doc: chunk produced by advanced_text_splitter
+# Returns:
+#   - hex digest of the chunk
+#########################################################
+def chunk_hash(doc: Document) -> str:
+    payload = json.dumps([doc.page_content, doc.metadata], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+#########################################################
+# Compute the index document ids of the chunks of a source
+# (the same chunk always gets the same id, identical chunks get distinct ids)
+# Args:
+#   - docs: chunks of the source
+#   - source: name of the source (see source_name)
+# Returns:
+#   - list of (id, chunk hash) tuples, one per chunk
+#########################################################
+def chunk_ids(docs: List[Document], source: str) -> List[tuple]:
+    occurrences: Dict[str, int] = {}
+    ids = []
+    for doc in docs:
+        digest = chunk_hash(doc)
+        occurrence = occurrences.get(digest, 0)
+        occurrences[digest] = occurrence + 1
+        doc_id = hashlib.sha256(f"{source}:{digest}:{occurrence}".encode("utf-8")).hexdigest()
+        ids.append((doc_id, digest))
+    return ids
+
+
+#########################################################
+# Get the name of a source file in the manifest: its normalized path
+# relative to a root folder, with "/" separators (two files with the same
+# name in different folders are different sources)
+# Args:
+#   - file_path: path of the source file
+#   - root: folder the names are relative to (default: the current folder)
+# Returns:
+#   - name of the source
+#########################################################
+def source_name(file_path: str, root: Optional[str] = None) -> str:
+    return os.path.relpath(os.path.abspath(file_path), os.path.abspath(root or os.curdir)).replace(os.sep, "/")
+
+
+#########################################################
+# Class: Chunk Manifest
+# Records, for each source file, the file hash and the hash and index
+# document id of each of its chunks, so that a re-ingestion only uploads
+# the new chunks and deletes the chunks that disappeared. The manifest is
+# a SQLite database: recording a source only writes the rows of that source.
+# Args:
+#   - path: path of the SQLite database
+#########################################################
+class ChunkManifest:
+    def __init__(self, path: str = MANIFEST_PATH) -> None:
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, file_hash TEXT)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                " source TEXT NOT NULL,"
+                " id TEXT NOT NULL,"
+                " hash TEXT NOT NULL,"
+                " PRIMARY KEY (source, id))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per operation: connections are not shared between threads or processes
+        return sqlite3.connect(self.path, timeout=30)
+
+    def sources(self) -> List[str]:
+        """Return the names of the recorded sources."""
+        with closing(self._connect()) as conn:
+            return [row[0] for row in conn.execute("SELECT source FROM sources ORDER BY source")]
+
+    def file_hash(self, source: str) -> Optional[str]:
+        """Return the hash of the file when it was last indexed, or None."""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT file_hash FROM sources WHERE source = ?", (source,)).fetchone()
+        return row[0] if row else None
+
+    def chunks(self, source: str) -> Dict[str, str]:
+        """Return the {id: chunk hash} of the indexed chunks of a source."""
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT id, hash FROM chunks WHERE source = ?", (source,)))
+
+    def update(self, source: str, chunks: Dict[str, str], file_hash: Optional[str] = None) -> None:
+        """Record the indexed chunks of a source (in a single transaction)."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO sources (source, file_hash) VALUES (?, ?) ON CONFLICT (source) DO UPDATE SET file_hash = excluded.file_hash",
+                (source, file_hash),
+            )
+            conn.execute("DELETE FROM chunks WHERE source = ?", (source,))
+            conn.executemany("INSERT INTO chunks (source, id, hash) VALUES (?, ?, ?)", ((source, doc_id, digest) for doc_id, digest in chunks.items()))
+
+    def remove(self, source: str) -> None:
+        """Forget a source."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM chunks WHERE source = ?", (source,))
+            conn.execute("DELETE FROM sources WHERE source = ?", (source,))
+
+
+def _write_json(path: str, data: Any) -> None:
+    # Written to a temporary file first so an interrupted run never leaves a partial file
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+#########################################################
+# Publish a new version of the index, after its chunks changed
+# (the semantic cache of the answers is cleared when the file changes,
+# see semantic_cache.index_version_from_env)
+# Args:
+#   - path: path of the index version file
+#   - index_name: name of the index
+# Returns:
+#   - the new version
+#########################################################
+def publish_index_version(path: str, index_name: str) -> str:
+    version = uuid.uuid4().hex
+    _write_json(path, {"index": index_name, "version": version, "published": time.time()})
+    return version
+
+
+#########################################################
+# Find the embedding model of a vector store
+# Args:
+#   - vector_store: vector store of the chunks
+# Returns:
+#   - Embeddings object, or None if the vector store only has an embedding function
+#########################################################
+def get_embeddings(vector_store: Any) -> Optional[Embeddings]:
+    embedding_function = getattr(vector_store, "embedding_function", None)
+    if isinstance(embedding_function, Embeddings):
+        return embedding_function
+    # create_multimodal_vector_store passes the bound embed_query method of the model
+    owner = getattr(embedding_function, "__self__", None)
+    return owner if isinstance(owner, Embeddings) else None
+
+
+#########################################################
+# Embed texts in batches, each distinct text only once
+# Args:
+#   - texts: texts to embed
+#   - embeddings: embedding model
+#   - batch_size: number of texts sent in each embedding request
+# Returns:
+#   - list of vectors, one per text
+#########################################################
+def embed_texts(texts: List[str], embeddings: Embeddings, batch_size: int = EMBED_BATCH_SIZE) -> List[List[float]]:
+    unique_texts = list(dict.fromkeys(texts))
+    vectors: Dict[str, List[float]] = {}
+    for start in range(0, len(unique_texts), batch_size):
+        batch = unique_texts[start:start + batch_size]
+        characters = sum(map(len, batch))
+        with span("embed", texts=len(batch), characters=characters):
+            vectors.update(zip(batch, embeddings.embed_documents(batch)))
+        count("embed.characters", characters)
+    return [vectors[text] for text in texts]
+
+
+#########################################################
+# Embed and upload chunks to the vector store
+# advanced_text_splitter creates one chunk per figure reference with the
+# same text, so the texts are deduplicated before being embedded and the
+# vectors are fanned back out to every chunk.
+# Args:
+#   - vector_store: vector store of the chunks
+#   - docs: chunks to upload
+#   - ids: optional index document ids of the chunks
+#   - embeddings: embedding model (default: the model of the vector store)
+#   - embed_batch_size: number of texts sent in each embedding request
+#   - upload_batch_size: number of chunks sent in each upload
+# Returns:
+#   - list of the index document ids
+#########################################################
+def add_documents(vector_store: Any, docs: List[Document], ids: Optional[List[str]] = None, embeddings: Optional[Embeddings] = None, embed_batch_size: int = EMBED_BATCH_SIZE, upload_batch_size: int = UPLOAD_BATCH_SIZE) -> List[str]:
+    if not docs:
+        return []
+    embeddings = embeddings or get_embeddings(vector_store)
+    if embeddings is None or not hasattr(vector_store, "add_embeddings"):
+        return vector_store.add_documents(documents=docs, ids=ids) if ids else vector_store.add_documents(documents=docs)
+
+    texts = [doc.page_content for doc in docs]
+    vectors = embed_texts(texts, embeddings, embed_batch_size)
+    added = []
+    for start in range(0, len(docs), upload_batch_size):
+        end = start + upload_batch_size
+        with span("upload", chunks=len(docs[start:end])):
+            added += vector_store.add_embeddings(
+                zip(texts[start:end], vectors[start:end]),
+                [doc.metadata for doc in docs[start:end]],
+                keys=ids[start:end] if ids else None,
+            )
+    return added
+
+
+#########################################################
+# Index the chunks of a source incrementally
+# Args:
+#   - vector_store: vector store of the chunks
+#   - docs: chunks of the source (from advanced_text_splitter)
+#   - source: name of the source in the manifest (see source_name)
+#   - manifest: manifest of the indexed chunks
+#   - file_hash: optional hash of the source file, recorded in the manifest
+#   - embeddings, embed_batch_size, upload_batch_size: see add_documents
+# Returns:
+#   - dictionary with the number of added, deleted and unchanged chunks
+#########################################################
+def index_documents(vector_store: Any, docs: List[Document], source: str, manifest: ChunkManifest, file_hash: Optional[str] = None, embeddings: Optional[Embeddings] = None, embed_batch_size: int = EMBED_BATCH_SIZE, upload_batch_size: int = UPLOAD_BATCH_SIZE) -> dict:
+    indexed = manifest.chunks(source)
+    ids = chunk_ids(docs, source)
+    current = dict(ids)
+    new_docs = [(doc_id, doc) for doc, (doc_id, _) in zip(docs, ids) if doc_id not in indexed]
+    stale_ids = [doc_id for doc_id in indexed if doc_id not in current]
+
+    if new_docs:
+        add_documents(
+            vector_store,
+            [doc for _, doc in new_docs],
+            [doc_id for doc_id, _ in new_docs],
+            embeddings,
+            embed_batch_size,
+            upload_batch_size,
+        )
+    if stale_ids:
+        vector_store.delete(ids=stale_ids)
+    manifest.update(source, current, file_hash)
+    return {"added": len(new_docs), "deleted": len(stale_ids), "unchanged": len(current) - len(new_docs)}
+
+
+#########################################################
+# Delete all the chunks of a source from the vector store
+# Args:
+#   - vector_store: vector store of the chunks
+#   - source: name of the source in the manifest (see source_name)
+#   - manifest: manifest of the indexed chunks
+# Returns:
+#   - number of deleted chunks
+#########################################################
+def delete_source(vector_store: Any, source: str, manifest: ChunkManifest) -> int:
+    ids = list(manifest.chunks(source))
+    if ids:
+        vector_store.delete(ids=ids)
+    manifest.remove(source)
+    return len(ids)
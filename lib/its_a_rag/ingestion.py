@@ -10,15 +10,37 @@
 from __future__ import annotations
 import re
 import json
-from typing import Any, List
+import os
+import threading
+from functools import partial
+from typing import Any, Callable, List, Optional
 from langchain_text_splitters.base import TextSplitter
 from langchain_community.vectorstores import AzureSearch
 from langchain_openai import AzureOpenAIEmbeddings
-from langchain.text_splitter import MarkdownHeaderTextSplitter
 from langchain.schema import Document
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain.prompts.chat import ChatPromptTemplate, HumanMessagePromptTemplate, SystemMessagePromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable, RunnableLambda, RunnablePassthrough
 from azure.search.documents.indexes.models import SearchableField, SearchField, SearchFieldDataType, SimpleField
+from .cache import QUERY_EMBEDDING_CACHE_SIZE, CachedEmbeddings, EmbeddingDimensionCache
+from .context import CONTEXT_TOKEN_BUDGET, context_documents, load_image, pack_context
+from .image_store import ImageStore
+from .local_store import LocalVectorStore
+from .rate_limit import RateLimitedEmbeddings, RateLimiter
+from .telemetry import span
+
+# Define the headers to split on
+HEADERS_TO_SPLIT_ON = [
+    ("#", "Header 1"),
+    ("##", "Header 2"),
+    ("###", "Header 3"),
+    ("####", "Header 4"),
+    ("#####", "Header 5"),
+    ("######", "Header 6"),
+    ("#######", "Header 7"),
+    ("########", "Header 8"),
+]
 
 AZURE_OPENAI_SYSTEM_MESSAGE = ("You are an assistant for question-answering tasks. "
                                "Use the context provided with the question to answer. "
@@ -27,6 +49,59 @@ AZURE_OPENAI_SYSTEM_MESSAGE = ("You are an assistant for question-answering task
                                "Keep the answer concise."
                                )
 
+#########################################################
+# Get the dimension of the vectors of an embedding deployment
+# Args:
+#   - embedding_function: embedding function, only called if the dimension is unknown
+#   - azure_openai_endpoint: azure openai endpoint
+#   - azure_openai_embedding_deployment: azure openai embedding deployment
+#   - dimensions: dimension from the configuration, if known
+#   - dimensions_cache: optional EmbeddingDimensionCache
+# Returns:
+#   - dimension of the vectors
+#########################################################
+def get_embedding_dimensions(embedding_function: Callable, azure_openai_endpoint: str, azure_openai_embedding_deployment: str, dimensions: Optional[int] = None, dimensions_cache: Optional[EmbeddingDimensionCache] = None) -> int:
+    if dimensions:
+        return int(dimensions)
+    key = EmbeddingDimensionCache.key(azure_openai_endpoint, azure_openai_embedding_deployment)
+    if dimensions_cache is not None:
+        cached = dimensions_cache.get(key)
+        if cached:
+            return cached
+    dimensions = len(embedding_function("Text"))
+    if dimensions_cache is not None:
+        dimensions_cache.set(key, dimensions)
+    return dimensions
+
+
+#########################################################
+# Class: Lazy Vector Store
+# Builds the vector store (and creates the index if it does not exist)
+# the first time one of its attributes is used.
+# Args:
+#   - factory: function returning the vector store
+#########################################################
+class LazyVectorStore:
+    def __init__(self, factory: Callable[[], Any]) -> None:
+        self._factory = factory
+        self._store = None
+        self._lock = threading.Lock()
+
+    @property
+    def store(self) -> Any:
+        """Return the vector store, building it on first use."""
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    self._store = self._factory()
+        return self._store
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+
 #########################################################
 # Create the multimodal vector store
 # Args:
@@ -37,21 +112,47 @@ AZURE_OPENAI_SYSTEM_MESSAGE = ("You are an assistant for question-answering task
 #   - azure_openai_embedding_deployment: azure openai embedding deployment
 #   - azure_search_endpoint: azure search endpoint
 #   - azure_search_api_key: azure search api key
+#   - embedding_dimensions: dimension of the vectors, if known (no embedding call to find it out)
+#   - dimensions_cache: optional EmbeddingDimensionCache remembering the dimension of each deployment
+#   - lazy: return a LazyVectorStore, the index is only created on first use
+#   - local_store_folder: keep the index in a LocalVectorStore saved in <local_store_folder>/<index_name>
+#     instead of Azure Search (the Azure Search endpoint and key are not used)
+#   - quantize: store the vectors of a new LocalVectorStore as int8
+#   - query_cache_size: number of query embeddings kept in memory (0 to disable the cache)
+#   - rate_limiter: optional RateLimiter of the embedding deployment (queries in the interactive lane,
+#     documents in the bulk lane; it then handles the retries)
 # Returns:
-#   - AzureSearch object, 
-#   - AzureOpenAIEmbeddings object
+#   - AzureSearch object (LazyVectorStore if lazy, LocalVectorStore if local_store_folder),
+#   - AzureOpenAIEmbeddings object (RateLimitedEmbeddings with a rate limiter)
 #########################################################
-def create_multimodal_vector_store(index_name: str, azure_openai_api_key: str, azure_openai_endpoint: str, azure_openai_api_version: str, azure_openai_embedding_deployment: str, azure_search_endpoint: str, azure_search_api_key: str) -> AzureSearch:
+def create_multimodal_vector_store(index_name: str, azure_openai_api_key: str, azure_openai_endpoint: str, azure_openai_api_version: str, azure_openai_embedding_deployment: str, azure_search_endpoint: str, azure_search_api_key: str, embedding_dimensions: Optional[int] = None, dimensions_cache: Optional[EmbeddingDimensionCache] = None, lazy: bool = False, local_store_folder: Optional[str] = None, quantize: bool = False, query_cache_size: int = QUERY_EMBEDDING_CACHE_SIZE, rate_limiter: Optional[RateLimiter] = None) -> AzureSearch:
     # Create the embedding client
     aoai_embeddings = AzureOpenAIEmbeddings(
     api_key= azure_openai_api_key,
     azure_deployment=azure_openai_embedding_deployment,
     openai_api_version=azure_openai_api_version,
-    azure_endpoint = azure_openai_endpoint
+    azure_endpoint = azure_openai_endpoint,
+    **({"max_retries": 0} if rate_limiter is not None else {})
     )
-    
+    if rate_limiter is not None:
+        aoai_embeddings = RateLimitedEmbeddings(aoai_embeddings, rate_limiter)
+    # The queries go through an LRU cache, the documents are embedded directly
+    query_embeddings = CachedEmbeddings(aoai_embeddings, azure_openai_embedding_deployment, query_cache_size) if query_cache_size else aoai_embeddings
+    embedding_function = query_embeddings.embed_query
+    if local_store_folder:
+        return LocalVectorStore.load_or_create(os.path.join(local_store_folder, index_name), query_embeddings, quantize), aoai_embeddings
+
+    def build() -> AzureSearch:
+        dimensions = get_embedding_dimensions(embedding_function, azure_openai_endpoint, azure_openai_embedding_deployment, embedding_dimensions, dimensions_cache)
+        return _create_azure_search(index_name, embedding_function, dimensions, azure_search_endpoint, azure_search_api_key)
+
+    if lazy:
+        return LazyVectorStore(build), aoai_embeddings
+    return build(), aoai_embeddings
+
+
+def _create_azure_search(index_name: str, embedding_function: Callable, dimensions: int, azure_search_endpoint: str, azure_search_api_key: str) -> AzureSearch:
     # Create Additional Fields for the Azure Search Index    
-    embedding_function = aoai_embeddings.embed_query
     fields = [
         SimpleField(
             name="id",
@@ -68,7 +169,7 @@ def create_multimodal_vector_store(index_name: str, azure_openai_api_key: str, a
             name="content_vector",
             type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
             searchable=True,
-            vector_search_dimensions=len(embedding_function("Text")),
+            vector_search_dimensions=dimensions,
             vector_search_profile_name="myHnswProfile",
         ),
         SearchableField(
@@ -98,9 +199,10 @@ def create_multimodal_vector_store(index_name: str, azure_openai_api_key: str, a
     index_name=index_name,
     embedding_function=embedding_function,
     fields=fields,
+    vector_search_dimensions=dimensions,
     )
     
-    return vector_store_multi_modal, aoai_embeddings
+    return vector_store_multi_modal
 
 #########################################################
 # Find the indices of the figures in the text
@@ -118,6 +220,7 @@ def find_figure_indices(text):
 
 #########################################################
 # Get the text from the documents related to images coming from the retriver
+# (images kept in an image store stay references until multimodal_prompt)
 # Args:
 #   - docs: list of documents
 # Returns:
@@ -137,14 +240,31 @@ def get_image_description(docs: List[Document]) -> dict:
 
 #########################################################
 # Generate the multimodal prompt including system message, text, table and image
+# With a token budget the context is packed within it (see context.pack_context)
+# unless it already was: the retrieved documents are packed in their rank order,
+# the output of get_image_description in its own order (texts, then images).
+# Without a budget the context is used as is, as before.
 # Args:
-#   - data_dict: dictionary containing the system message, context, question
+#   - data_dict: dictionary containing the question and the context (the retrieved
+#                documents, or the output of get_image_description or pack_context)
+#   - image_store: image store of the referenced images (default: get_default_image_store())
+#   - token_budget: maximum number of tokens of the context (None: no budget)
 # Returns:
 #   - list of messages
 #########################################################
-def multimodal_prompt(data_dict) -> List:
+def multimodal_prompt(data_dict, image_store: Optional[ImageStore] = None, token_budget: Optional[int] = None) -> List:
     system_message = AZURE_OPENAI_SYSTEM_MESSAGE
-    formatted_texts = "\n".join(data_dict["context"]["texts"])
+    context = data_dict["context"]
+    if not isinstance(context, dict):
+        context = pack_context(context, token_budget, image_store=image_store)
+    elif "tokens" not in context:
+        if token_budget is not None:
+            context = pack_context(context_documents(context), token_budget, image_store=image_store)
+        else:
+            # Only the images that reach the prompt are loaded from the image store
+            images = [load_image(image, image_store) for image in context["images"]]
+            context = {"images": [image for image in images if image], "texts": context["texts"]}
+    formatted_texts = "\n".join(context["texts"])
     messages = []
     # Adding the text for analysis
     text_message = {
@@ -157,8 +277,8 @@ def multimodal_prompt(data_dict) -> List:
     }
     messages.append(text_message)
     # Adding image(s) to the messages if present
-    if data_dict["context"]["images"]:
-        for image in data_dict["context"]["images"]:
+    if context["images"]:
+        for image in context["images"]:
             image_message = {
                 "type": "image_url",
                 "image_url": {"url": f"{image}"},
@@ -167,6 +287,26 @@ def multimodal_prompt(data_dict) -> List:
     return [HumanMessage(content=messages)]
 
 
+#########################################################
+# Build the multimodal RAG chain: retrieve the documents of the question,
+# pack them in the prompt within the token budget and generate the answer
+# Args:
+#   - retriever: retriever of the multimodal vector store
+#   - model: chat model
+#   - token_budget: maximum number of tokens of the context (None: no budget)
+#   - image_store: image store of the referenced images (default: get_default_image_store())
+# Returns:
+#   - runnable taking the question and returning the answer
+#########################################################
+def multimodal_rag_chain(retriever: Any, model: Any, token_budget: Optional[int] = CONTEXT_TOKEN_BUDGET, image_store: Optional[ImageStore] = None) -> Runnable:
+    return (
+        {"context": retriever, "question": RunnablePassthrough()}
+        | RunnableLambda(partial(multimodal_prompt, image_store=image_store, token_budget=token_budget))
+        | model
+        | StrOutputParser()
+    )
+
+
 class CustomCharacterTextSplitter(TextSplitter):
     """Splitting text that looks at characters."""
 
@@ -185,53 +325,180 @@ class CustomCharacterTextSplitter(TextSplitter):
         splits = [part for part in splits if part.strip()]
         return splits
 
+#########################################################
+# Find the header lines of a Markdown text (same header detection as
+# MarkdownHeaderTextSplitter with HEADERS_TO_SPLIT_ON)
+# Args:
+#   - text: Markdown text
+# Returns:
+#   - list of (offset, headers_before, headers_after, safe) tuples, one per header line.
+#     safe is True when the text can be cut before the line without changing the
+#     chunks of MarkdownHeaderTextSplitter: it is the first header line after some
+#     content and the headers of the content before and after it differ.
+#########################################################
+def find_header_boundaries(text: str) -> List[tuple]:
+    boundaries = []
+    headers = {}
+    content_headers = None      # headers of the last content line
+    pending = None              # index of the first header line after the last content line
+    in_code_block = False
+    opening_fence = ""
+    offset = 0
+    for line in text.split("\n"):
+        line_offset = offset
+        offset += len(line) + 1
+        stripped_line = "".join(filter(str.isprintable, line.strip()))
+        if not in_code_block:
+            if stripped_line.startswith("```") and stripped_line.count("```") == 1:
+                in_code_block, opening_fence = True, "```"
+            elif stripped_line.startswith("~~~"):
+                in_code_block, opening_fence = True, "~~~"
+        elif stripped_line.startswith(opening_fence):
+            in_code_block, opening_fence = False, ""
+        if not in_code_block and stripped_line.startswith("#"):
+            level = min(len(stripped_line) - len(stripped_line.lstrip("#")), len(HEADERS_TO_SPLIT_ON))
+            sep = "#" * level
+            if len(stripped_line) == len(sep) or stripped_line[len(sep)] == " ":
+                new_headers = {name: data for name, data in headers.items() if int(name.split()[-1]) < level}
+                new_headers[f"Header {level}"] = stripped_line[len(sep):].strip()
+                if pending is None:
+                    pending = len(boundaries)
+                boundaries.append((line_offset, headers, new_headers, False))
+                headers = new_headers
+                continue
+        if in_code_block or stripped_line:
+            if pending is not None and content_headers is not None and headers != content_headers:
+                boundaries[pending] = boundaries[pending][:3] + (True,)
+            pending = None
+            content_headers = headers
+    return boundaries
+
+
+#########################################################
+# Merge the headers inherited by a section with the headers found in it
+# Args:
+#   - inherited: headers active where the section starts
+#   - headers: headers found by the splitter in the section
+# Returns:
+#   - headers of the chunk, as if the document had been split in one piece
+#########################################################
+def merge_headers(inherited: dict, headers: dict) -> dict:
+    if not headers:
+        return dict(inherited)
+    level = min(int(name.split()[-1]) for name in headers)
+    merged = {name: data for name, data in inherited.items() if int(name.split()[-1]) < level}
+    merged.update(headers)
+    return merged
+
+
+# Precompiled patterns of the figure tags and of the figure references
+FIGURE_TAG_PATTERN = re.compile(r'(<figure>.*?</figure>)', re.DOTALL)
+FIGURE_REFERENCE_PATTERN = re.compile(r'!\[\]\(figures/(\d+)\)')
+
+# Key of the figure metadata holding the marks of the deduplicated and decorative figures (not an image)
+FIGURE_MARKS_KEY = "marks"
+
+# Header metadata name of each header level
+HEADER_NAMES = {len(sep): name for sep, name in HEADERS_TO_SPLIT_ON}
+
+
+#########################################################
+# Split a Markdown text on the headers in a single scan
+# (same chunks and metadata as MarkdownHeaderTextSplitter with HEADERS_TO_SPLIT_ON)
+# Args:
+#   - text: Markdown text
+# Returns:
+#   - list of (content, headers) tuples, one per chunk
+#########################################################
+def split_markdown_headers(text: str) -> List[tuple]:
+    chunks = []                 # [list of blocks, headers] of each chunk
+    block = []                  # lines of the current block (blocks are separated by blank lines)
+    headers = {}
+    levels = {}                 # level of each header name in headers
+    in_code_block = False
+    opening_fence = ""
+    for line in text.split("\n"):
+        stripped_line = line.strip()
+        if not stripped_line.isprintable():
+            stripped_line = "".join(filter(str.isprintable, stripped_line))
+        if not in_code_block:
+            if stripped_line.startswith("```") and stripped_line.count("```") == 1:
+                in_code_block, opening_fence = True, "```"
+            elif stripped_line.startswith("~~~"):
+                in_code_block, opening_fence = True, "~~~"
+        elif stripped_line.startswith(opening_fence):
+            in_code_block, opening_fence = False, ""
+        if in_code_block:
+            block.append(stripped_line)
+            continue
+        if stripped_line.startswith("#"):
+            level = len(stripped_line) - len(stripped_line.lstrip("#"))
+            if level in HEADER_NAMES and (len(stripped_line) == level or stripped_line[level] == " "):
+                if block:
+                    if chunks and chunks[-1][1] == headers:
+                        chunks[-1][0].append("\n".join(block))
+                    else:
+                        chunks.append([["\n".join(block)], headers])
+                    block = []
+                name = HEADER_NAMES[level]
+                headers = {key: data for key, data in headers.items() if levels[key] < level}
+                headers[name] = stripped_line[level:].strip()
+                levels[name] = level
+                continue
+        if stripped_line:
+            block.append(stripped_line)
+        elif block:
+            if chunks and chunks[-1][1] == headers:
+                chunks[-1][0].append("\n".join(block))
+            else:
+                chunks.append([["\n".join(block)], headers])
+            block = []
+    if block:
+        if chunks and chunks[-1][1] == headers:
+            chunks[-1][0].append("\n".join(block))
+        else:
+            chunks.append([["\n".join(block)], headers])
+    return [("  \n".join(blocks), dict(chunk_headers)) for blocks, chunk_headers in chunks]
+
+
 #########################################################
 # Split the text on the headers and the figures
 # Args:
-#   - docs: list of documents
+#   - docs: list of documents (one document, or any of the sections streamed by the parser)
 #   - pdf_file_name: name of the pdf file
+#   - image_store: optional image store, the chunks then reference the images instead of holding their data URL
 # Returns:
 #   - list of documents
 #########################################################
-def advanced_text_splitter(docs: List[Document], pdf_file_name: str) -> List[Document]:
-    # Define the headers to split on
-    headers_to_split_on = [
-    ("#", "Header 1"),
-    ("##", "Header 2"),
-    ("###", "Header 3"),
-    ("####", "Header 4"),
-    ("#####", "Header 5"),
-    ("######", "Header 6"),
-    ("#######", "Header 7"),
-    ("########", "Header 8"),
-    ]
-    # Use the markdownHeader Spliter from langchain
-    text_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on)
-    docs_string = docs[0].page_content
-    docs_result = text_splitter.split_text(docs_string)
-    # Split the text on the figure tags
-    text_splitter = CustomCharacterTextSplitter(separator=r'(<figure>.*?</figure>)', is_separator_regex=True)
-    child_docs  = text_splitter.split_documents(docs_result)
-    # Extract the image metadata
-    image_metadata = docs[-1].metadata['images']
-    lst_docs = []
-    # For each child document,
-    for doc in child_docs:
-        # Find all the figures
-        figure_indices = find_figure_indices(doc.page_content)
-        if figure_indices:
-            for figure_indice in figure_indices:
-                # get the image metadata
-                image = image_metadata[figure_indice]
-                # Create a new document with the image metadata
-                doc_result = Document(page_content = doc.page_content, metadata={"header": json.dumps(doc.metadata), "source": pdf_file_name, "image": image})
-                # Append the document to the list
-                lst_docs.append(doc_result)
-        # If there are no figures
-        else:
-            # Create a new document with no image metadata
-            doc_result = Document(page_content = doc.page_content, metadata={"header": json.dumps(doc.metadata), "source": pdf_file_name, "image": None})
-            # Append the document to the list
-            lst_docs.append(doc_result)
+def advanced_text_splitter(docs: List[Document], pdf_file_name: str, image_store: Optional[ImageStore] = None) -> List[Document]:
+    with span("split", file=pdf_file_name, characters=sum(len(doc.page_content) for doc in docs)) as split_span:
+        # Split on the headers (sections streamed by the parser carry the headers active where they start,
+        # so a section split on its own gets the same headers as in the whole document)
+        chunks = []
+        for doc in docs:
+            inherited = doc.metadata.get("headers", {})
+            chunks += [(content, merge_headers(inherited, headers)) for content, headers in split_markdown_headers(doc.page_content)]
+        # Extract the image metadata
+        image_metadata = {}
+        for doc in docs:
+            image_metadata.update((idx, image) for idx, image in doc.metadata['images'].items() if idx != FIGURE_MARKS_KEY)
+        if image_store is not None:
+            image_metadata = {idx: image_store.put_data_url(image) for idx, image in image_metadata.items()}
+        lst_docs = []
+        for content, headers in chunks:
+            header = json.dumps(headers)
+            # Split the chunk on the figure tags
+            parts = FIGURE_TAG_PATTERN.split(content) if "<figure>" in content else [content]
+            for part in parts:
+                if not part.strip():
+                    continue
+                # Create one document per figure referenced in the part, or one document with no image
+                figure_indices = FIGURE_REFERENCE_PATTERN.findall(part) if "![](figures/" in part else []
+                if figure_indices:
+                    for figure_indice in figure_indices:
+                        lst_docs.append(Document(page_content=part, metadata={"header": header, "source": pdf_file_name, "image": image_metadata[int(figure_indice)]}))
+                else:
+                    lst_docs.append(Document(page_content=part, metadata={"header": header, "source": pdf_file_name, "image": None}))
+        split_span.set(chunks=len(lst_docs))
     # Return the list of documents
     return lst_docs
@@ -0,0 +1,382 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: local_store.py
+# Description: In-process vector store (NumPy) with the same documents and fields as the Azure Search index.
+# Version: 2025-02-03
+# Author: Francesco Sodano
+#-----------------------------------------------------------------------------------------------------------
+
+from __future__ import annotations
+import json
+import os
+import tempfile
+import threading
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore, VectorStoreRetriever
+
+from .bm25 import RRF_K, BM25Index, reciprocal_rank_fusion
+
+LOCAL_STORE_FOLDER = "ingestion/vector_store"
+
+# Number of results of each search (vector and BM25) fused by the hybrid search
+HYBRID_FETCH_K = 30
+
+# Number of vectors scored at once (bounds the memory of the int8 to float32 conversion)
+SEARCH_BLOCK_SIZE = 65536
+
+
+#########################################################
+# Write a file atomically (temporary file first, then rename)
+#########################################################
+def _atomic_write(path: str, write: Callable[[Any], None], mode: str = "wb") -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+#########################################################
+# Class: Local Vector Store
+# Keeps the chunks in process: the vectors are normalized and stored in a
+# contiguous NumPy array (float32, or int8 with a scale per vector when
+# quantized) and a query is scored against all of them with one matrix
+# product per block. The documents keep the same metadata as in the
+# Azure Search index (header, image, source), and a BM25 index of the
+# texts provides the keyword side of the hybrid search.
+# Args:
+#   - embedding_function: Embeddings object or embedding function of a text
+#   - folder: optional folder where the store is saved
+#   - quantize: store the vectors as int8 (4x smaller, slightly less precise scores)
+#   - lexical: keep a BM25 index of the texts for the hybrid search
+#########################################################
+class LocalVectorStore(VectorStore):
+    def __init__(self, embedding_function: Union[Embeddings, Callable], folder: Optional[str] = None, quantize: bool = False, lexical: bool = True) -> None:
+        self.embedding_function = embedding_function
+        self.folder = folder
+        self.quantize = quantize
+        self.lexical_index = BM25Index() if lexical else None
+        self._lock = threading.RLock()
+        self._ids: List[str] = []
+        self._texts: List[str] = []
+        self._metadatas: List[dict] = []
+        self._positions: Dict[str, int] = {}
+        self._vectors: Optional[np.ndarray] = None      # (capacity, dimensions)
+        self._scales: Optional[np.ndarray] = None       # (capacity,) when quantized
+        self._size = 0
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding_function if isinstance(self.embedding_function, Embeddings) else None
+
+    def __len__(self) -> int:
+        return self._size
+
+    # Embedding
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if isinstance(self.embedding_function, Embeddings):
+            return self.embedding_function.embed_documents(texts)
+        return [self.embedding_function(text) for text in texts]
+
+    def _embed_query(self, text: str) -> List[float]:
+        if isinstance(self.embedding_function, Embeddings):
+            return self.embedding_function.embed_query(text)
+        return self.embedding_function(text)
+
+    @staticmethod
+    def _normalize(vectors: Any) -> np.ndarray:
+        matrix = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def _encode(self, matrix: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        if not self.quantize:
+            return matrix, None
+        scales = np.abs(matrix).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return np.round(matrix / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    # Writing
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, *, keys: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        """Embed and add texts (ids can be given as keys or ids, like AzureSearch)."""
+        texts = list(texts)
+        if not texts:
+            return []
+        return self.add_embeddings(zip(texts, self._embed_documents(texts)), metadatas, keys=keys or kwargs.get("ids"))
+
+    def add_embeddings(self, text_embeddings: Iterable[Tuple[str, List[float]]], metadatas: Optional[List[dict]] = None, *, keys: Optional[List[str]] = None) -> List[str]:
+        """Add texts with their vectors; an existing id is replaced."""
+        pairs = list(text_embeddings)
+        if not pairs:
+            return []
+        keys = list(keys) if keys else [uuid.uuid4().hex for _ in pairs]
+        metadatas = metadatas or [{} for _ in pairs]
+        rows, scales = self._encode(self._normalize([vector for _, vector in pairs]))
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.empty((0, rows.shape[1]), dtype=rows.dtype)
+                self._scales = np.empty(0, dtype=np.float32) if self.quantize else None
+            elif rows.shape[1] != self._vectors.shape[1]:
+                raise ValueError(f"Vectors of dimension {rows.shape[1]} cannot be added to a store of dimension {self._vectors.shape[1]}")
+            self._make_writable()
+            for i, key in enumerate(keys):
+                (text, _), metadata = pairs[i], metadatas[i]
+                position = self._positions.get(key)
+                if position is None:
+                    position = self._size
+                    self._reserve(position + 1)
+                    self._ids.append(key)
+                    self._texts.append(text)
+                    self._metadatas.append(metadata)
+                    self._positions[key] = position
+                    self._size += 1
+                else:
+                    self._texts[position] = text
+                    self._metadatas[position] = metadata
+                self._vectors[position] = rows[i]
+                if scales is not None:
+                    self._scales[position] = scales[i]
+            if self.lexical_index is not None:
+                self.lexical_index.add_texts(keys, [text for text, _ in pairs])
+        return keys
+
+    def _make_writable(self) -> None:
+        # A loaded store is memory-mapped read-only, copy it in memory before the first change
+        if not self._vectors.flags.writeable:
+            self._vectors = np.array(self._vectors)
+            if self._scales is not None:
+                self._scales = np.array(self._scales)
+
+    def _reserve(self, size: int) -> None:
+        # Grow the arrays geometrically so that adding one vector at a time stays linear
+        capacity = self._vectors.shape[0]
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 1024)
+        vectors = np.empty((capacity, self._vectors.shape[1]), dtype=self._vectors.dtype)
+        vectors[:self._size] = self._vectors[:self._size]
+        self._vectors = vectors
+        if self._scales is not None:
+            scales = np.empty(capacity, dtype=np.float32)
+            scales[:self._size] = self._scales[:self._size]
+            self._scales = scales
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        """Delete documents by id."""
+        if not ids:
+            return False
+        with self._lock:
+            deleted = {self._positions[key] for key in ids if key in self._positions}
+            if not deleted:
+                return False
+            keep = np.array([i for i in range(self._size) if i not in deleted], dtype=np.int64)
+            # New arrays and lists, so that a search running on the previous ones is not affected
+            self._vectors = self._vectors[keep]
+            if self._scales is not None:
+                self._scales = self._scales[keep]
+            self._ids = [self._ids[i] for i in keep]
+            self._texts = [self._texts[i] for i in keep]
+            self._metadatas = [self._metadatas[i] for i in keep]
+            self._positions = {key: i for i, key in enumerate(self._ids)}
+            self._size = len(keep)
+            if self.lexical_index is not None:
+                self.lexical_index.delete(ids)
+        return True
+
+    # Search
+    def _matching(self, metadatas: List[dict], size: int, filter: Optional[dict]) -> Optional[np.ndarray]:
+        if not filter:
+            return None
+        return np.array([all(metadatas[i].get(name) == value for name, value in filter.items()) for i in range(size)], dtype=bool)
+
+    def search_by_vectors(self, vectors: Any, k: int = 4, filter: Optional[dict] = None) -> List[List[Tuple[Document, float]]]:
+        """Return the k most similar documents (cosine similarity) of each query vector.
+
+        filter keeps only the documents whose metadata has the given values, e.g. {"source": "2023 FY MSFT.pdf"}.
+        """
+        queries = self._normalize(vectors)
+        with self._lock:
+            stored, scales, size = self._vectors, self._scales, self._size
+            ids, texts, metadatas = self._ids, self._texts, self._metadatas
+        if size == 0 or k <= 0:
+            return [[] for _ in range(len(queries))]
+        mask = self._matching(metadatas, size, filter)
+
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_positions = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, size, SEARCH_BLOCK_SIZE):
+            end = min(size, start + SEARCH_BLOCK_SIZE)
+            block = stored[start:end]
+            if scales is None:
+                scores = queries @ block.T
+            else:
+                scores = (queries @ block.astype(np.float32).T) * scales[start:end]
+            if mask is not None:
+                scores[:, ~mask[start:end]] = -np.inf
+            # Keep the k best of the block, then the k best of the candidates so far
+            top = min(k, end - start)
+            positions = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, positions, axis=1)], axis=1)
+            best_positions = np.concatenate([best_positions, positions + start], axis=1)
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_positions = np.take_along_axis(best_positions, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        results = []
+        for query_scores, query_positions, query_order in zip(best_scores, best_positions, order):
+            results.append([
+                (Document(id=ids[query_positions[i]], page_content=texts[query_positions[i]], metadata=metadatas[query_positions[i]]), float(query_scores[i]))
+                for i in query_order
+                if np.isfinite(query_scores[i])
+            ])
+        return results
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.search_by_vectors([self._embed_query(query)], k, filter)[0]
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.search_by_vectors([embedding], k, filter)[0]]
+
+    def hybrid_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None, fetch_k: int = HYBRID_FETCH_K, rrf_k: int = RRF_K, **kwargs: Any) -> List[Tuple[Document, float]]:
+        """Fuse the vector and BM25 results (fetch_k of each) by reciprocal rank fusion and return the k best with their fused score.
+
+        The fused score is normalized to [0, 1]: 1 for a document ranked first by both searches,
+        0.5 for a document ranked first by one of them only.
+        """
+        if self.lexical_index is None:
+            raise ValueError("The hybrid search needs the BM25 index (lexical=True)")
+        vector_results = self.similarity_search_with_score(query, fetch_k, filter)
+        lexical_results = self.lexical_index.search(query, fetch_k if not filter else 4 * fetch_k)
+        with self._lock:
+            positions, metadatas = self._positions, self._metadatas
+            lexical_ids = [
+                key for key, _ in lexical_results
+                if key in positions and (not filter or all(metadatas[positions[key]].get(name) == value for name, value in filter.items()))
+            ][:fetch_k]
+        documents = {doc.id: doc for doc, _ in vector_results}
+        fused = reciprocal_rank_fusion([[doc.id for doc, _ in vector_results], lexical_ids], rrf_k)[:k]
+        missing = [key for key, _ in fused if key not in documents]
+        documents.update((doc.id, doc) for doc in self.get_by_ids(missing))
+        # The best possible fused score is 2 / (rrf_k + 1), ranked first by both searches
+        best = 2 / (rrf_k + 1)
+        return [(documents[key], score / best) for key, score in fused if key in documents]
+
+    def hybrid_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        """Return the k best documents of the hybrid (vector + BM25) search."""
+        return [doc for doc, _ in self.hybrid_search_with_score(query, k, **kwargs)]
+
+    def as_retriever(self, **kwargs: Any) -> LocalStoreRetriever:
+        """Return a retriever, with the search types of VectorStoreRetriever plus "hybrid" and "hybrid_score_threshold"."""
+        tags = kwargs.pop("tags", None) or [*self._get_retriever_tags()]
+        return LocalStoreRetriever(vectorstore=self, tags=tags, **kwargs)
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # Cosine similarity in [-1, 1] to a relevance in [0, 1]
+        return lambda score: (score + 1) / 2
+
+    def get_by_ids(self, ids: List[str]) -> List[Document]:
+        with self._lock:
+            return [
+                Document(id=key, page_content=self._texts[self._positions[key]], metadata=self._metadatas[self._positions[key]])
+                for key in ids
+                if key in self._positions
+            ]
+
+    # Persistence
+    def save(self, folder: Optional[str] = None) -> None:
+        """Save the store in a folder (vectors.npy, scales.npy, documents.jsonl, store.json)."""
+        folder = folder or self.folder
+        if not folder:
+            raise ValueError("No folder to save the store in")
+        os.makedirs(folder, exist_ok=True)
+        with self._lock:
+            size = self._size
+            vectors = self._vectors[:size] if self._vectors is not None else np.empty((0, 0), dtype=np.float32)
+            scales = self._scales[:size] if self._scales is not None else None
+            _atomic_write(os.path.join(folder, "vectors.npy"), lambda f: np.save(f, vectors))
+            if scales is not None:
+                _atomic_write(os.path.join(folder, "scales.npy"), lambda f: np.save(f, scales))
+
+            def write_documents(f) -> None:
+                for key, text, metadata in zip(self._ids, self._texts, self._metadatas):
+                    f.write(json.dumps({"id": key, "content": text, "metadata": metadata}) + "\n")
+
+            _atomic_write(os.path.join(folder, "documents.jsonl"), write_documents, "w")
+            if self.lexical_index is not None:
+                self.lexical_index.save(folder)
+            # Written last: a store is only loaded once its description matches the other files
+            store = {"count": size, "dimensions": int(vectors.shape[1]), "quantize": self.quantize, "lexical": self.lexical_index is not None}
+            _atomic_write(os.path.join(folder, "store.json"), lambda f: json.dump(store, f), "w")
+
+    @classmethod
+    def load(cls, folder: str, embedding_function: Union[Embeddings, Callable], mmap: bool = True) -> LocalVectorStore:
+        """Load a saved store (the vectors are memory-mapped unless mmap is False)."""
+        with open(os.path.join(folder, "store.json")) as f:
+            description = json.load(f)
+        store = cls(embedding_function, folder, description["quantize"], description.get("lexical", False))
+        mmap_mode = "r" if mmap else None
+        if description["count"]:
+            store._vectors = np.load(os.path.join(folder, "vectors.npy"), mmap_mode=mmap_mode)
+            if store.quantize:
+                store._scales = np.load(os.path.join(folder, "scales.npy"), mmap_mode=mmap_mode)
+        with open(os.path.join(folder, "documents.jsonl")) as f:
+            for line in f:
+                document = json.loads(line)
+                store._positions[document["id"]] = len(store._ids)
+                store._ids.append(document["id"])
+                store._texts.append(document["content"])
+                store._metadatas.append(document["metadata"])
+        store._size = len(store._ids)
+        if store._size != description["count"]:
+            raise ValueError(f"The store in {folder} is inconsistent ({store._size} documents, {description['count']} expected)")
+        if store.lexical_index is not None:
+            store.lexical_index = BM25Index.load(folder)
+        return store
+
+    @classmethod
+    def load_or_create(cls, folder: str, embedding_function: Union[Embeddings, Callable], quantize: bool = False) -> LocalVectorStore:
+        """Load the store saved in a folder, or create an empty one saved there."""
+        if os.path.exists(os.path.join(folder, "store.json")):
+            return cls.load(folder, embedding_function)
+        return cls(embedding_function, folder, quantize)
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, *, ids: Optional[List[str]] = None, **kwargs: Any) -> LocalVectorStore:
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas, keys=ids)
+        return store
+
+
+#########################################################
+# Class: Retriever of the Local Vector Store
+# VectorStoreRetriever with the hybrid search types of the Azure Search
+# retriever ("hybrid" and "hybrid_score_threshold"). The score_threshold of
+# "hybrid_score_threshold" applies to the normalized fused score in [0, 1]
+# (see hybrid_search_with_score), not to the raw reciprocal rank fusion
+# score that Azure Search compares it with.
+#########################################################
+class LocalStoreRetriever(VectorStoreRetriever):
+    allowed_search_types = ("similarity", "similarity_score_threshold", "mmr", "hybrid", "hybrid_score_threshold")
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs: Any) -> List[Document]:
+        search_kwargs = self.search_kwargs | kwargs
+        if self.search_type == "hybrid":
+            return self.vectorstore.hybrid_search(query, **search_kwargs)
+        if self.search_type == "hybrid_score_threshold":
+            score_threshold = search_kwargs.pop("score_threshold", 0.0)
+            return [doc for doc, score in self.vectorstore.hybrid_search_with_score(query, **search_kwargs) if score >= score_threshold]
+        return super()._get_relevant_documents(query, run_manager=run_manager, **kwargs)
@@ -0,0 +1,464 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: pipeline.py
+# Description: Parallel multi-document ingestion pipeline (analysis, cropping, description, splitting, indexing).
+# Version: 2025-02-03
+# Author: Francesco Sodano
+# Usage: python -m its_a_rag.pipeline --index-name <index> data/fsi/pdf
+#-----------------------------------------------------------------------------------------------------------
+
+from __future__ import annotations
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain.schema import Document
+
+from .doc_intelligence import (
+    CROP_DPI,
+    IMAGE_STORE_FOLDER,
+    SHARD_CONCURRENCY,
+    AzureAIDocumentIntelligenceParser,
+    ImageEncoding,
+    VisionClient,
+    assemble_figures,
+    crop_figures,
+    describe_figures,
+    save_initial_markdown,
+)
+from .cache import FIGURE_INDEX_PATH, EmbeddingDimensionCache, FigureIndex, file_sha256
+from .image_store import IMAGE_STORE_PATH, ImageStore, LocalImageStore
+from .indexing import EMBED_BATCH_SIZE, INDEX_VERSION_ENV, UPLOAD_BATCH_SIZE, ChunkManifest, add_documents, index_documents, publish_index_version, source_name
+from .ingestion import advanced_text_splitter, create_multimodal_vector_store
+from .local_store import LOCAL_STORE_FOLDER, LocalVectorStore
+from .rate_limit import get_rate_limiter
+from .telemetry import JsonLinesSink, OpenTelemetrySink, current_span, set_telemetry_sink, span
+
+# Order of the pipeline stages
+STAGES = ["analyze", "crop", "describe", "split", "index"]
+
+# Start method of the crop processes: forking the pipeline while its stage threads hold
+# locks (SQLite connections, HTTP pools, telemetry sink) can deadlock the children
+CROP_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+#########################################################
+# Class: Result of the ingestion of a file
+#########################################################
+@dataclass
+class FileResult:
+    file_path: str
+    status: str = "pending"                                   # "indexed", "unchanged" or "failed"
+    stage: Optional[str] = None                               # last stage reached
+    figures: int = 0
+    chunks: int = 0
+    added: int = 0                                            # chunks uploaded to the index
+    deleted: int = 0                                          # stale chunks deleted from the index
+    error: Optional[str] = None
+    timings: Dict[str, float] = field(default_factory=dict)   # seconds spent in each stage
+
+
+#########################################################
+# Class: File moving through the pipeline
+#########################################################
+@dataclass
+class _FileJob:
+    result: FileResult
+    skip: bool = False
+    file_hash: Optional[str] = None
+    analysis: Any = None
+    crops: List[Any] = field(default_factory=list)
+    docs: List[Document] = field(default_factory=list)
+
+
+_DONE = object()
+
+
+#########################################################
+# Class: Ingestion Pipeline
+# Each stage runs in its own pool of workers and the stages are connected
+# by bounded queues, so a slow stage holds back the upstream stages
+# (backpressure) instead of accumulating analyzed files in memory.
+# Args:
+#   - parser: AzureAIDocumentIntelligenceParser used for the layout analysis
+#   - vector_store: vector store the chunks are added to
+#   - analysis_workers: number of files analyzed in parallel
+#   - crop_workers: number of processes cropping figures
+#   - description_workers: number of image descriptions requested in parallel (across files)
+#   - split_workers: number of files split in parallel
+#   - index_workers: number of files embedded and uploaded in parallel
+#   - queue_size: number of files waiting between two stages
+#   - output_folder: folder of the ingestion artifacts (images, descriptions, markdown), unused if the parser does not save the images
+#   - dpi: resolution of the cropped figures
+#   - progress: callback called with the FileResult of each completed file
+#   - manifest: optional ChunkManifest, only the new chunks are uploaded and the stale ones deleted
+#   - skip_unchanged: with a manifest, skip the files whose content did not change since they were indexed
+#   - source_root: folder the files are named relative to in the manifest (default: the current folder)
+#   - embeddings: embedding model (default: the model of the vector store)
+#   - embed_batch_size: number of distinct chunk texts sent in each embedding request
+#   - upload_batch_size: number of chunks sent in each upload to the vector store
+#   - image_store: optional image store, the index then holds image references instead of data URLs
+#########################################################
+class IngestionPipeline:
+    def __init__(
+        self,
+        parser: AzureAIDocumentIntelligenceParser,
+        vector_store: Any,
+        *,
+        analysis_workers: int = 4,
+        crop_workers: Optional[int] = None,
+        description_workers: int = 8,
+        split_workers: int = 2,
+        index_workers: int = 2,
+        queue_size: int = 4,
+        output_folder: str = IMAGE_STORE_FOLDER,
+        dpi: int = CROP_DPI,
+        progress: Optional[Callable[[FileResult], None]] = None,
+        manifest: Optional[ChunkManifest] = None,
+        skip_unchanged: bool = True,
+        source_root: Optional[str] = None,
+        embeddings: Any = None,
+        embed_batch_size: int = EMBED_BATCH_SIZE,
+        upload_batch_size: int = UPLOAD_BATCH_SIZE,
+        image_store: Optional[ImageStore] = None,
+    ) -> None:
+        self.parser = parser
+        self.vector_store = vector_store
+        self.workers = {
+            "analyze": analysis_workers,
+            "crop": crop_workers or os.cpu_count() or 1,
+            # Files being described at the same time; the vision calls are bounded by description_workers
+            "describe": max(1, min(4, description_workers)),
+            "split": split_workers,
+            "index": index_workers,
+        }
+        self.description_workers = description_workers
+        self.queue_size = queue_size
+        self.output_folder = output_folder
+        self.dpi = dpi
+        self.progress = progress or self._print_progress
+        self.manifest = manifest
+        self.skip_unchanged = skip_unchanged
+        self.source_root = source_root
+        self.embeddings = embeddings
+        self.embed_batch_size = embed_batch_size
+        self.upload_batch_size = upload_batch_size
+        self.image_store = image_store
+        self._crop_pool = None
+        self._description_pool = None
+
+    # Stages
+    def _analyze(self, job: _FileJob) -> None:
+        file_path = job.result.file_path
+        if self.manifest is not None:
+            job.file_hash = file_sha256(file_path)
+            if self.skip_unchanged and self.manifest.file_hash(source_name(file_path, self.source_root)) == job.file_hash:
+                job.skip = True
+                return
+        job.analysis = self.parser.analyze(file_path)
+
+    def _crop(self, job: _FileJob) -> None:
+        file_path = job.result.file_path
+        if self.parser.save_images:
+            save_initial_markdown(file_path, job.analysis, self.output_folder)
+        with_image_hashes = self.parser.description_cache is not None
+        with_perceptual_hashes = self.parser.deduplicate_figures or self.parser.figure_index is not None
+        job.crops = self._crop_pool.submit(
+            crop_figures,
+            file_path,
+            job.analysis.figures,
+            self.output_folder,
+            self.dpi,
+            with_image_hashes,
+            self.parser.image_encoding,
+            self.parser.save_images,
+            with_perceptual_hashes=with_perceptual_hashes,
+            content=job.analysis.content if with_perceptual_hashes else None,
+            with_entropy=self.parser.skip_decorative,
+        ).result()
+        job.result.figures = len(job.analysis.figures or [])
+        # The figures are cropped in worker processes, their size is recorded on the stage span
+        current_span().set(figures=job.result.figures, bytes=sum(len(crop.data_url) for crop in job.crops))
+
+    def _describe(self, job: _FileJob) -> None:
+        describe_figures(
+            job.crops,
+            description_cache=self.parser.description_cache,
+            executor=self._description_pool,
+            client=self.parser.vision_client,
+            figure_index=self.parser.figure_index,
+            skip_decorative=self.parser.skip_decorative,
+        )
+
+    def _split(self, job: _FileJob) -> None:
+        file_path = job.result.file_path
+        md_content, fig_metadata = assemble_figures(file_path, job.analysis, job.crops, self.output_folder, self.parser.save_images)
+        # Release the analysis and the crops, only the chunks move on
+        job.analysis, job.crops = None, []
+        doc = Document(page_content=md_content, metadata={"images": fig_metadata})
+        job.docs = advanced_text_splitter([doc], os.path.basename(file_path), self.image_store)
+        job.result.chunks = len(job.docs)
+
+    def _index(self, job: _FileJob) -> None:
+        if self.manifest is not None:
+            counts = index_documents(
+                self.vector_store,
+                job.docs,
+                source_name(job.result.file_path, self.source_root),
+                self.manifest,
+                job.file_hash,
+                self.embeddings,
+                self.embed_batch_size,
+                self.upload_batch_size,
+            )
+            job.result.added, job.result.deleted = counts["added"], counts["deleted"]
+        elif job.docs:
+            add_documents(self.vector_store, job.docs, None, self.embeddings, self.embed_batch_size, self.upload_batch_size)
+            job.result.added = len(job.docs)
+        job.docs = []
+
+    # Plumbing
+    def _stage_worker(self, stage: str, run: Callable[[_FileJob], None], in_queue: queue.Queue, out_queue: queue.Queue, exited: List[int], lock: threading.Lock) -> None:
+        while True:
+            job = in_queue.get()
+            if job is _DONE:
+                break
+            if job.result.error is None and not job.skip:
+                job.result.stage = stage
+                start = time.perf_counter()
+                try:
+                    with span(f"pipeline.{stage}", file=os.path.basename(job.result.file_path)):
+                        run(job)
+                except Exception as e:
+                    job.result.error = f"{type(e).__name__}: {e}"
+                job.result.timings[stage] = time.perf_counter() - start
+            out_queue.put(job)
+        # The last worker of the stage closes the next queue
+        with lock:
+            exited[0] += 1
+            if exited[0] == self.workers[stage]:
+                for _ in range(self.workers.get(self._next_stage(stage), 1)):
+                    out_queue.put(_DONE)
+
+    @staticmethod
+    def _next_stage(stage: str) -> Optional[str]:
+        index = STAGES.index(stage) + 1
+        return STAGES[index] if index < len(STAGES) else None
+
+    @staticmethod
+    def _print_progress(result: FileResult) -> None:
+        if result.status == "indexed":
+            print(f"Indexed: {result.file_path} ({result.figures} figures, {result.chunks} chunks, {result.added} added, {result.deleted} deleted, {sum(result.timings.values()):.1f}s)")
+        elif result.status == "unchanged":
+            print(f"Unchanged: {result.file_path}")
+        else:
+            print(f"Failed: {result.file_path} at stage {result.stage}: {result.error}")
+
+    def run(self, files: List[str]) -> List[FileResult]:
+        """Ingest the files and return the result of each file (in the order of the files)."""
+        runs = {
+            "analyze": self._analyze,
+            "crop": self._crop,
+            "describe": self._describe,
+            "split": self._split,
+            "index": self._index,
+        }
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(STAGES) + 1)]
+        results = [FileResult(file_path=f) for f in files]
+        threads = []
+        with ProcessPoolExecutor(max_workers=self.workers["crop"], mp_context=multiprocessing.get_context(CROP_START_METHOD)) as self._crop_pool, \
+                ThreadPoolExecutor(max_workers=self.description_workers) as self._description_pool:
+            for i, stage in enumerate(STAGES):
+                # All the workers of a stage share the same exit counter
+                exited, lock = [0], threading.Lock()
+                for _ in range(self.workers[stage]):
+                    thread = threading.Thread(
+                        target=self._stage_worker,
+                        args=(stage, runs[stage], queues[i], queues[i + 1], exited, lock),
+                        daemon=True,
+                    )
+                    threads.append(thread)
+            for thread in threads:
+                thread.start()
+
+            def feed() -> None:
+                for result in results:
+                    queues[0].put(_FileJob(result=result))
+                for _ in range(self.workers[STAGES[0]]):
+                    queues[0].put(_DONE)
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+
+            # Collect the files coming out of the last stage
+            while True:
+                job = queues[-1].get()
+                if job is _DONE:
+                    break
+                job.result.status = "failed" if job.result.error else "unchanged" if job.skip else "indexed"
+                self.progress(job.result)
+            feeder.join()
+            for thread in threads:
+                thread.join()
+        # The local store is saved once all the files are indexed
+        if isinstance(self.vector_store, LocalVectorStore) and self.vector_store.folder:
+            self.vector_store.save()
+        self._crop_pool = self._description_pool = None
+        return results
+
+
+#########################################################
+# List the files to ingest
+# Args:
+#   - paths: files, folders or glob patterns
+#   - pattern: glob pattern of the files inside the folders
+# Returns:
+#   - sorted list of files
+#########################################################
+def list_files(paths: List[str], pattern: str = "*.pdf") -> List[str]:
+    files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            files.update(glob.glob(os.path.join(path, pattern)))
+        else:
+            files.update(glob.glob(path))
+    return sorted(f for f in files if os.path.isfile(f))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(prog="python -m its_a_rag.pipeline", description="Ingest documents into the multimodal vector store.")
+    parser.add_argument("paths", nargs="+", help="files, folders or glob patterns to ingest")
+    parser.add_argument("--pattern", default="*.pdf", help="glob pattern of the files inside the folders (default: *.pdf)")
+    parser.add_argument("--index-name", default=os.getenv("AZURE_SEARCH_INDEX"), help="Azure Search index (default: $AZURE_SEARCH_INDEX)")
+    parser.add_argument("--analysis-workers", type=int, default=4)
+    parser.add_argument("--shard-pages", type=int, help="analyze the PDFs longer than this number of pages by page ranges of this size, concurrently")
+    parser.add_argument("--shard-concurrency", type=int, default=SHARD_CONCURRENCY, help="page ranges of a PDF analyzed at the same time")
+    parser.add_argument("--crop-workers", type=int, default=None)
+    parser.add_argument("--description-workers", type=int, default=8)
+    parser.add_argument("--split-workers", type=int, default=2)
+    parser.add_argument("--index-workers", type=int, default=2)
+    parser.add_argument("--queue-size", type=int, default=4)
+    parser.add_argument("--local-store", nargs="?", const=LOCAL_STORE_FOLDER, help=f"index into a local vector store in this folder instead of Azure Search (default folder: {LOCAL_STORE_FOLDER})")
+    parser.add_argument("--quantize", action="store_true", help="with --local-store, store the vectors as int8")
+    parser.add_argument("--embedding-dimensions", type=int, default=os.getenv("AZURE_OPENAI_EMBEDDING_DIMENSIONS"), help="dimension of the embedding vectors (default: $AZURE_OPENAI_EMBEDDING_DIMENSIONS, else cached per deployment)")
+    parser.add_argument("--embed-batch-size", type=int, default=EMBED_BATCH_SIZE, help="distinct chunk texts per embedding request")
+    parser.add_argument("--upload-batch-size", type=int, default=UPLOAD_BATCH_SIZE, help="chunks per upload to the index")
+    parser.add_argument("--output-folder", default=IMAGE_STORE_FOLDER)
+    parser.add_argument("--image-format", default="PNG", choices=["PNG", "JPEG", "WEBP"], help="format of the images sent to the vision model")
+    parser.add_argument("--image-quality", type=int, default=85, help="quality of the JPEG / WEBP images")
+    parser.add_argument("--image-max-size", type=int, nargs=2, metavar=("WIDTH", "HEIGHT"), help="maximum size of the images sent to the vision model")
+    parser.add_argument("--dedup-figures", action="store_true", help="reuse the description of the near-duplicate figures of a document")
+    parser.add_argument("--figure-index", nargs="?", const=FIGURE_INDEX_PATH, help=f"reuse the description of the near-duplicate figures of the previously ingested documents, indexed in this database (default: {FIGURE_INDEX_PATH})")
+    parser.add_argument("--skip-decorative", action="store_true", help="do not describe the small or plain figures without caption (logos, icons, rules)")
+    parser.add_argument("--no-save-images", action="store_true", help="do not save the cropped images, the figure descriptions and the Markdown in the output folder")
+    parser.add_argument("--image-store", default=IMAGE_STORE_PATH, help="folder of the image store referenced by the index")
+    parser.add_argument("--inline-images", action="store_true", help="store the image data URLs in the index instead of the image store")
+    parser.add_argument("--manifest", help="chunk manifest for incremental indexing (only new chunks are uploaded, stale chunks are deleted)")
+    parser.add_argument("--force", action="store_true", help="with --manifest, process the files even if they did not change")
+    parser.add_argument("--source-root", help="with --manifest, folder the files are named relative to in the manifest (default: the current folder)")
+    parser.add_argument("--index-version", default=os.getenv(INDEX_VERSION_ENV), help=f"publish a new index version to this file when the index changed, the chat app clears its cached answers when it changes (default: ${INDEX_VERSION_ENV})")
+    parser.add_argument("--vision-rpm", type=float, default=os.getenv("AZURE_OPENAI_VISION_RPM"), help="requests per minute quota of the vision deployment (default: $AZURE_OPENAI_VISION_RPM)")
+    parser.add_argument("--vision-tpm", type=float, default=os.getenv("AZURE_OPENAI_VISION_TPM"), help="tokens per minute quota of the vision deployment (default: $AZURE_OPENAI_VISION_TPM)")
+    parser.add_argument("--embedding-rpm", type=float, default=os.getenv("AZURE_OPENAI_EMBEDDING_RPM"), help="requests per minute quota of the embedding deployment (default: $AZURE_OPENAI_EMBEDDING_RPM)")
+    parser.add_argument("--embedding-tpm", type=float, default=os.getenv("AZURE_OPENAI_EMBEDDING_TPM"), help="tokens per minute quota of the embedding deployment (default: $AZURE_OPENAI_EMBEDDING_TPM)")
+    parser.add_argument("--report", help="write the per-file results to this JSON lines file")
+    parser.add_argument("--telemetry", help="write the spans and counters of the stages to this JSON lines file")
+    parser.add_argument("--otel", action="store_true", help="export the spans and counters through OpenTelemetry (configured by the environment)")
+    args = parser.parse_args(argv)
+
+    if not args.index_name:
+        parser.error("--index-name is required (or set AZURE_SEARCH_INDEX)")
+    files = list_files(args.paths, args.pattern)
+    if not files:
+        parser.error("no file to ingest")
+
+    # Requests scheduled within the quotas of the deployments (the vision client of the environment otherwise)
+    vision_limiter = get_rate_limiter(os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME") or "vision", args.vision_rpm, args.vision_tpm)
+    embedding_limiter = get_rate_limiter(os.getenv("AZURE_OPENAI_EMBEDDING") or "embedding", args.embedding_rpm, args.embedding_tpm)
+    image_store = None if args.inline_images else LocalImageStore(args.image_store)
+    doc_parser = AzureAIDocumentIntelligenceParser(
+        api_endpoint=os.getenv("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT"),
+        api_key=os.getenv("AZURE_DOCUMENT_INTELLIGENCE_API_KEY"),
+        api_version=os.getenv("AZURE_DOCUMENT_INTELLIGENCE_API_VERSION"),
+        api_model="prebuilt-layout",
+        analysis_features=["ocrHighResolution"],
+        image_encoding=ImageEncoding(args.image_format, args.image_quality, tuple(args.image_max_size) if args.image_max_size else None),
+        save_images=not args.no_save_images,
+        vision_client=VisionClient.from_env(rate_limiter=vision_limiter) if vision_limiter else None,
+        shard_pages=args.shard_pages,
+        shard_concurrency=args.shard_concurrency,
+        deduplicate_figures=args.dedup_figures,
+        figure_index=FigureIndex(args.figure_index, image_store=image_store) if args.figure_index else None,
+        skip_decorative=args.skip_decorative,
+    )
+    vector_store, embeddings = create_multimodal_vector_store(
+        args.index_name,
+        os.getenv("AZURE_OPENAI_API_KEY"),
+        os.getenv("AZURE_OPENAI_ENDPOINT"),
+        os.getenv("AZURE_OPENAI_API_VERSION"),
+        os.getenv("AZURE_OPENAI_EMBEDDING"),
+        os.getenv("AZURE_SEARCH_ENDPOINT"),
+        os.getenv("AZURE_SEARCH_API_KEY"),
+        embedding_dimensions=args.embedding_dimensions,
+        dimensions_cache=EmbeddingDimensionCache(),
+        lazy=True,
+        local_store_folder=args.local_store,
+        quantize=args.quantize,
+        rate_limiter=embedding_limiter,
+    )
+    pipeline = IngestionPipeline(
+        doc_parser,
+        vector_store,
+        analysis_workers=args.analysis_workers,
+        crop_workers=args.crop_workers,
+        description_workers=args.description_workers,
+        split_workers=args.split_workers,
+        index_workers=args.index_workers,
+        queue_size=args.queue_size,
+        output_folder=args.output_folder,
+        manifest=ChunkManifest(args.manifest) if args.manifest else None,
+        skip_unchanged=not args.force,
+        source_root=args.source_root,
+        embeddings=embeddings,
+        embed_batch_size=args.embed_batch_size,
+        upload_batch_size=args.upload_batch_size,
+        image_store=image_store,
+    )
+
+    sink = OpenTelemetrySink() if args.otel else JsonLinesSink(args.telemetry) if args.telemetry else None
+    set_telemetry_sink(sink)
+
+    print(f"Ingesting {len(files)} files into {args.index_name}...")
+    start = time.perf_counter()
+    try:
+        results = pipeline.run(files)
+    finally:
+        set_telemetry_sink(None)
+        if sink is not None:
+            sink.close()
+    failed = [r for r in results if r.status == "failed"]
+    unchanged = [r for r in results if r.status == "unchanged"]
+    print(f"Done in {time.perf_counter() - start:.1f}s: {len(results) - len(failed) - len(unchanged)} indexed, {len(unchanged)} unchanged, {len(failed)} failed")
+    if args.index_version and any(r.added or r.deleted for r in results):
+        print(f"Published index version {publish_index_version(args.index_version, args.index_name)} to {args.index_version}")
+
+    if args.report:
+        with open(args.report, "w") as f:
+            for result in results:
+                f.write(json.dumps(asdict(result)) + "\n")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,395 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: rate_limit.py
+# Description: Rate-limit-aware scheduler of the Azure OpenAI requests (requests and tokens per minute),
+#              with priority lanes and Retry-After aware retries, usable from threads and asyncio.
+# Version: 2025-02-03
+# Author: Francesco Sodano
+#-----------------------------------------------------------------------------------------------------------
+
+from __future__ import annotations
+import asyncio
+import email.utils
+import heapq
+import itertools
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import openai
+from langchain_core.embeddings import Embeddings
+
+from .context import count_tokens, estimate_image_url_tokens
+
+# Priority lanes (the lowest value goes first)
+INTERACTIVE = 0
+BULK = 1
+
+# Azure OpenAI enforces the quotas over short windows: the buckets hold this many seconds of quota
+BURST_SECONDS = 10
+
+# Retries of a throttled or failed request
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# Polling interval of the asyncio waiters that are not at the head of the queue
+ASYNC_POLL_INTERVAL = 0.01
+
+# Tokens added per chat message by the chat format
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+#########################################################
+# Estimate the tokens of a chat completion request as the quota counts
+# them: the prompt (texts and images) plus max_tokens
+# Args:
+#   - messages: chat messages (OpenAI format)
+#   - max_tokens: maximum number of tokens of the completion
+#   - image_detail: detail level of the images ("low", "high" or "auto")
+# Returns:
+#   - estimated number of tokens
+#########################################################
+def estimate_chat_tokens(messages: List[dict], max_tokens: int = 0, image_detail: str = "auto") -> int:
+    tokens = max_tokens
+    for message in messages:
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            tokens += count_tokens(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                tokens += count_tokens(part["text"])
+            elif part.get("type") == "image_url":
+                url = part["image_url"]["url"]
+                tokens += estimate_image_url_tokens(url, image_detail)
+    return tokens
+
+
+#########################################################
+# Estimate the tokens of texts sent to the embedding model
+#########################################################
+def estimate_embedding_tokens(texts: List[str]) -> int:
+    return sum(count_tokens(text) for text in texts)
+
+
+#########################################################
+# Get the delay requested by a throttled response (retry-after-ms or
+# retry-after headers), or None
+#########################################################
+def retry_after(error: BaseException) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for name in ("retry-after-ms", "x-ms-retry-after-ms"):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # HTTP date (a malformed value is ignored: the backoff applies)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+#########################################################
+# Get the HTTP status of a failed request, or None
+#########################################################
+def error_status(error: BaseException) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+#########################################################
+# Check whether a failed request can be retried (throttled, server error, connection error)
+#########################################################
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    status = error_status(error)
+    return status is not None and (status in (408, 429) or status >= 500)
+
+
+#########################################################
+# Class: Token Bucket
+# Refilled continuously at per_minute / 60 per second, holding at most
+# burst_seconds of quota. A request larger than the bucket is let through
+# when the bucket is full and leaves it in debt.
+#########################################################
+class TokenBucket:
+    def __init__(self, per_minute: float, burst_seconds: float = BURST_SECONDS) -> None:
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, per_minute * burst_seconds / 60)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Return the seconds until amount can be taken (0 if it can be taken now)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.level -= amount
+
+    def give(self, amount: float) -> None:
+        self.level = min(self.capacity, self.level + amount)
+
+
+#########################################################
+# Class: Rate Limiter
+# Shared scheduler of the requests of a deployment: a request waits until
+# it is the first of the queue (priority lane, then arrival order) and both
+# the request and the token buckets can take it. A throttled response
+# pauses the whole limiter for its Retry-After delay (plus jitter), the
+# other failures are retried with jittered exponential backoff.
+# Args:
+#   - requests_per_minute: request quota (None: unlimited)
+#   - tokens_per_minute: token quota (None: unlimited)
+#   - burst_seconds: seconds of quota the buckets hold
+#   - max_retries: retries of a throttled or failed request
+#   - backoff_base, backoff_max: exponential backoff without Retry-After (seconds)
+#   - seed: seed of the jitter
+#########################################################
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        burst_seconds: float = BURST_SECONDS,
+        max_retries: int = MAX_RETRIES,
+        backoff_base: float = BACKOFF_BASE,
+        backoff_max: float = BACKOFF_MAX,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.requests = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.granted = 0
+        self.throttled = 0
+        self.retried = 0
+        self._cond = threading.Condition()
+        self._queue: List[tuple] = []            # heap of (priority, arrival) tickets
+        self._arrivals = itertools.count()
+        self._paused_until = 0.0
+        self._rng = random.Random(seed)
+
+    # Scheduling
+    def _wait_time(self, ticket: tuple, tokens: float) -> Optional[float]:
+        # None: wait for the tickets ahead to be granted
+        if self._queue[0] != ticket:
+            return None
+        now = time.monotonic()
+        wait = self._paused_until - now
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return max(0.0, wait)
+
+    def _grant(self, tokens: float) -> None:
+        heapq.heappop(self._queue)
+        if self.requests is not None:
+            self.requests.take(1)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+        self.granted += 1
+        self._cond.notify_all()
+
+    def _cancel(self, ticket: tuple) -> None:
+        with self._cond:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+
+    def acquire(self, tokens: float = 0, priority: int = BULK) -> None:
+        """Wait until a request of this many tokens can be sent."""
+        ticket = (priority, next(self._arrivals))
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            try:
+                while True:
+                    wait = self._wait_time(ticket, tokens)
+                    if wait == 0:
+                        self._grant(tokens)
+                        return
+                    self._cond.wait(wait)
+            except BaseException:
+                self._queue.remove(ticket)
+                heapq.heapify(self._queue)
+                self._cond.notify_all()
+                raise
+
+    async def aacquire(self, tokens: float = 0, priority: int = BULK) -> None:
+        """Async acquire: waits without blocking the event loop."""
+        ticket = (priority, next(self._arrivals))
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._wait_time(ticket, tokens)
+                    if wait == 0:
+                        self._grant(tokens)
+                        return
+                await asyncio.sleep(ASYNC_POLL_INTERVAL if wait is None else wait)
+        except BaseException:
+            self._cancel(ticket)
+            raise
+
+    def settle(self, estimated: float, actual: float) -> None:
+        """Correct the token bucket with the actual usage of a request."""
+        if self.tokens is None:
+            return
+        with self._cond:
+            if actual > estimated:
+                self.tokens.take(actual - estimated)
+            else:
+                self.tokens.give(estimated - actual)
+                self._cond.notify_all()
+
+    def pause(self, delay: float) -> None:
+        """Hold all the requests for delay seconds and empty the buckets (throttled by the service)."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            # The service saw more than the buckets did (other clients of the deployment): start again from empty buckets
+            for bucket in (self.requests, self.tokens):
+                if bucket is not None:
+                    bucket.level = min(bucket.level, 0.0)
+            self._cond.notify_all()
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        """Return the delay before retrying a failed request: the Retry-After delay (if any) plus an
+        exponential backoff with full jitter, so the throttled requests do not all retry at once."""
+        jitter = self._rng.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return (retry_after(error) or 0.0) + jitter
+
+    def _on_error(self, attempt: int, error: BaseException) -> Optional[float]:
+        # Returns the delay before the retry, or None to raise the error
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        self.retried += 1
+        delay = self.backoff(attempt, error)
+        if error_status(error) == 429:
+            # The other requests wait for the Retry-After delay, the retry also waits its jitter
+            self.throttled += 1
+            requested = retry_after(error)
+            self.pause(requested if requested is not None else delay)
+        return delay
+
+    # Requests
+    def call(self, fn: Callable[[], Any], tokens: float = 0, priority: int = BULK, usage: Optional[Callable[[Any], Optional[float]]] = None) -> Any:
+        """Send a request through the limiter, retrying it when it is throttled or fails transiently.
+        usage optionally returns the actual tokens of the result."""
+        for attempt in itertools.count():
+            self.acquire(tokens, priority)
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._on_error(attempt, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            if usage is not None:
+                actual = usage(result)
+                if actual is not None:
+                    self.settle(tokens, actual)
+            return result
+
+    async def acall(self, fn: Callable[[], Awaitable[Any]], tokens: float = 0, priority: int = BULK, usage: Optional[Callable[[Any], Optional[float]]] = None) -> Any:
+        """Async call: fn returns the awaitable of the request."""
+        for attempt in itertools.count():
+            await self.aacquire(tokens, priority)
+            try:
+                result = await fn()
+            except Exception as e:
+                delay = self._on_error(attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            if usage is not None:
+                actual = usage(result)
+                if actual is not None:
+                    self.settle(tokens, actual)
+            return result
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+#########################################################
+# Get the rate limiter shared by the clients of a deployment
+# The registry is per process: the clients of the threads and event loops
+# of a process share the budget, separate processes (several chat-app
+# workers, an ingestion running next to the chat app) do not. Each process
+# must then be given its share of the deployment quota.
+# Args:
+#   - name: name of the deployment
+#   - requests_per_minute, tokens_per_minute: quotas of the deployment, numbers or strings
+#     (environment variables), used when the limiter is created
+# Returns:
+#   - the RateLimiter of the deployment, or None if it has none and no quota is given
+#########################################################
+def get_rate_limiter(name: str, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None) -> Optional[RateLimiter]:
+    requests_per_minute = float(requests_per_minute) if requests_per_minute else None
+    tokens_per_minute = float(tokens_per_minute) if tokens_per_minute else None
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(name)
+        if limiter is None and (requests_per_minute or tokens_per_minute):
+            limiter = _rate_limiters[name] = RateLimiter(requests_per_minute, tokens_per_minute)
+        return limiter
+
+
+#########################################################
+# Class: Rate Limited Embeddings
+# Embeddings wrapper sending the requests through a RateLimiter: the
+# queries in the interactive lane, the documents in the bulk lane.
+# Args:
+#   - embeddings: embedding model
+#   - rate_limiter: RateLimiter of the embedding deployment
+#   - query_priority: lane of embed_query
+#   - document_priority: lane of embed_documents
+#########################################################
+class RateLimitedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, rate_limiter: RateLimiter, query_priority: int = INTERACTIVE, document_priority: int = BULK) -> None:
+        self.embeddings = embeddings
+        self.rate_limiter = rate_limiter
+        self.query_priority = query_priority
+        self.document_priority = document_priority
+        self.deployment = getattr(embeddings, "deployment", None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.rate_limiter.call(lambda: self.embeddings.embed_documents(texts), estimate_embedding_tokens(texts), self.document_priority)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.rate_limiter.acall(lambda: self.embeddings.aembed_documents(texts), estimate_embedding_tokens(texts), self.document_priority)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.rate_limiter.call(lambda: self.embeddings.embed_query(text), count_tokens(text), self.query_priority)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.rate_limiter.acall(lambda: self.embeddings.aembed_query(text), count_tokens(text), self.query_priority)
@@ -0,0 +1,288 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: semantic_cache.py
+# Description: Semantic cache of the answers, keyed on the question embedding.
+# Version: 2025-02-03
+# Author: Francesco Sodano
+#-----------------------------------------------------------------------------------------------------------
+
+from __future__ import annotations
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Union
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from .indexing import INDEX_VERSION_ENV
+
+# Minimum cosine similarity between two questions for the cached answer to be reused
+SIMILARITY_THRESHOLD = 0.95
+
+# Lifetime of a cached answer, in seconds
+CACHE_TTL = 24 * 3600
+
+# Maximum number of cached answers (the least recently used are evicted)
+CACHE_MAX_ENTRIES = 1000
+
+# Embeddings of the questions that missed, kept until their answer is stored
+PENDING_EMBEDDINGS = 256
+
+logger = logging.getLogger(__name__)
+
+
+#########################################################
+# Normalize a question for the exact match (case and whitespace)
+#########################################################
+def normalize_question(question: str) -> str:
+    return " ".join(question.casefold().split())
+
+
+#########################################################
+# Numbers of a question (years, amounts): two questions that only differ
+# by a year are very similar for the embedding model but have different answers
+#########################################################
+def question_numbers(question: str) -> tuple:
+    return tuple(sorted(set(re.findall(r"\d+(?:[.,]\d+)*", question))))
+
+
+#########################################################
+# Version of a file (modification time, size and inode), or None if it does not exist
+# e.g. the index version file, rewritten every time the index changes (the files
+# replaced by a rename get a new inode even within the time resolution of the file system)
+#########################################################
+def file_version(path: str) -> Optional[tuple]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+#########################################################
+# Get the version of the index from the configuration: the file named by the
+# environment variable, published by the ingestion pipeline next to the index
+# (see indexing.publish_index_version)
+# Args:
+#   - env_var: environment variable of the path of the file
+# Returns:
+#   - function returning the current version of the index, or None (with a warning)
+#     when the variable is not set or the file does not exist: the answers must not be cached
+#########################################################
+def index_version_from_env(env_var: str = INDEX_VERSION_ENV) -> Optional[Callable[[], Any]]:
+    path = os.getenv(env_var)
+    if not path:
+        logger.warning("%s is not set: no index version to invalidate the cached answers, they are not cached", env_var)
+        return None
+    if not os.path.exists(path):
+        logger.warning("Index version file %s (%s) not found: no index version to invalidate the cached answers, they are not cached", path, env_var)
+        return None
+    return partial(file_version, path)
+
+
+#########################################################
+# Replay a cached answer as a stream of chunks
+# Args:
+#   - answer: cached answer
+# Returns:
+#   - async iterator of the words of the answer (with their trailing whitespace)
+#########################################################
+async def replay_answer(answer: str) -> AsyncIterator[str]:
+    for chunk in re.findall(r"\s+|\S+\s*", answer):
+        yield chunk
+        await asyncio.sleep(0)
+
+
+#########################################################
+# Class: Semantic Cache
+# Cache of the answers keyed on the question: an exact match of the
+# normalized question first, then the most similar cached question
+# (cosine similarity of the embeddings above the threshold, with the same
+# numbers in the question). The entries
+# expire after ttl seconds, the least recently used are evicted above
+# max_entries, and the whole cache is cleared when the index version changes.
+# Args:
+#   - embedding_function: Embeddings object or embedding function of a text
+#   - threshold: minimum cosine similarity to reuse an answer
+#   - ttl: lifetime of an answer in seconds
+#   - max_entries: maximum number of answers
+#   - index_version: optional function returning the current version of the index
+#########################################################
+class SemanticCache:
+    def __init__(
+        self,
+        embedding_function: Union[Embeddings, Callable[[str], List[float]]],
+        threshold: float = SIMILARITY_THRESHOLD,
+        ttl: float = CACHE_TTL,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        index_version: Optional[Callable[[], Any]] = None,
+    ) -> None:
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.index_version = index_version
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._version = index_version() if index_version else None
+        self._entries: OrderedDict = OrderedDict()   # slot -> (question, answer, created), least recently used first
+        self._exact: Dict[str, int] = {}              # normalized question -> slot
+        self._vectors: Optional[np.ndarray] = None    # slot -> normalized embedding
+        self._live = np.zeros(max_entries, dtype=bool)
+        self._pending: OrderedDict = OrderedDict()    # normalized question -> embedding
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # Embedding
+    def embed(self, question: str) -> List[float]:
+        """Return the embedding of a question."""
+        if isinstance(self.embedding_function, Embeddings):
+            return self.embedding_function.embed_query(question)
+        return self.embedding_function(question)
+
+    async def aembed(self, question: str) -> List[float]:
+        """Return the embedding of a question without blocking the event loop."""
+        if isinstance(self.embedding_function, Embeddings):
+            return await self.embedding_function.aembed_query(question)
+        return await asyncio.to_thread(self.embedding_function, question)
+
+    # Lookup
+    def _check_version(self) -> None:
+        if self.index_version is None:
+            return
+        version = self.index_version()
+        if version != self._version:
+            self.clear()
+            self._version = version
+
+    def _expired(self, slot: int, now: float) -> bool:
+        return now - self._entries[slot][2] > self.ttl
+
+    def _remove(self, slot: int) -> None:
+        question = self._entries.pop(slot)[0]
+        self._exact.pop(normalize_question(question), None)
+        self._live[slot] = False
+
+    def _lookup_exact(self, key: str) -> Optional[str]:
+        slot = self._exact.get(key)
+        if slot is None:
+            return None
+        if self._expired(slot, time.time()):
+            self._remove(slot)
+            return None
+        self._entries.move_to_end(slot)
+        return self._entries[slot][1]
+
+    def _lookup_similar(self, vector: np.ndarray, numbers: tuple) -> Optional[str]:
+        if self._vectors is None or not self._entries:
+            return None
+        slots = np.flatnonzero(self._live)
+        scores = self._vectors[slots] @ vector
+        now = time.time()
+        for i in np.argsort(-scores):
+            if scores[i] < self.threshold:
+                return None
+            slot = int(slots[i])
+            if self._expired(slot, now):
+                self._remove(slot)
+                continue
+            if question_numbers(self._entries[slot][0]) != numbers:
+                continue
+            self._entries.move_to_end(slot)
+            return self._entries[slot][1]
+        return None
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, question: str, embedding: Optional[List[float]] = None) -> Optional[str]:
+        """Return the cached answer of the question (or of a similar question), or None."""
+        key = normalize_question(question)
+        with self._lock:
+            self._check_version()
+            answer = self._lookup_exact(key)
+        if answer is None:
+            if embedding is None:
+                embedding = self.embed(question)
+            with self._lock:
+                answer = self._lookup_similar(self._normalize(embedding), question_numbers(question))
+                if answer is None:
+                    # Kept so that put does not embed the question again
+                    self._pending[key] = embedding
+                    while len(self._pending) > PENDING_EMBEDDINGS:
+                        self._pending.popitem(last=False)
+        self._count(answer)
+        return answer
+
+    async def aget(self, question: str) -> Optional[str]:
+        """Async get: the question is embedded without blocking the event loop."""
+        key = normalize_question(question)
+        with self._lock:
+            self._check_version()
+            answer = self._lookup_exact(key)
+        if answer is not None:
+            self._count(answer)
+            return answer
+        return self.get(question, await self.aembed(question))
+
+    def _count(self, answer: Optional[str]) -> None:
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+    # Update
+    def put(self, question: str, answer: str, embedding: Optional[List[float]] = None) -> None:
+        """Cache the answer of a question."""
+        key = normalize_question(question)
+        with self._lock:
+            embedding = embedding if embedding is not None else self._pending.pop(key, None)
+        if embedding is None:
+            embedding = self.embed(question)
+        vector = self._normalize(embedding)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            slot = self._exact.get(key)
+            if slot is not None:
+                self._remove(slot)
+            elif len(self._entries) >= self.max_entries:
+                self._remove(next(iter(self._entries)))
+            slot = int(np.flatnonzero(~self._live)[0])
+            self._vectors[slot] = vector
+            self._live[slot] = True
+            self._entries[slot] = (question, answer, time.time())
+            self._exact[key] = slot
+
+    def clear(self) -> None:
+        """Remove all the cached answers."""
+        with self._lock:
+            self._entries.clear()
+            self._exact.clear()
+            self._pending.clear()
+            self._live[:] = False
+
+    # Streaming
+    async def astream(self, question: str, stream: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """Replay the cached answer of the question, or stream the answer and cache it once complete."""
+        answer = await self.aget(question)
+        if answer is not None:
+            async for chunk in replay_answer(answer):
+                yield chunk
+            return
+        chunks = []
+        async for chunk in stream():
+            chunks.append(chunk)
+            yield chunk
+        self.put(question, "".join(chunks))
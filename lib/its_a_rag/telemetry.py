@@ -0,0 +1,306 @@
+#-----------------------------------------------------------------------------------------------------------
+# IT'S A RAG - Hackathon
+# Name: telemetry.py
+# Description: Per-stage spans and counters of the ingestion, exported through a pluggable sink
+#              (JSON lines file, OpenTelemetry, in memory). Without a sink the instrumentation is a no-op.
+# Version: 2025-02-03
+# Author: Francesco Sodano
+#-----------------------------------------------------------------------------------------------------------
+
+from __future__ import annotations
+import contextvars
+import itertools
+import json
+import os
+import statistics
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+
+#########################################################
+# Class: Telemetry Sink
+# Receives the finished spans and the counters. The spans are dictionaries:
+# id, parent (id of the enclosing span of the same thread), name, start
+# (epoch seconds), duration (seconds), attributes, error, thread.
+# Sinks that need the spans as they open (e.g. to nest them) also get
+# start, with the id, parent, name, start and attributes of the span.
+#########################################################
+class TelemetrySink:
+    def start(self, record: Dict[str, Any]) -> None:
+        """Receive a span that opens (the enclosing spans are already open)."""
+
+    def span(self, record: Dict[str, Any]) -> None:
+        """Export a finished span."""
+
+    def counter(self, name: str, value: float, attributes: Dict[str, Any]) -> None:
+        """Export a counter increment."""
+
+    def close(self) -> None:
+        """Flush and release the sink."""
+
+
+#########################################################
+# Class: JSON Lines Sink
+# Appends one JSON object per span or counter to a file
+# (type "span" or "counter").
+# Args:
+#   - path: path of the JSON lines file
+#########################################################
+class JsonLinesSink(TelemetrySink):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def span(self, record: Dict[str, Any]) -> None:
+        self._write({"type": "span", **record})
+
+    def counter(self, name: str, value: float, attributes: Dict[str, Any]) -> None:
+        self._write({"type": "counter", "name": name, "value": value, "time": time.time(), "attributes": attributes})
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+#########################################################
+# Class: Memory Sink
+# Keeps the spans and the counters in memory, with a summary per stage
+# (benchmarks, notebooks).
+#########################################################
+class MemorySink(TelemetrySink):
+    def __init__(self) -> None:
+        self.spans: List[Dict[str, Any]] = []
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def span(self, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self.spans.append(record)
+
+    def counter(self, name: str, value: float, attributes: Dict[str, Any]) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Return the number, total, median and maximum duration of the spans of each name."""
+        durations: Dict[str, List[float]] = {}
+        for record in self.spans:
+            durations.setdefault(record["name"], []).append(record["duration"])
+        return {
+            name: {"count": len(values), "total": sum(values), "median": statistics.median(values), "max": max(values)}
+            for name, values in durations.items()
+        }
+
+    def slowest(self, name: str, n: int = 10, by: str = "file") -> List[tuple]:
+        """Return the n values of an attribute (e.g. the files) with the most time spent in the spans of a name."""
+        totals: Dict[Any, float] = {}
+        for record in self.spans:
+            if record["name"] == name and by in record["attributes"]:
+                key = record["attributes"][by]
+                totals[key] = totals.get(key, 0.0) + record["duration"]
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:n]
+
+
+#########################################################
+# Class: OpenTelemetry Sink
+# Exports the spans as OpenTelemetry spans (with their real start and end
+# times) plus a duration histogram per span name, and the counters as
+# OpenTelemetry counters. Each OpenTelemetry span starts when its span
+# opens, in the context of the OpenTelemetry span of its parent (or in the
+# current OpenTelemetry context for the outermost spans), so the traces keep
+# the nesting of the stages. Requires the opentelemetry-api package; the
+# providers and exporters are configured by the application.
+# Args:
+#   - tracer_provider: optional TracerProvider (default: the global one)
+#   - meter_provider: optional MeterProvider (default: the global one)
+#########################################################
+class OpenTelemetrySink(TelemetrySink):
+    def __init__(self, tracer_provider: Any = None, meter_provider: Any = None) -> None:
+        try:
+            from opentelemetry import metrics, trace
+        except ImportError as e:
+            raise ImportError("OpenTelemetrySink requires the opentelemetry-api package (pip install opentelemetry-api opentelemetry-sdk)") from e
+        self._tracer = trace.get_tracer("its_a_rag", tracer_provider=tracer_provider)
+        self._meter = metrics.get_meter("its_a_rag", meter_provider=meter_provider)
+        self._duration = self._meter.create_histogram("its_a_rag.span.duration", unit="s", description="Duration of the ingestion spans")
+        self._counters: Dict[str, Any] = {}
+        self._open: Dict[int, Any] = {}     # span id -> OpenTelemetry span, until it ends
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _attributes(attributes: Dict[str, Any]) -> Dict[str, Any]:
+        # OpenTelemetry attributes are str, bool, int or float
+        return {key: value if isinstance(value, (str, bool, int, float)) else str(value) for key, value in attributes.items() if value is not None}
+
+    def start(self, record: Dict[str, Any]) -> None:
+        from opentelemetry import trace
+        with self._lock:
+            parent = self._open.get(record["parent"])
+        context = trace.set_span_in_context(parent) if parent is not None else None
+        otel_span = self._tracer.start_span(record["name"], context=context, start_time=int(record["start"] * 1e9), attributes=self._attributes(record["attributes"]))
+        with self._lock:
+            self._open[record["id"]] = otel_span
+
+    def span(self, record: Dict[str, Any]) -> None:
+        from opentelemetry.trace import Status, StatusCode
+        with self._lock:
+            otel_span = self._open.pop(record["id"], None)
+        start = int(record["start"] * 1e9)
+        if otel_span is None:
+            otel_span = self._tracer.start_span(record["name"], start_time=start)
+        # The attributes set while the span was open
+        otel_span.set_attributes(self._attributes(record["attributes"]))
+        if record["error"]:
+            otel_span.set_status(Status(StatusCode.ERROR, record["error"]))
+        otel_span.end(end_time=start + int(record["duration"] * 1e9))
+        self._duration.record(record["duration"], {"name": record["name"]})
+
+    def counter(self, name: str, value: float, attributes: Dict[str, Any]) -> None:
+        with self._lock:
+            otel_counter = self._counters.get(name)
+            if otel_counter is None:
+                otel_counter = self._counters[name] = self._meter.create_counter(f"its_a_rag.{name}")
+        otel_counter.add(value, self._attributes(attributes))
+
+
+#########################################################
+# Class: Span of a stage
+# Context manager returned by span(): the attributes set while the span is
+# open (set, add) are exported with it when it closes.
+#########################################################
+class Span:
+    __slots__ = ("sink", "id", "parent", "name", "attributes", "start", "_perf", "_token")
+
+    def __init__(self, sink: TelemetrySink, name: str, attributes: Dict[str, Any]) -> None:
+        self.sink = sink
+        self.id = next(_span_ids)
+        self.parent = None
+        self.name = name
+        self.attributes = attributes
+        self.start = 0.0
+        self._perf = 0.0
+        self._token = None
+
+    def __enter__(self) -> Span:
+        parent = _current_span.get()
+        self.parent = parent.id if parent is not None else None
+        self._token = _current_span.set(self)
+        self.start = time.time()
+        self.sink.start({"id": self.id, "parent": self.parent, "name": self.name, "start": self.start, "attributes": dict(self.attributes)})
+        self._perf = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        duration = time.perf_counter() - self._perf
+        _current_span.reset(self._token)
+        self.sink.span({
+            "id": self.id,
+            "parent": self.parent,
+            "name": self.name,
+            "start": self.start,
+            "duration": duration,
+            "attributes": self.attributes,
+            "error": f"{exc_type.__name__}: {exc}" if exc_type is not None else None,
+            "thread": threading.current_thread().name,
+        })
+
+    def set(self, **attributes: Any) -> None:
+        """Set attributes of the span."""
+        self.attributes.update(attributes)
+
+    def add(self, name: str, value: float) -> None:
+        """Add a value to a numeric attribute of the span (e.g. bytes or tokens)."""
+        self.attributes[name] = self.attributes.get(name, 0) + value
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> _NullSpan:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def add(self, name: str, value: float) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+_span_ids = itertools.count(1)
+_current_span: contextvars.ContextVar = contextvars.ContextVar("its_a_rag_span", default=None)
+_sink: Optional[TelemetrySink] = None
+_sink_pid: Optional[int] = None
+
+
+#########################################################
+# Set the telemetry sink of the process (None disables the telemetry)
+# The sink is not inherited by the worker processes (e.g. the cropping
+# pool of the pipeline): their stage is measured by the parent process.
+# Args:
+#   - sink: TelemetrySink, or None
+# Returns:
+#   - the previous sink
+#########################################################
+def set_telemetry_sink(sink: Optional[TelemetrySink]) -> Optional[TelemetrySink]:
+    global _sink, _sink_pid
+    previous = get_telemetry_sink()
+    _sink, _sink_pid = sink, os.getpid()
+    return previous
+
+
+def get_telemetry_sink() -> Optional[TelemetrySink]:
+    if _sink is None or _sink_pid != os.getpid():
+        return None
+    return _sink
+
+
+#########################################################
+# Open a span around a stage
+# Args:
+#   - name: name of the stage (e.g. "analyze", "crop", "describe")
+#   - attributes: attributes of the span (e.g. file, figure, bytes)
+# Returns:
+#   - context manager yielding the span (a no-op span without sink)
+#########################################################
+def span(name: str, **attributes: Any):
+    sink = _sink
+    if sink is None or _sink_pid != os.getpid():
+        return _NULL_SPAN
+    return Span(sink, name, attributes)
+
+
+#########################################################
+# Return the innermost open span of the current thread (a no-op span if none)
+#########################################################
+def current_span():
+    if _sink is None:
+        return _NULL_SPAN
+    return _current_span.get() or _NULL_SPAN
+
+
+#########################################################
+# Increment a counter
+# Args:
+#   - name: name of the counter (e.g. "vision.prompt_tokens")
+#   - value: increment
+#   - attributes: attributes of the increment (e.g. file)
+#########################################################
+def count(name: str, value: float = 1, **attributes: Any) -> None:
+    sink = _sink
+    if sink is None or _sink_pid != os.getpid():
+        return
+    sink.counter(name, value, attributes)
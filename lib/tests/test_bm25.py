@@ -0,0 +1,104 @@
+import sys
+import os
+import math
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.bm25 import BM25Index, reciprocal_rank_fusion, tokenize
+
+CORPUS = {
+    "cloud": "Azure cloud revenue grew 28% driven by Azure consumption",
+    "devices": "Devices revenue declined as PC shipments fell",
+    "gaming": "Gaming revenue increased with Xbox content and services",
+    "costs": "Operating expenses were stable and research costs increased",
+    "risk": "Risk factors include competition in the cloud market",
+}
+
+
+def make_index(corpus=CORPUS):
+    index = BM25Index()
+    index.add_texts(corpus.keys(), corpus.values())
+    return index
+
+
+def reference_bm25(corpus, query, k1=1.2, b=0.75):
+    # Textbook BM25 over the whole corpus
+    docs = {key: tokenize(text) for key, text in corpus.items()}
+    average = sum(len(tokens) for tokens in docs.values()) / len(docs)
+    scores = {}
+    for key, tokens in docs.items():
+        score = 0.0
+        for term in set(tokenize(query)):
+            df = sum(term in other for other in docs.values())
+            tf = tokens.count(term)
+            if tf:
+                idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(tokens) / average))
+        if score:
+            scores[key] = score
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def assert_same_results(results, expected):
+    assert [key for key, _ in results] == [key for key, _ in expected]
+    assert [score for _, score in results] == pytest.approx([score for _, score in expected], rel=1e-5)
+
+
+class TestTokenize:
+    def test_words_and_numbers(self):
+        assert tokenize("Form 10-K: Revenue was $1,234.5 million (FY2023).") == ["form", "10-k", "revenue", "was", "1,234.5", "million", "fy2023"]
+
+
+class TestBM25Index:
+    @pytest.mark.parametrize("query", ["azure revenue", "cloud", "revenue increased", "xbox gaming services", "costs"])
+    def test_same_scores_as_reference(self, query):
+        assert_same_results(make_index().search(query, k=10), reference_bm25(CORPUS, query))
+
+    def test_ranking(self):
+        index = make_index()
+        assert index.search("azure cloud", k=1)[0][0] == "cloud"
+        # Same term frequency: the shorter document first
+        assert [key for key, _ in index.search("cloud", k=10)] == ["risk", "cloud"]
+        assert index.search("unknown words") == []
+        assert len(index.search("revenue", k=2)) == 2
+
+    def test_delete_replace_and_compact(self):
+        index = make_index()
+        index.delete(["cloud", "missing"])
+        assert "cloud" not in index and len(index) == 4
+        assert [key for key, _ in index.search("cloud")] == ["risk"]
+        index.add("risk", "Currency exchange risk")
+        assert index.search("cloud") == []
+        expected = reference_bm25({key: text for key, text in CORPUS.items() if key not in ("cloud", "risk")} | {"risk": "Currency exchange risk"}, "revenue risk")
+        assert_same_results(index.search("revenue risk"), expected)
+        index.compact()
+        assert_same_results(index.search("revenue risk"), expected)
+
+    def test_save_and_load(self, tmp_path):
+        index = make_index()
+        index.delete(["devices"])
+        index.save(str(tmp_path))
+        loaded = BM25Index.load(str(tmp_path))
+        assert len(loaded) == 4
+        for query in ("azure revenue", "revenue increased", "risk"):
+            assert_same_results(loaded.search(query), index.search(query))
+        # The loaded index can still be changed
+        loaded.delete(["gaming"])
+        loaded.add("new", "Xbox revenue")
+        assert [key for key, _ in loaded.search("xbox")] == ["new"]
+
+
+class TestReciprocalRankFusion:
+    def test_fused_scores(self):
+        fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]], k=60)
+        assert_same_results(fused, [("b", 1 / 62 + 1 / 61), ("a", 1 / 61), ("d", 1 / 62), ("c", 1 / 63)])
+
+    def test_weights(self):
+        fused = reciprocal_rank_fusion([["a", "b"], ["b", "a"]], k=1, weights=[1.0, 3.0])
+        assert [key for key, _ in fused] == ["b", "a"]
+        assert dict(fused) == pytest.approx({"a": 1 / 2 + 3 / 3, "b": 1 / 3 + 3 / 2})
+
+    def test_empty(self):
+        assert reciprocal_rank_fusion([[], []]) == []
@@ -0,0 +1,294 @@
+import sys
+import os
+import asyncio
+import random
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+from azure.ai.documentintelligence.models import AnalyzeResult, DocumentContentFormat
+from langchain_core.embeddings import Embeddings
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.cache import AnalysisResultCache, CachedEmbeddings, FigureIndex, ImageDescriptionCache, PerceptualHashIndex, image_description_key, image_hash
+from its_a_rag.doc_intelligence import AzureAIDocumentIntelligenceParser
+from its_a_rag.image_store import LocalImageStore, is_image_reference
+
+
+def stored_size(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM descriptions").fetchone()[0]
+
+
+class TestKeys:
+    def test_image_hash_depends_on_the_pixels_and_the_encoding(self):
+        image = Image.new("RGB", (8, 8), (255, 0, 0))
+        assert image_hash(image, "PNG") == image_hash(image.copy(), "PNG")
+        assert image_hash(image, "PNG") != image_hash(image, "JPEG:85:None")
+        assert image_hash(image, "PNG") != image_hash(Image.new("RGB", (8, 8), (254, 0, 0)), "PNG")
+        assert image_hash(image, "PNG") != image_hash(Image.new("RGB", (4, 16), (255, 0, 0)), "PNG")
+
+    def test_description_key_parts_do_not_collide(self):
+        key = image_description_key("hash", "caption", "system", "gpt-4o")
+        assert key == image_description_key("hash", "caption", "system", "gpt-4o")
+        assert key != image_description_key("hashc", "aption", "system", "gpt-4o")
+        assert key != image_description_key("hash", "caption", "system", "gpt-4o-mini")
+        assert image_description_key("hash", None, "system", "gpt-4o") == image_description_key("hash", "", "system", "gpt-4o")
+
+
+class TestImageDescriptionCache:
+    def test_get_and_set(self, tmp_path):
+        cache = ImageDescriptionCache(str(tmp_path / "cache.sqlite"))
+        assert cache.get("key") is None
+        cache.set("key", "description")
+        assert cache.get("key") == "description"
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache = ImageDescriptionCache(str(tmp_path / "cache.sqlite"), max_bytes=30)
+        for key in ("a", "b", "c"):
+            cache.set(key, "x" * 10)
+        # Reading "a" makes "b" the least recently used
+        cache.get("a")
+        cache.set("d", "x" * 10)
+        assert cache.get("b") is None
+        assert all(cache.get(key) is not None for key in ("a", "c", "d"))
+        assert cache.total_size() == 30
+
+    def test_total_size_matches_the_stored_descriptions(self, tmp_path):
+        path = str(tmp_path / "cache.sqlite")
+        cache = ImageDescriptionCache(path, max_bytes=1000)
+        rnd = random.Random(0)
+        for _ in range(500):
+            key = str(rnd.randrange(100))
+            if rnd.random() < 0.3:
+                cache.get(key)
+            else:
+                cache.set(key, "x" * rnd.randrange(1, 120))
+            assert cache.total_size() == stored_size(path) <= 1000
+        cache.clear()
+        assert cache.total_size() == 0 and len(cache) == 0
+
+    def test_description_larger_than_the_bound_is_not_kept(self, tmp_path):
+        cache = ImageDescriptionCache(str(tmp_path / "cache.sqlite"), max_bytes=10)
+        cache.set("small", "x" * 5)
+        cache.set("large", "x" * 50)
+        assert cache.get("large") is None
+        assert cache.total_size() <= 10
+
+    def test_existing_database_total_is_computed(self, tmp_path):
+        path = str(tmp_path / "cache.sqlite")
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE TABLE descriptions (key TEXT PRIMARY KEY, description TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+            conn.executemany("INSERT INTO descriptions VALUES (?, ?, ?, ?)", [(str(n), "x" * 10, 10, n) for n in range(50)])
+        cache = ImageDescriptionCache(path, max_bytes=300)
+        assert cache.total_size() == 500
+        cache.set("new", "x" * 10)
+        assert cache.total_size() == 300
+        # The oldest entries were evicted
+        assert cache.get("0") is None and cache.get("49") is not None
+
+
+def analyze_result(content="# Title\n\ntext", pages=1):
+    return AnalyzeResult({
+        "apiVersion": "2024-11-30",
+        "modelId": "prebuilt-layout",
+        "content": content,
+        "pages": [{"pageNumber": n + 1, "spans": [{"offset": 0, "length": len(content)}]} for n in range(pages)],
+    })
+
+
+class TestAnalysisResultCache:
+    def test_round_trip(self, tmp_path):
+        cache = AnalysisResultCache(str(tmp_path / "analysis"))
+        file_path = tmp_path / "doc.pdf"
+        file_path.write_bytes(b"%PDF-1.7 content")
+        key = cache.key(str(file_path), "prebuilt-layout", DocumentContentFormat.MARKDOWN)
+        assert cache.get(key) is None
+        cache.set(key, analyze_result(pages=3))
+        result = AnalysisResultCache(str(tmp_path / "analysis")).get(key)
+        assert isinstance(result, AnalyzeResult)
+        assert result.as_dict() == analyze_result(pages=3).as_dict()
+        assert [page.page_number for page in result.pages] == [1, 2, 3]
+        # No temporary file left next to the result
+        assert [name for _, _, names in os.walk(tmp_path / "analysis") for name in names] == [f"{key}.json.gz"]
+
+    def test_key_depends_on_the_content_and_the_options(self, tmp_path):
+        cache = AnalysisResultCache(str(tmp_path / "analysis"))
+        file_path = tmp_path / "doc.pdf"
+        file_path.write_bytes(b"%PDF-1.7 content")
+        key = cache.key(str(file_path), "prebuilt-layout", "markdown", ["ocrHighResolution", "formulas"])
+        # The same content in another file, features in another order, enum or string formats
+        copy_path = tmp_path / "copy.pdf"
+        copy_path.write_bytes(b"%PDF-1.7 content")
+        assert cache.key(str(copy_path), "prebuilt-layout", DocumentContentFormat.MARKDOWN, ["formulas", "ocrHighResolution"]) == key
+        assert cache.key(str(file_path), "prebuilt-read", "markdown", ["ocrHighResolution", "formulas"]) != key
+        assert cache.key(str(file_path), "prebuilt-layout", "text", ["ocrHighResolution", "formulas"]) != key
+        assert cache.key(str(file_path), "prebuilt-layout", "markdown") != key
+        assert cache.key(str(file_path), "prebuilt-layout", "markdown", ["ocrHighResolution", "formulas"], "unicodeCodePoint") != key
+        file_path.write_bytes(b"%PDF-1.7 changed")
+        assert cache.key(str(file_path), "prebuilt-layout", "markdown", ["ocrHighResolution", "formulas"]) != key
+
+
+class FakeDocumentIntelligenceClient:
+    def __init__(self):
+        self.calls = []
+
+    def begin_analyze_document(self, model_id, body, **kwargs):
+        self.calls.append((model_id, body.read(), kwargs))
+        return SimpleNamespace(result=lambda: analyze_result("analyzed"))
+
+
+class TestAnalyzeWithCache:
+    def test_unchanged_file_is_not_analyzed_again(self, tmp_path):
+        cache = AnalysisResultCache(str(tmp_path / "analysis"))
+        file_path = tmp_path / "doc.pdf"
+        file_path.write_bytes(b"%PDF-1.7 content")
+        parser = AzureAIDocumentIntelligenceParser("https://di.example.com", "key", analysis_cache=cache)
+        parser.client = FakeDocumentIntelligenceClient()
+        assert parser.analyze(str(file_path)).content == "analyzed"
+        assert parser.analyze(str(file_path)).content == "analyzed"
+        assert len(parser.client.calls) == 1
+        file_path.write_bytes(b"%PDF-1.7 changed")
+        parser.analyze(str(file_path))
+        assert len(parser.client.calls) == 2
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.queries = []
+        self.documents = []
+
+    def embed_query(self, text):
+        self.queries.append(text)
+        return [float(len(text)), 1.0]
+
+    def embed_documents(self, texts):
+        self.documents.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+    async def aembed_query(self, text):
+        return self.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        return self.embed_documents(texts)
+
+
+class TestCachedEmbeddings:
+    def test_query_embedded_once(self):
+        embeddings = CountingEmbeddings()
+        cached = CachedEmbeddings(embeddings, "embedding")
+        assert cached.embed_query("revenue of nvidia") == [17.0, 1.0]
+        # Same text up to whitespace
+        assert cached.embed_query("  revenue   of\nnvidia ") == [17.0, 1.0]
+        assert embeddings.queries == ["revenue of nvidia"]
+        assert (cached.hits, cached.misses) == (1, 1)
+
+    def test_returned_vectors_are_copies(self):
+        cached = CachedEmbeddings(CountingEmbeddings(), "embedding")
+        cached.embed_query("revenue").append(0.0)
+        assert cached.embed_query("revenue") == [7.0, 1.0]
+
+    def test_least_recently_used_evicted(self):
+        embeddings = CountingEmbeddings()
+        cached = CachedEmbeddings(embeddings, "embedding", max_entries=2)
+        for text in ("a", "b", "a", "c"):
+            cached.embed_query(text)
+        assert len(cached) == 2
+        cached.embed_query("a")
+        cached.embed_query("b")
+        assert embeddings.queries == ["a", "b", "c", "b"]
+
+    def test_deployment_is_part_of_the_key(self):
+        cached = CachedEmbeddings(CountingEmbeddings(), "small")
+        other = CachedEmbeddings(CountingEmbeddings(), "large")
+        assert cached._key("revenue") != other._key("revenue")
+        assert CachedEmbeddings(SimpleNamespace(deployment="embedding"))._key("x") == ("embedding", "x")
+
+    def test_distinct_misses_embedded_in_one_request(self):
+        embeddings = CountingEmbeddings()
+        cached = CachedEmbeddings(embeddings, "embedding")
+        cached.embed_query("cached")
+        assert cached.embed_queries(["a", "cached", "bb", "a "]) == [[1.0, 1.0], [6.0, 1.0], [2.0, 1.0], [1.0, 1.0]]
+        assert embeddings.documents == [["a", "bb"]]
+        assert asyncio.run(cached.aembed_queries(["bb", "ccc"])) == [[2.0, 1.0], [3.0, 1.0]]
+        assert embeddings.documents == [["a", "bb"], ["ccc"]]
+
+    def test_async_query(self):
+        embeddings = CountingEmbeddings()
+        cached = CachedEmbeddings(embeddings, "embedding")
+        assert asyncio.run(cached.aembed_query("revenue")) == [7.0, 1.0]
+        assert cached.embed_query("revenue") == [7.0, 1.0]
+        assert embeddings.queries == ["revenue"]
+
+    def test_documents_are_not_cached(self):
+        embeddings = CountingEmbeddings()
+        cached = CachedEmbeddings(embeddings, "embedding")
+        cached.embed_documents(["chunk"])
+        cached.embed_documents(["chunk"])
+        assert embeddings.documents == [["chunk"], ["chunk"]] and len(cached) == 0
+        cached.embed_query("chunk")
+        cached.clear()
+        assert len(cached) == 0
+
+
+class TestPerceptualHashIndex:
+    def test_same_matches_as_brute_force(self):
+        rnd = random.Random(0)
+        index = PerceptualHashIndex(max_distance=6, bits=64)
+        entries = []
+        base = [rnd.getrandbits(64) for _ in range(20)]
+        for n in range(300):
+            # Near-duplicates of a few base hashes, and random hashes
+            phash = rnd.choice(base) ^ sum(1 << rnd.randrange(64) for _ in range(rnd.randrange(10))) if rnd.random() < 0.7 else rnd.getrandbits(64)
+            key = rnd.choice(["k1", "k2"])
+            entries.append((key, phash, 1.0, n))
+            index.add(key, phash, 1.0, n)
+        for _ in range(300):
+            key, phash = rnd.choice(["k1", "k2"]), rnd.choice(base) ^ (1 << rnd.randrange(64))
+            candidates = [((entry_phash ^ phash).bit_count(), n) for entry_key, entry_phash, _, n in entries
+                          if entry_key == key and (entry_phash ^ phash).bit_count() <= 6]
+            assert index.find(key, phash, 1.0) == (min(candidates)[1] if candidates else None)
+
+    def test_aspect_ratio_and_key_must_match(self):
+        index = PerceptualHashIndex(max_distance=2, bits=64)
+        index.add("key", 0b1011, 1.5, "value")
+        assert index.find("key", 0b1001, 1.5) == "value"
+        assert index.find("key", 0b1011, 3.0) is None
+        assert index.find("other", 0b1011, 1.5) is None
+        assert index.find("key", 0b0100, 1.5) is None
+
+
+class TestFigureIndex:
+    def test_figures_are_found_after_reopening(self, tmp_path):
+        path = str(tmp_path / "figures.sqlite")
+        index = FigureIndex(path)
+        index.add("key", 0xABCDEF, 1.2, "a bar chart", "data:image/png;base64,AAAA", "a.pdf#3")
+        assert index.find("key", 0xABCDEE, 1.2) == ("a bar chart", "data:image/png;base64,AAAA", "a.pdf#3")
+        reopened = FigureIndex(path)
+        assert len(reopened) == 1
+        assert reopened.find("key", 0xABCDEF, 1.2) == ("a bar chart", "data:image/png;base64,AAAA", "a.pdf#3")
+        assert reopened.find("key", 0x123456, 1.2) is None
+        assert (reopened.hits, reopened.misses) == (1, 1)
+
+    def test_only_the_hashes_are_held_in_memory(self, tmp_path):
+        path = str(tmp_path / "figures.sqlite")
+        FigureIndex(path).add("key", 0xABCDEF, 1.0, "description", "data:image/png;base64," + "A" * 1000, "a.pdf#0")
+        index = FigureIndex(path)
+        values = [value for bucket in index._index._buckets.values() for *_, value in bucket]
+        assert values and all(isinstance(value, int) for value in values)
+
+    def test_clear(self, tmp_path):
+        index = FigureIndex(str(tmp_path / "figures.sqlite"))
+        index.add("key", 1, 1.0, "description", None, "a.pdf#0")
+        index.clear()
+        assert len(index) == 0 and index.find("key", 1, 1.0) is None
+
+    def test_images_kept_in_the_image_store(self, tmp_path):
+        store = LocalImageStore(str(tmp_path / "images"))
+        index = FigureIndex(str(tmp_path / "figures.sqlite"), image_store=store)
+        index.add("key", 1, 1.0, "description", "data:image/png;base64,AAAA", "a.pdf#0")
+        description, image, origin = index.find("key", 1, 1.0)
+        assert is_image_reference(image) and store.get_data_url(image) == "data:image/png;base64,AAAA"
@@ -0,0 +1,160 @@
+import sys
+import os
+import base64
+import io
+
+import pytest
+from PIL import Image
+from langchain.schema import Document
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.context import DEFAULT_IMAGE_TOKENS, count_tokens, data_url_image_size, estimate_image_tokens, estimate_image_url_tokens, pack_context
+from its_a_rag.image_store import IMAGE_REFERENCE_PREFIX, LocalImageStore
+from its_a_rag.ingestion import get_image_description, multimodal_prompt
+
+
+def image_data_url(size=(8, 8), color=(255, 0, 0), format="PNG", **kwargs):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format=format, **kwargs)
+    return f"data:image/{format.lower()};base64," + base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def text(content):
+    return Document(page_content=content, metadata={"image": None})
+
+
+def figure(image, content="figure description"):
+    return Document(page_content=content, metadata={"image": image})
+
+
+def prompt_parts(messages):
+    content = messages[0].content
+    return content[0]["text"], [part["image_url"]["url"] for part in content[1:]]
+
+
+class TestEstimateImageTokens:
+    @pytest.mark.parametrize("width, height, tokens", [
+        (8, 8, 85 + 170),
+        (512, 512, 85 + 170),
+        (513, 512, 85 + 170 * 2),
+        # Shortest side scaled to 768: 2x2 tiles
+        (1024, 1024, 85 + 170 * 4),
+        # Scaled to fit 2048x2048, then to 768 on the shortest side: 1536x768, 3x2 tiles
+        (4096, 2048, 85 + 170 * 6),
+    ])
+    def test_high_detail_tiles(self, width, height, tokens):
+        assert estimate_image_tokens(width, height, "high") == estimate_image_tokens(width, height) == tokens
+
+    def test_low_detail(self):
+        assert estimate_image_tokens(4096, 4096, "low") == 85
+        assert estimate_image_url_tokens("https://example.com/chart.png", "low") == 85
+
+    def test_image_url(self):
+        assert estimate_image_url_tokens(image_data_url((1024, 1024))) == 85 + 170 * 4
+        assert estimate_image_url_tokens("https://example.com/chart.png") == DEFAULT_IMAGE_TOKENS
+
+
+class TestDataUrlImageSize:
+    def test_png_and_jpeg(self):
+        assert data_url_image_size(image_data_url((300, 200))) == (300, 200)
+        assert data_url_image_size(image_data_url((120, 90), format="JPEG")) == (120, 90)
+
+    def test_size_after_large_jpeg_metadata(self):
+        # The size of a JPEG comes after its metadata, further than the first decoded characters
+        data_url = image_data_url((64, 48), format="JPEG", exif=b"Exif\x00\x00" + os.urandom(20000))
+        assert data_url_image_size(data_url) == (64, 48)
+
+    @pytest.mark.parametrize("value", [
+        "https://example.com/chart.png",
+        IMAGE_REFERENCE_PREFIX + "0123.png",
+        "data:text/plain;base64," + base64.b64encode(b"not an image").decode("utf-8"),
+        "data:image/png;base64," + base64.b64encode(b"not an image").decode("utf-8"),
+        "data:image/png;base64,",
+        "data:image/svg+xml,<svg></svg>",
+    ])
+    def test_none_when_the_size_cannot_be_read(self, value):
+        assert data_url_image_size(value) is None
+
+
+class TestPackContext:
+    def test_everything_without_budget(self):
+        image = image_data_url()
+        docs = [text("first"), figure(image), text("second")]
+        context = pack_context(docs, None)
+        assert context["texts"] == ["first", "second"] and context["images"] == [image]
+        assert context["tokens"] == count_tokens("first") + count_tokens("second") + estimate_image_tokens(8, 8)
+
+    def test_duplicates_are_dropped(self):
+        image = image_data_url()
+        context = pack_context([text("same"), text(" same\n"), figure(image), figure(image), text("other")], None)
+        assert context["texts"] == ["same", "other"] and context["images"] == [image]
+
+    def test_rank_order_within_the_budget(self):
+        # The large image does not fit: the documents ranked after it still do, in their order
+        small, large = image_data_url((8, 8)), image_data_url((2048, 2048), color=(0, 0, 255))
+        docs = [text("alpha"), figure(large), text("beta"), figure(small), text("gamma")]
+        budget = count_tokens("alpha") + count_tokens("beta") + estimate_image_tokens(8, 8) + count_tokens("gamma")
+        context = pack_context(docs, budget)
+        assert context["texts"] == ["alpha", "beta", "gamma"] and context["images"] == [small]
+        assert context["tokens"] == budget
+
+    def test_text_truncated_to_the_remaining_budget(self):
+        long_text = "revenue grew in every segment " * 100
+        context = pack_context([text("intro"), text(long_text)], count_tokens("intro") + 40)
+        assert context["texts"][0] == "intro" and long_text.startswith(context["texts"][1])
+        assert count_tokens(context["texts"][1]) <= 40 and context["tokens"] <= count_tokens("intro") + 40
+        # Not truncated: skipped
+        assert pack_context([text("intro"), text(long_text)], count_tokens("intro") + 40, truncate=False)["texts"] == ["intro"]
+
+    def test_max_chunk_tokens(self):
+        context = pack_context([text("word " * 200)], None, max_chunk_tokens=10)
+        assert count_tokens(context["texts"][0]) <= 10
+
+    def test_referenced_images_are_loaded_from_the_store(self, tmp_path):
+        store = LocalImageStore(str(tmp_path / "images"))
+        image = image_data_url((1024, 1024))
+        context = pack_context([figure(store.put_data_url(image))], None, image_store=store)
+        assert context["images"] == [image] and context["tokens"] == 85 + 170 * 4
+
+    def test_missing_image_store_file(self, tmp_path):
+        # A figure whose file is missing from the store is left out instead of failing the answer
+        store = LocalImageStore(str(tmp_path / "images"))
+        context = pack_context([figure(IMAGE_REFERENCE_PREFIX + "0123.png"), text("text")], 1000, image_store=store)
+        assert context["images"] == [] and context["texts"] == ["text"]
+
+    def test_image_of_unknown_size(self):
+        context = pack_context([figure("https://example.com/chart.png")], None)
+        assert context["images"] == ["https://example.com/chart.png"] and context["tokens"] == DEFAULT_IMAGE_TOKENS
+
+
+class TestMultimodalPrompt:
+    def test_image_description_used_as_is_by_default(self):
+        # The call shape of the notebooks: the output of get_image_description, without any budget
+        image = image_data_url()
+        docs = [text("first " * 5000), figure(image), text("second")]
+        prompt, images = prompt_parts(multimodal_prompt({"context": get_image_description(docs), "question": "what?"}))
+        assert prompt.endswith("first " * 5000 + "\nsecond") and images == [image]
+
+    def test_documents_packed_in_rank_order(self):
+        image = image_data_url()
+        docs = [text("second"), figure(image), text("first")]
+        prompt, images = prompt_parts(multimodal_prompt({"context": docs, "question": "what?"}, token_budget=1000))
+        assert prompt.endswith("Text and / or tables:\nsecond\nfirst") and images == [image]
+
+    def test_budget_applied_to_the_image_description(self):
+        docs = [text("kept"), text("dropped " * 100)]
+        prompt, _ = prompt_parts(multimodal_prompt({"context": get_image_description(docs), "question": "what?"}, token_budget=count_tokens("kept") + 5))
+        assert prompt.endswith("Text and / or tables:\nkept")
+
+    def test_packed_context_used_as_is(self):
+        context = {"texts": ["packed"], "images": [], "tokens": 1}
+        prompt, _ = prompt_parts(multimodal_prompt({"context": context, "question": "what?"}, token_budget=0))
+        assert prompt.endswith("packed")
+
+    def test_missing_image_without_budget(self, tmp_path):
+        store = LocalImageStore(str(tmp_path / "images"))
+        reference = store.put_data_url(image_data_url())
+        context = {"texts": ["text"], "images": [reference, IMAGE_REFERENCE_PREFIX + "0123.png"]}
+        _, images = prompt_parts(multimodal_prompt({"context": context, "question": "what?"}, image_store=store))
+        assert images == [store.get_data_url(reference)]
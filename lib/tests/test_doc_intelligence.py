@@ -0,0 +1,424 @@
+import sys
+import os
+import io
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pymupdf
+import pytest
+from PIL import Image
+from azure.ai.documentintelligence.models import AnalyzeResult
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'benchmarks')))
+
+from fake_services import FakeAzureServices, synthetic_layout
+from its_a_rag import doc_intelligence
+from its_a_rag.doc_intelligence import PAGE_BREAK, STRING_INDEX_TYPE, AzureAIDocumentIntelligenceParser, FigureCropper, StubVisionClient, VisionClient, crop_image_from_pdf_page, describe_image_data_url, describe_images, find_figure_tags, include_figure_in_md, iter_sections_with_figures, merge_analyze_results, rewrite_figures, update_figure_description
+from its_a_rag.rate_limit import RateLimiter, TokenBucket
+
+
+class SlowVisionClient:
+    """Vision client answering after a random delay and recording the requests in flight."""
+
+    deployment_name = "slow"
+
+    def __init__(self, seed=0, fail_on=None):
+        self.rnd = random.Random(seed)
+        self.fail_on = fail_on
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = []
+
+    def describe(self, data_url, caption):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.calls.append(data_url)
+            delay = self.rnd.uniform(0.001, 0.02)
+        try:
+            time.sleep(delay)
+            if data_url == self.fail_on:
+                raise RuntimeError(f"failed to describe {data_url}")
+            return f"description of {data_url} ({caption})"
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def make_jobs(n):
+    return [(f"image {idx}", f"caption {idx}") for idx in range(n)]
+
+
+class TestDescribeImages:
+    @pytest.mark.parametrize("max_concurrency", [1, 4, 16])
+    def test_descriptions_in_job_order(self, max_concurrency):
+        client = SlowVisionClient()
+        jobs = make_jobs(20)
+        descriptions = describe_images(jobs, max_concurrency, client=client)
+        assert descriptions == [f"description of {data_url} ({caption})" for data_url, caption in jobs]
+        assert sorted(client.calls) == sorted(data_url for data_url, _ in jobs)
+
+    def test_sequential_by_default(self):
+        client = SlowVisionClient()
+        describe_images(make_jobs(5), client=client)
+        assert client.max_in_flight == 1
+
+    def test_concurrency_is_bounded(self):
+        client = SlowVisionClient()
+        describe_images(make_jobs(40), 4, client=client)
+        assert 1 < client.max_in_flight <= 4
+
+    def test_shared_executor(self):
+        client = SlowVisionClient()
+        jobs = make_jobs(10)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            # max_concurrency is ignored with an executor
+            descriptions = describe_images(jobs, 1, executor=executor, client=client)
+        assert descriptions == [f"description of {data_url} ({caption})" for data_url, caption in jobs]
+        assert 1 < client.max_in_flight <= 3
+
+    def test_failure_is_raised(self):
+        client = SlowVisionClient(fail_on="image 3")
+        with pytest.raises(RuntimeError, match="image 3"):
+            describe_images(make_jobs(30), 2, client=client)
+        # The jobs not started yet are dropped
+        assert len(client.calls) < 30
+
+    def test_no_jobs(self):
+        assert describe_images([], 4, client=SlowVisionClient()) == []
+
+
+def make_pdf(path, pages=6):
+    doc = pymupdf.open()
+    for n in range(pages):
+        page = doc.new_page(width=288, height=288)
+        page.draw_rect(pymupdf.Rect(36, 36, 36 + 30 * n, 144), color=(0, 0, 1), fill=(n / pages, 0.5, 0))
+        page.insert_text((40, 200), f"page {n}")
+    doc.save(path)
+    doc.close()
+    return path
+
+
+class TestFigureCropper:
+    def test_same_crops_as_opening_the_file_each_time(self, tmp_path):
+        path = make_pdf(str(tmp_path / "doc.pdf"))
+        with FigureCropper(path, dpi=72) as cropper:
+            for page_number in [0, 3, 0, 5, 1]:
+                bounding_box = (0.25, 0.25, 2.0, 2.0 + page_number / 10)
+                assert cropper.crop(page_number, bounding_box).tobytes() == crop_image_from_pdf_page(path, page_number, bounding_box, dpi=72).tobytes()
+
+    def test_least_recently_used_pages_are_dropped(self, tmp_path):
+        path = make_pdf(str(tmp_path / "doc.pdf"))
+        loads = []
+        with FigureCropper(path, dpi=72, max_cached_pages=2) as cropper:
+            load_page = cropper._open().load_page
+            cropper._doc.load_page = lambda page_number: loads.append(page_number) or load_page(page_number)
+            for page_number in [0, 1, 0, 0, 2, 0, 1]:
+                cropper.crop(page_number, (0, 0, 1, 1))
+            # Page 1 was the least recently used when page 2 was loaded
+            assert loads == [0, 1, 2, 1]
+            assert list(cropper._pages) == [0, 1]
+        assert cropper._doc is None and not cropper._pages
+
+    def test_multi_page_tiff(self, tmp_path):
+        path = str(tmp_path / "doc.tiff")
+        frames = [Image.new("RGB", (50, 40), (40 * n, 0, 0)) for n in range(3)]
+        frames[0].save(path, save_all=True, append_images=frames[1:])
+        with FigureCropper(path) as cropper:
+            for page_number in [2, 0, 1]:
+                crop = cropper.crop(page_number, (10, 10, 30, 20))
+                assert crop.size == (20, 10) and crop.getpixel((0, 0)) == (40 * page_number, 0, 0)
+
+
+# Previous implementation of the figure rewriting (one pass per figure)
+def reference_rewrite(md_content, img_descriptions):
+    for idx, img_description in enumerate(img_descriptions):
+        md_content = update_figure_description(md_content, img_description, idx)
+    return md_content
+
+
+def figure_with_span(offset, length):
+    return SimpleNamespace(spans=[SimpleNamespace(offset=offset, length=length)])
+
+
+class TestRewriteFigures:
+    @pytest.mark.parametrize("seed", range(500))
+    def test_same_output_as_reference(self, seed, capsys):
+        rnd = random.Random(seed)
+        tokens = ["<figure>", "</figure>", "a", "\n", "<figcaption>x</figcaption>", "bb "]
+        md = "".join(rnd.choice(tokens) for _ in range(rnd.randint(0, 15)))
+        descriptions = [rnd.choice([f"d{idx}", "", "<figure>x" if rnd.random() < 0.1 else "q"]) for idx in range(rnd.randint(0, 5))]
+        assert rewrite_figures(md, descriptions) == reference_rewrite(md, descriptions)
+
+    def test_replaces_the_figure_contents(self):
+        md = "a<figure>one</figure>b<figure>two</figure>c"
+        assert rewrite_figures(md, ["X", "Y"]) == "a<figure>\n![](figures/0)\nX\n</figure>b<figure>\n![](figures/1)\nY\n</figure>c"
+
+    def test_figure_spans_are_used_when_they_match_the_tags(self, capsys):
+        md = "a<figure>one</figure>b<figure>two</figure>c"
+        figures = [figure_with_span(1, 20), figure_with_span(22, 20)]
+        assert find_figure_tags(md, figures) == [(9, 12), (30, 33)]
+        assert rewrite_figures(md, ["X", "Y"], figures) == reference_rewrite(md, ["X", "Y"])
+        # Spans that do not point at the tags are ignored
+        assert find_figure_tags(md, [figure_with_span(0, 20), figure_with_span(22, 20)]) == [(9, 12), (30, 33)]
+
+    def test_nested_tags_are_not_well_formed(self):
+        assert find_figure_tags("<figure><figure></figure></figure>") is None
+        assert find_figure_tags("<figure></figure></figure>") is None
+
+
+def make_figure_pdf(path, pages=3):
+    # One titled page per section, each with a framed chart (a figure of the synthetic layout)
+    doc = pymupdf.open()
+    for n in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Section {n}", fontsize=20)
+        page.insert_text((72, 110), f"Paragraph of section {n}.", fontsize=10)
+        page.draw_rect(pymupdf.Rect(90, 180, 290, 360), color=(0, 0, 0))
+        page.draw_rect(pymupdf.Rect(100, 300 - 20 * n, 130, 350), color=(0, 0, 0), fill=(0.2, 0.4, 0.8))
+        page.insert_text((72, 400), f"End of section {n}.", fontsize=10)
+    doc.save(path)
+    doc.close()
+    with open(path, "rb") as f:
+        return AnalyzeResult(synthetic_layout(f.read()))
+
+
+class TestSaveImages:
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_nothing_is_written_without_save_images(self, tmp_path, stream, capsys):
+        result = make_figure_pdf(str(tmp_path / "doc.pdf"))
+        output_folder = tmp_path / "output"
+        client = StubVisionClient()
+        if stream:
+            docs = list(iter_sections_with_figures(str(tmp_path / "doc.pdf"), result, str(output_folder), save_images=False, vision_client=client, section_size=1))
+            assert len(docs) > 1
+            md_content = "".join(doc.page_content for doc in docs)
+        else:
+            md_content, _ = include_figure_in_md(str(tmp_path / "doc.pdf"), result, str(output_folder), save_images=False, vision_client=client)
+        assert client.calls == 3 and md_content.count("Description of image") == 3
+        assert not output_folder.exists()
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_artifacts_are_written_with_save_images(self, tmp_path, stream, capsys):
+        result = make_figure_pdf(str(tmp_path / "doc.pdf"))
+        output_folder = tmp_path / "output"
+        if stream:
+            md_content = "".join(doc.page_content for doc in iter_sections_with_figures(str(tmp_path / "doc.pdf"), result, str(output_folder), vision_client=StubVisionClient(), section_size=1))
+        else:
+            md_content, _ = include_figure_in_md(str(tmp_path / "doc.pdf"), result, str(output_folder), vision_client=StubVisionClient())
+        assert sorted(os.listdir(output_folder)) == ["doc.md", "doc_cropped_image_0.png", "doc_cropped_image_0.txt", "doc_cropped_image_1.png", "doc_cropped_image_1.txt", "doc_cropped_image_2.png", "doc_cropped_image_2.txt", "doc_init.md"]
+        assert (output_folder / "doc.md").read_text() == md_content
+        assert (output_folder / "doc_init.md").read_text() == result.content
+
+
+class TestVisionClient:
+    def test_describe_through_the_pooled_client(self):
+        with FakeAzureServices(vision_latency=0) as services:
+            client = VisionClient("fake", services.endpoint, "2024-10-21", "gpt-4o", pool_size=4)
+            try:
+                jobs = make_jobs(8)
+                descriptions = describe_images(jobs, 4, client=client)
+            finally:
+                client.close()
+            assert services.counters["chat"] == 8
+        assert all(description.startswith("The image ") for description in descriptions)
+        # The same image gets the same description
+        assert len(set(descriptions)) == 8
+        assert client.http_client.is_closed
+
+    def test_describe_with_the_rate_limiter(self):
+        with FakeAzureServices(vision_latency=0) as services:
+            # One request in the quota of the deployment, refilled every 100 ms
+            services._quotas["chat"] = TokenBucket(600, burst_seconds=0.1)
+            limiter = RateLimiter(requests_per_minute=6000, backoff_base=0.001)
+            client = VisionClient("fake", services.endpoint, "2024-10-21", "gpt-4o", rate_limiter=limiter)
+            try:
+                # The second request is over the quota of the deployment: it is retried after the delay it returns
+                descriptions = [client.describe(f"image {n}", "") for n in range(2)]
+            finally:
+                client.close()
+            assert services.counters["throttled"] >= 1
+        assert all(description.startswith("The image ") for description in descriptions)
+        assert limiter.throttled >= 1 and limiter.granted >= 3
+
+    def test_default_client_created_once_from_the_environment(self, monkeypatch):
+        monkeypatch.setattr(doc_intelligence, "_default_vision_client", None)
+        for name, value in [("AZURE_OPENAI_API_KEY", "key"), ("AZURE_OPENAI_ENDPOINT", "http://127.0.0.1:9"), ("AZURE_OPENAI_API_VERSION", "2024-10-21"), ("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-4o")]:
+            monkeypatch.setenv(name, value)
+        client = doc_intelligence.get_default_vision_client()
+        try:
+            assert client.deployment_name == "gpt-4o"
+            assert doc_intelligence.get_default_vision_client() is client
+        finally:
+            client.close()
+
+
+class TestStubVisionClient:
+    def test_deterministic_descriptions(self):
+        client = StubVisionClient()
+        assert client.describe("data:image/png;base64,AAAA", "Revenue") == StubVisionClient().describe("data:image/png;base64,AAAA", "Revenue")
+        assert client.describe("data:image/png;base64,AAAA", "").startswith("Description of image ")
+        assert client.describe("data:image/png;base64,AAAB", "") != client.describe("data:image/png;base64,AAAA", "")
+        assert client.calls == 4
+
+    def test_used_by_describe_image_data_url(self):
+        client = StubVisionClient()
+        assert describe_image_data_url("data:image/png;base64,AAAA", "Revenue", client).endswith("with caption: Revenue")
+        assert client.calls == 1
+
+
+# Pages of a document: paragraphs and figures (with non-BMP characters, counted as one code point)
+LAYOUT_PAGES = [
+    [("paragraph", "# Annual report"), ("paragraph", "Revenue grew 📈 in every región."), ("figure", "Revenue by year")],
+    [("paragraph", "## Costs"), ("figure", "Costs 💶 by segment"), ("paragraph", "Stable."), ("figure", "Headcount")],
+    [("paragraph", "## Outlook")],
+    [("figure", "Guidance"), ("paragraph", "Next year 🚀.")],
+    [("paragraph", "## Risks"), ("paragraph", "Competition.")],
+]
+
+
+def page_layout(pages):
+    # Analysis result of the pages, as Document Intelligence returns it (offsets in code points):
+    # one paragraph per text, one figure (with its caption paragraph) per chart, one section per page
+    result = {"stringIndexType": STRING_INDEX_TYPE, "content": "", "pages": [], "paragraphs": [], "figures": [], "sections": []}
+    for page_number, items in enumerate(pages, start=1):
+        if page_number > 1:
+            result["content"] += PAGE_BREAK
+        page_start = len(result["content"])
+        region = [{"pageNumber": page_number, "polygon": [1, 1, 2, 1, 2, 2, 1, 2]}]
+        elements = []
+        for n, (kind, text) in enumerate(items):
+            if n:
+                result["content"] += "\n\n"
+            tag = f"<figure>\n{text}\n</figure>" if kind == "figure" else text
+            span = {"offset": len(result["content"]), "length": len(tag)}
+            result["content"] += tag
+            if kind == "figure":
+                caption = {"offset": span["offset"] + len("<figure>\n"), "length": len(text)}
+                result["paragraphs"].append({"content": text, "spans": [caption], "boundingRegions": region})
+                figure_number = sum(figure["id"].startswith(f"{page_number}.") for figure in result["figures"]) + 1
+                result["figures"].append({"id": f"{page_number}.{figure_number}", "spans": [span], "boundingRegions": region, "elements": [f"/paragraphs/{len(result['paragraphs']) - 1}"]})
+                elements.append(f"/figures/{len(result['figures']) - 1}")
+            else:
+                result["paragraphs"].append({"content": text, "spans": [span], "boundingRegions": region})
+                elements.append(f"/paragraphs/{len(result['paragraphs']) - 1}")
+        result["pages"].append({"pageNumber": page_number, "spans": [{"offset": page_start, "length": len(result["content"]) - page_start}]})
+        result["sections"].append({"spans": [{"offset": page_start, "length": len(result["content"]) - page_start}], "elements": elements})
+    return AnalyzeResult(result)
+
+
+class TestMergeAnalyzeResults:
+    @pytest.mark.parametrize("shard_pages", [1, 2, 3, 4])
+    def test_same_result_as_the_whole_document(self, shard_pages):
+        firsts = list(range(0, len(LAYOUT_PAGES), shard_pages))
+        shards = [page_layout(LAYOUT_PAGES[first:first + shard_pages]) for first in firsts]
+        merged = merge_analyze_results(shards, firsts)
+        whole = page_layout(LAYOUT_PAGES)
+        assert merged.as_dict() == whole.as_dict()
+
+    def test_offsets_pages_and_references(self):
+        merged = merge_analyze_results([page_layout(LAYOUT_PAGES[:2]), page_layout(LAYOUT_PAGES[2:])], [0, 2])
+        # Every span points at its text in the merged content
+        for paragraph in merged.paragraphs:
+            span = paragraph.spans[0]
+            assert merged.content[span.offset:span.offset + span.length] == paragraph.content
+        assert [figure.id for figure in merged.figures] == ["1.1", "2.1", "2.2", "4.1"]
+        assert [figure.bounding_regions[0].page_number for figure in merged.figures] == [1, 2, 2, 4]
+        assert [page.page_number for page in merged.pages] == [1, 2, 3, 4, 5]
+        # The references of the second range point at its own paragraphs and figures
+        guidance = merged.figures[3]
+        assert merged.paragraphs[int(guidance.elements[0].split("/")[-1])].content == "Guidance"
+        assert merged.sections[3].elements == ["/figures/3", f"/paragraphs/{len(merged.paragraphs) - 3}"]
+
+    def test_text_format_separator(self):
+        merged = merge_analyze_results([AnalyzeResult({"content": "one", "pages": [{"pageNumber": 1, "spans": [{"offset": 0, "length": 3}]}]})] * 2, [0, 1], "\n")
+        assert merged.content == "one\none" and merged.pages[1].spans[0].offset == 4 and merged.pages[1].page_number == 2
+
+
+class SyntheticDocumentIntelligenceClient:
+    """Client returning the synthetic layout of the uploaded PDF and recording the requests."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def begin_analyze_document(self, model_id, body, **kwargs):
+        layout = synthetic_layout(body.read())
+        with self.lock:
+            self.calls.append(kwargs)
+        return SimpleNamespace(result=lambda: AnalyzeResult(layout))
+
+
+class TestShardedAnalysis:
+    def test_same_result_as_the_whole_file(self, tmp_path):
+        file_path = str(tmp_path / "report.pdf")
+        whole = make_figure_pdf(file_path, pages=5)
+        parser = AzureAIDocumentIntelligenceParser("https://di.example.com", "key", shard_pages=2)
+        parser.client = SyntheticDocumentIntelligenceClient()
+        result = parser.analyze(file_path)
+        assert len(parser.client.calls) == 3
+        assert result.as_dict() == whole.as_dict()
+
+    def test_both_paths_request_code_point_offsets(self, tmp_path):
+        file_path = str(tmp_path / "report.pdf")
+        make_figure_pdf(file_path, pages=3)
+        for shard_pages in (None, 2):
+            parser = AzureAIDocumentIntelligenceParser("https://di.example.com", "key", shard_pages=shard_pages)
+            parser.client = SyntheticDocumentIntelligenceClient()
+            parser.analyze(file_path)
+            assert parser.client.calls and all(call["string_index_type"] == STRING_INDEX_TYPE for call in parser.client.calls)
+
+
+class StreamRecordingClient:
+    """Client checking that the request bodies are files opened for reading, never bytes in memory."""
+
+    def __init__(self, fail_on_page=None):
+        self.lock = threading.Lock()
+        self.bodies = []
+        self.fail_on_page = fail_on_page
+
+    def begin_analyze_document(self, model_id, body, **kwargs):
+        assert isinstance(body, io.BufferedReader) and body.mode == "rb" and not body.closed
+        assert body.tell() == 0
+        with self.lock:
+            self.bodies.append(body.name)
+        layout = synthetic_layout(body.read())
+        if self.fail_on_page is not None and os.path.basename(body.name) == f"{self.fail_on_page}.pdf":
+            raise RuntimeError("analysis failed")
+        return SimpleNamespace(result=lambda: AnalyzeResult(layout))
+
+
+class TestStreamedUpload:
+    def test_whole_file_streamed_from_the_file(self, tmp_path):
+        file_path = str(tmp_path / "report.pdf")
+        make_figure_pdf(file_path, pages=2)
+        parser = AzureAIDocumentIntelligenceParser("https://di.example.com", "key")
+        parser.client = StreamRecordingClient()
+        parser.analyze(file_path)
+        assert parser.client.bodies == [file_path]
+
+    def test_page_ranges_streamed_from_temporary_files(self, tmp_path):
+        file_path = str(tmp_path / "report.pdf")
+        make_figure_pdf(file_path, pages=5)
+        parser = AzureAIDocumentIntelligenceParser("https://di.example.com", "key", shard_pages=2)
+        parser.client = StreamRecordingClient()
+        parser.analyze(file_path)
+        assert sorted(os.path.basename(path) for path in parser.client.bodies) == ["1.pdf", "3.pdf", "5.pdf"]
+        # The ranges are removed once analyzed
+        assert not any(os.path.exists(path) for path in parser.client.bodies)
+
+    def test_temporary_files_removed_after_a_failure(self, tmp_path):
+        file_path = str(tmp_path / "report.pdf")
+        make_figure_pdf(file_path, pages=6)
+        parser = AzureAIDocumentIntelligenceParser("https://di.example.com", "key", shard_pages=1, shard_concurrency=1)
+        parser.client = StreamRecordingClient(fail_on_page=2)
+        with pytest.raises(RuntimeError):
+            parser.analyze(file_path)
+        # The ranges after the failed one are not submitted
+        assert len(parser.client.bodies) < 6
+        assert not any(os.path.exists(path) for path in parser.client.bodies)
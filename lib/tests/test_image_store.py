@@ -0,0 +1,93 @@
+import sys
+import os
+import base64
+import io
+
+import pytest
+from PIL import Image
+from langchain.schema import Document
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.image_store import IMAGE_REFERENCE_PREFIX, LocalImageStore, get_default_image_store, is_image_reference, set_default_image_store
+from its_a_rag.ingestion import advanced_text_splitter, multimodal_prompt
+
+
+def png_data_url(color=(255, 0, 0), size=(8, 8)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+class CountingImageStore(LocalImageStore):
+    def __init__(self, folder):
+        super().__init__(folder)
+        self.reads = 0
+
+    def _read(self, name):
+        self.reads += 1
+        return super()._read(name)
+
+
+class TestLocalImageStore:
+    def test_data_url_round_trip(self, tmp_path):
+        store = LocalImageStore(str(tmp_path / "images"))
+        data_url = png_data_url()
+        reference = store.put_data_url(data_url)
+        assert is_image_reference(reference) and reference.endswith(".png")
+        assert store.get_data_url(reference) == data_url
+        # Stored under the hash of the content, in a folder named after its first two characters
+        name = reference[len(IMAGE_REFERENCE_PREFIX):]
+        assert os.path.exists(tmp_path / "images" / name[:2] / name)
+
+    def test_same_image_stored_once(self, tmp_path):
+        store = LocalImageStore(str(tmp_path / "images"))
+        first = store.put_data_url(png_data_url())
+        assert store.put_data_url(png_data_url()) == first
+        assert store.put_data_url(png_data_url(color=(0, 0, 255))) != first
+        assert sum(len(files) for _, _, files in os.walk(tmp_path / "images")) == 2
+
+    def test_none_references_and_data_urls_returned_as_is(self, tmp_path):
+        store = LocalImageStore(str(tmp_path / "images"))
+        reference = store.put_data_url(png_data_url())
+        assert store.put_data_url(None) is None
+        assert store.put_data_url(reference) == reference
+        assert store.get_data_url(None) is None
+        assert store.get_data_url(png_data_url()) == png_data_url()
+
+    @pytest.mark.parametrize("reference", [IMAGE_REFERENCE_PREFIX, IMAGE_REFERENCE_PREFIX + "../secret.png", IMAGE_REFERENCE_PREFIX + "ab/c.png", IMAGE_REFERENCE_PREFIX + ".hidden"])
+    def test_invalid_references_are_rejected(self, tmp_path, reference):
+        with pytest.raises(ValueError):
+            LocalImageStore(str(tmp_path / "images")).get(reference)
+
+    def test_default_image_store(self, tmp_path):
+        store = LocalImageStore(str(tmp_path / "images"))
+        set_default_image_store(store)
+        try:
+            assert get_default_image_store() is store
+        finally:
+            set_default_image_store(None)
+        assert isinstance(get_default_image_store(), LocalImageStore) and get_default_image_store() is not store
+
+
+class TestOutOfBandImages:
+    def test_chunks_reference_the_images(self, tmp_path):
+        store = LocalImageStore(str(tmp_path / "images"))
+        red, blue = png_data_url(), png_data_url(color=(0, 0, 255))
+        doc = Document(page_content="# Title\n\n<figure>\n\n![](figures/0)\n\n</figure>\n\ntext\n\n<figure>\n\n![](figures/1)\n\n</figure>", metadata={"images": {0: red, 1: blue}})
+        chunks = advanced_text_splitter([doc], "f.pdf", store)
+        images = [chunk.metadata["image"] for chunk in chunks if chunk.metadata["image"]]
+        assert len(images) == 2 and all(is_image_reference(image) for image in images)
+        assert [store.get_data_url(image) for image in images] == [red, blue]
+        # Without an image store the chunks keep the data URLs
+        assert [chunk.metadata["image"] for chunk in advanced_text_splitter([doc], "f.pdf") if chunk.metadata["image"]] == [red, blue]
+
+    def test_images_loaded_only_when_building_the_prompt(self, tmp_path):
+        store = CountingImageStore(str(tmp_path / "images"))
+        data_url = png_data_url()
+        reference = store.put_data_url(data_url)
+        docs = [Document(page_content="figure", metadata={"image": reference}), Document(page_content="text", metadata={"image": None})]
+        assert store.reads == 0
+        messages = multimodal_prompt({"context": docs, "question": "what?"}, image_store=store, token_budget=None)
+        assert [part["image_url"]["url"] for part in messages[0].content if part["type"] == "image_url"] == [data_url]
+        assert store.reads == 1
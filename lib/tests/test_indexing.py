@@ -0,0 +1,185 @@
+import sys
+import os
+
+import pytest
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.indexing import ChunkManifest, add_documents, chunk_ids, delete_source, embed_texts, index_documents, source_name
+
+
+class FakeEmbeddings(Embeddings):
+    def __init__(self):
+        self.requests = []
+
+    def embed_documents(self, texts):
+        self.requests.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return [float(len(text)), 1.0]
+
+
+class FakeVectorStore:
+    """Vector store keeping the uploaded chunks in a dictionary."""
+
+    def __init__(self, embeddings=None):
+        self.embedding_function = embeddings
+        self.docs = {}
+        self.uploads = []
+        self.deletes = []
+
+    def add_embeddings(self, text_embeddings, metadatas, keys=None):
+        keys = list(keys)
+        self.uploads.append(keys)
+        for key, (text, vector), metadata in zip(keys, text_embeddings, metadatas):
+            self.docs[key] = (text, vector, metadata)
+        return keys
+
+    def delete(self, ids):
+        self.deletes.append(list(ids))
+        for doc_id in ids:
+            del self.docs[doc_id]
+
+
+def chunks(*texts, source="report.pdf"):
+    return [Document(page_content=text, metadata={"header": "{}", "source": source, "image": None}) for text in texts]
+
+
+class TestChunkManifest:
+    def test_recorded_sources_are_kept_after_reopening(self, tmp_path):
+        path = str(tmp_path / "manifest.sqlite")
+        manifest = ChunkManifest(path)
+        assert manifest.chunks("a/report.pdf") == {} and manifest.file_hash("a/report.pdf") is None
+        manifest.update("a/report.pdf", {"id1": "h1", "id2": "h2"}, "file hash")
+        manifest.update("b/report.pdf", {"id3": "h3"})
+        reopened = ChunkManifest(path)
+        assert reopened.chunks("a/report.pdf") == {"id1": "h1", "id2": "h2"}
+        assert reopened.file_hash("a/report.pdf") == "file hash"
+        assert reopened.sources() == ["a/report.pdf", "b/report.pdf"]
+
+    def test_update_replaces_the_chunks_of_the_source_only(self, tmp_path):
+        manifest = ChunkManifest(str(tmp_path / "manifest.sqlite"))
+        manifest.update("a.pdf", {"id1": "h1", "id2": "h2"}, "v1")
+        manifest.update("b.pdf", {"id3": "h3"}, "v1")
+        manifest.update("a.pdf", {"id4": "h4"}, "v2")
+        assert manifest.chunks("a.pdf") == {"id4": "h4"} and manifest.file_hash("a.pdf") == "v2"
+        assert manifest.chunks("b.pdf") == {"id3": "h3"}
+        manifest.remove("a.pdf")
+        assert manifest.sources() == ["b.pdf"] and manifest.chunks("a.pdf") == {}
+
+
+class TestSourceName:
+    def test_relative_normalized_path(self, tmp_path):
+        root = tmp_path / "filings"
+        assert source_name(str(root / "2023" / "." / "report.pdf"), str(root)) == "2023/report.pdf"
+        assert source_name(str(root / "2024" / ".." / "2023" / "report.pdf"), str(root)) == "2023/report.pdf"
+
+    def test_same_file_name_in_different_folders(self, tmp_path):
+        assert source_name(str(tmp_path / "2023" / "report.pdf"), str(tmp_path)) != source_name(str(tmp_path / "2024" / "report.pdf"), str(tmp_path))
+
+    def test_relative_to_the_current_folder_by_default(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        assert source_name("data/report.pdf") == source_name(str(tmp_path / "data" / "report.pdf")) == "data/report.pdf"
+
+
+class TestIndexDocuments:
+    def test_add_unchanged_and_delete(self, tmp_path):
+        manifest = ChunkManifest(str(tmp_path / "manifest.sqlite"))
+        embeddings = FakeEmbeddings()
+        store = FakeVectorStore(embeddings)
+
+        counts = index_documents(store, chunks("a", "b", "c"), "2023/report.pdf", manifest, "v1")
+        assert counts == {"added": 3, "deleted": 0, "unchanged": 0}
+        assert sorted(text for text, _, _ in store.docs.values()) == ["a", "b", "c"]
+
+        # Nothing changed: nothing is embedded, uploaded or deleted
+        requests = len(embeddings.requests)
+        counts = index_documents(store, chunks("a", "b", "c"), "2023/report.pdf", manifest, "v1")
+        assert counts == {"added": 0, "deleted": 0, "unchanged": 3}
+        assert len(embeddings.requests) == requests and len(store.uploads) == 1 and store.deletes == []
+
+        # One chunk changed: it is uploaded and the previous one deleted
+        counts = index_documents(store, chunks("a", "b", "c2"), "2023/report.pdf", manifest, "v2")
+        assert counts == {"added": 1, "deleted": 1, "unchanged": 2}
+        assert embeddings.requests[-1] == ["c2"]
+        assert sorted(text for text, _, _ in store.docs.values()) == ["a", "b", "c2"]
+        assert set(manifest.chunks("2023/report.pdf")) == set(store.docs) and manifest.file_hash("2023/report.pdf") == "v2"
+
+    def test_files_with_the_same_name_do_not_share_chunks(self, tmp_path):
+        manifest = ChunkManifest(str(tmp_path / "manifest.sqlite"))
+        store = FakeVectorStore(FakeEmbeddings())
+        index_documents(store, chunks("a", "b"), "2023/report.pdf", manifest)
+        index_documents(store, chunks("a", "c"), "2024/report.pdf", manifest)
+        assert len(store.docs) == 4
+        # Re-indexing one of them does not delete the chunks of the other
+        counts = index_documents(store, chunks("a"), "2024/report.pdf", manifest)
+        assert counts == {"added": 0, "deleted": 1, "unchanged": 1}
+        assert sorted(text for text, _, _ in store.docs.values()) == ["a", "a", "b"]
+        assert set(manifest.chunks("2023/report.pdf")) <= set(store.docs)
+
+    def test_identical_chunks_get_distinct_ids(self):
+        ids = chunk_ids(chunks("same", "same", "other"), "report.pdf")
+        assert len({doc_id for doc_id, _ in ids}) == 3
+        assert ids == chunk_ids(chunks("same", "same", "other"), "report.pdf")
+        assert ids[0][1] == ids[1][1]
+
+    def test_delete_source(self, tmp_path):
+        manifest = ChunkManifest(str(tmp_path / "manifest.sqlite"))
+        store = FakeVectorStore(FakeEmbeddings())
+        index_documents(store, chunks("a", "b"), "2023/report.pdf", manifest)
+        index_documents(store, chunks("c"), "2024/report.pdf", manifest)
+        assert delete_source(store, "2023/report.pdf", manifest) == 2
+        assert [text for text, _, _ in store.docs.values()] == ["c"]
+        assert manifest.sources() == ["2024/report.pdf"]
+        assert delete_source(store, "2023/report.pdf", manifest) == 0
+
+
+class TestEmbedTexts:
+    def test_each_distinct_text_embedded_once(self):
+        embeddings = FakeEmbeddings()
+        texts = ["a", "bb", "a", "ccc", "bb", "a"]
+        vectors = embed_texts(texts, embeddings, batch_size=2)
+        assert vectors == [[float(len(text)), 1.0] for text in texts]
+        # Batches of distinct texts, in order of first appearance
+        assert embeddings.requests == [["a", "bb"], ["ccc"]]
+
+    def test_no_texts(self):
+        embeddings = FakeEmbeddings()
+        assert embed_texts([], embeddings) == []
+        assert embeddings.requests == []
+
+
+class TestAddDocuments:
+    def test_figure_chunks_share_one_embedding(self):
+        # advanced_text_splitter makes one chunk per figure of a part, with the same text
+        embeddings = FakeEmbeddings()
+        store = FakeVectorStore(embeddings)
+        docs = [Document(page_content="chart of two figures", metadata={"image": f"image {idx}"}) for idx in range(2)] + chunks("text")
+        ids = add_documents(store, docs, ["id0", "id1", "id2"], embed_batch_size=10, upload_batch_size=2)
+        assert ids == ["id0", "id1", "id2"]
+        assert embeddings.requests == [["chart of two figures", "text"]]
+        assert store.uploads == [["id0", "id1"], ["id2"]]
+        assert store.docs["id0"][1] == store.docs["id1"][1] and store.docs["id1"][2] == {"image": "image 1"}
+
+    def test_embeddings_of_the_vector_store_are_used_by_default(self):
+        embeddings = FakeEmbeddings()
+        store = FakeVectorStore()
+        # create_multimodal_vector_store gives the bound embed_query of the model
+        store.embedding_function = embeddings.embed_query
+        add_documents(store, chunks("a", "b"), ["id0", "id1"])
+        assert embeddings.requests == [["a", "b"]]
+
+    def test_vector_store_without_embeddings(self):
+        class Store:
+            def add_documents(self, documents, ids=None):
+                self.added = (documents, ids)
+                return ids
+
+        store = Store()
+        docs = chunks("a")
+        assert add_documents(store, docs, ["id0"]) == ["id0"]
+        assert store.added == (docs, ["id0"])
+        assert add_documents(store, []) == []
@@ -0,0 +1,203 @@
+import sys
+import os
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag import local_store
+from its_a_rag.bm25 import RRF_K, reciprocal_rank_fusion, tokenize
+from its_a_rag.local_store import LocalVectorStore
+
+DIMENSIONS = 32
+
+# Topics of the words, so that synonyms get similar vectors (what the keyword search misses)
+TOPICS = {"revenue": 0, "sales": 0, "turnover": 0, "azure": 1, "cloud": 1, "costs": 2, "expenses": 2, "xbox": 3, "gaming": 3}
+
+FILINGS = {
+    "azure": "Azure revenue grew 28%",
+    "cloud": "Cloud sales increased in every region",
+    "gaming": "Xbox gaming turnover declined",
+    "costs": "Operating expenses were stable",
+    "code": "Segment code AZ-7781 was retired",
+}
+
+
+def random_vectors(count, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, DIMENSIONS)).astype(np.float32)
+
+
+def make_store(vectors, quantize=False, folder=None, metadatas=None):
+    store = LocalVectorStore(lambda text: pytest.fail("no embedding expected"), folder=folder, quantize=quantize, lexical=False)
+    store.add_embeddings([(f"text {i}", vector) for i, vector in enumerate(vectors)], metadatas, keys=[f"id{i}" for i in range(len(vectors))])
+    return store
+
+
+def topic_embedding(text):
+    vector = [0.0] * (len(set(TOPICS.values())) + 1)
+    for token in tokenize(text):
+        vector[TOPICS.get(token, -1)] += 1.0
+    return vector
+
+
+def make_filings_store(**kwargs):
+    store = LocalVectorStore(topic_embedding, **kwargs)
+    store.add_texts(FILINGS.values(), [{"source": f"{key}.pdf"} for key in FILINGS], keys=list(FILINGS))
+    return store
+
+
+def brute_force(vectors, queries, k):
+    # Ids of the k most similar vectors of each query (cosine similarity)
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = queries @ vectors.T
+    return [[f"id{i}" for i in np.argsort(-row, kind="stable")[:k]] for row in scores], scores
+
+
+def result_ids(results):
+    return [[doc.id for doc, _ in query_results] for query_results in results]
+
+
+def recall(results, expected):
+    return np.mean([len(set(found) & set(ids)) / len(ids) for found, ids in zip(results, expected)])
+
+
+class TestSearch:
+    def test_float32_same_results_as_brute_force(self):
+        vectors, queries = random_vectors(500), random_vectors(20, seed=1)
+        expected, scores = brute_force(vectors, queries, 10)
+        results = make_store(vectors).search_by_vectors(queries, k=10)
+        assert result_ids(results) == expected
+        for query, query_results in enumerate(results):
+            assert [score for _, score in query_results] == pytest.approx(sorted(scores[query], reverse=True)[:10], abs=1e-5)
+
+    def test_int8_recall(self):
+        vectors, queries = random_vectors(2000), random_vectors(50, seed=1)
+        expected, scores = brute_force(vectors, queries, 10)
+        store = make_store(vectors, quantize=True)
+        assert store._vectors.dtype == np.int8
+        results = store.search_by_vectors(queries, k=10)
+        assert recall(result_ids(results), expected) >= 0.9
+        # The dequantized scores stay close to the exact similarities
+        for query, query_results in enumerate(results):
+            for doc, score in query_results:
+                assert score == pytest.approx(scores[query, int(doc.id[2:])], abs=0.02)
+
+    @pytest.mark.parametrize("quantize", [False, True])
+    def test_top_k_across_blocks(self, monkeypatch, quantize):
+        # The k best of each block are merged: same results as one block
+        vectors, queries = random_vectors(300), random_vectors(10, seed=1)
+        store = make_store(vectors, quantize=quantize)
+        whole = result_ids(store.search_by_vectors(queries, k=7))
+        for block_size in (1, 5, 64, 299):
+            monkeypatch.setattr(local_store, "SEARCH_BLOCK_SIZE", block_size)
+            assert result_ids(store.search_by_vectors(queries, k=7)) == whole
+
+    def test_k_larger_than_the_store_and_filter(self, monkeypatch):
+        monkeypatch.setattr(local_store, "SEARCH_BLOCK_SIZE", 2)
+        vectors = random_vectors(5)
+        store = make_store(vectors, metadatas=[{"source": "a.pdf" if i % 2 else "b.pdf"} for i in range(5)])
+        assert len(store.search_by_vectors(vectors[:1], k=10)[0]) == 5
+        results = store.search_by_vectors(vectors[:1], k=10, filter={"source": "a.pdf"})[0]
+        assert sorted(doc.id for doc, _ in results) == ["id1", "id3"]
+
+    def test_replace_and_delete(self):
+        vectors = random_vectors(3)
+        store = make_store(vectors)
+        store.add_embeddings([("replaced", vectors[2])], keys=["id0"])
+        assert len(store) == 3
+        assert store.search_by_vectors(vectors[2:], k=2)[0][0][0].id in ("id0", "id2")
+        assert store.delete(["id1", "unknown"]) is True
+        assert [doc.id for doc in store.get_by_ids(["id0", "id1", "id2"])] == ["id0", "id2"]
+        assert store.get_by_ids(["id0"])[0].page_content == "replaced"
+
+
+class TestPersistence:
+    @pytest.mark.parametrize("quantize", [False, True])
+    def test_save_and_load_round_trip(self, tmp_path, quantize):
+        vectors, queries = random_vectors(200), random_vectors(5, seed=1)
+        metadatas = [{"source": f"{i % 3}.pdf", "header": "{}", "image": None} for i in range(200)]
+        store = make_store(vectors, quantize=quantize, folder=str(tmp_path / "store"), metadatas=metadatas)
+        store.save()
+        loaded = LocalVectorStore.load(str(tmp_path / "store"), store.embedding_function)
+        # The vectors are memory-mapped read-only
+        assert isinstance(loaded._vectors, np.memmap) and not loaded._vectors.flags.writeable
+        assert len(loaded) == 200 and loaded.quantize == quantize
+        assert loaded.get_by_ids(["id7"])[0].metadata == metadatas[7]
+        assert result_ids(loaded.search_by_vectors(queries, k=5)) == result_ids(store.search_by_vectors(queries, k=5))
+
+        # Changing a loaded store copies it in memory, the saved files are unchanged
+        loaded.add_embeddings([("new", random_vectors(1, seed=2)[0])], keys=["new"])
+        loaded.delete(["id0"])
+        assert len(loaded) == 200 and len(LocalVectorStore.load(str(tmp_path / "store"), store.embedding_function)) == 200
+
+    def test_load_without_mmap(self, tmp_path):
+        store = make_store(random_vectors(10), folder=str(tmp_path / "store"))
+        store.save()
+        loaded = LocalVectorStore.load(str(tmp_path / "store"), store.embedding_function, mmap=False)
+        assert not isinstance(loaded._vectors, np.memmap)
+        assert np.array_equal(loaded._vectors, store._vectors[:10])
+
+    def test_load_or_create(self, tmp_path):
+        folder = str(tmp_path / "store")
+        store = LocalVectorStore.load_or_create(folder, lambda text: [1.0, 0.0])
+        assert len(store) == 0 and store.folder == folder
+        store.add_texts(["a", "b"])
+        store.save()
+        assert len(LocalVectorStore.load_or_create(folder, lambda text: [1.0, 0.0])) == 2
+
+    def test_empty_store(self, tmp_path):
+        store = LocalVectorStore(lambda text: [1.0], folder=str(tmp_path / "store"))
+        store.save()
+        loaded = LocalVectorStore.load(str(tmp_path / "store"), store.embedding_function)
+        assert len(loaded) == 0 and loaded.search_by_vectors([[1.0]], k=3) == [[]]
+
+
+class TestHybridSearch:
+    def test_ranking(self):
+        store = make_filings_store()
+        # Only the keyword search finds the exact code, only the vector search finds the synonyms
+        assert store.hybrid_search("az-7781", k=1)[0].id == "code"
+        assert store.hybrid_search("cloud turnover", k=3)[0].id in ("cloud", "gaming")
+        # "azure revenue" is ranked first by both searches
+        results = store.hybrid_search_with_score("azure revenue", k=5)
+        assert [doc.id for doc, _ in results][:2] == ["azure", "cloud"]
+        assert results[0][0].page_content == FILINGS["azure"] and results[0][0].metadata == {"source": "azure.pdf"}
+
+    def test_fused_score_normalized(self):
+        store = make_filings_store()
+        results = store.hybrid_search_with_score("azure revenue", k=5)
+        assert results[0][1] == pytest.approx(1.0)
+        assert all(0 < score <= 1 for _, score in results)
+        assert [score for _, score in results] == sorted((score for _, score in results), reverse=True)
+        # Reciprocal rank fusion of both searches, divided by the best possible fused score
+        vector_ids = [doc.id for doc, _ in store.similarity_search_with_score("azure revenue", k=30)]
+        lexical_ids = [key for key, _ in store.lexical_index.search("azure revenue", k=30)]
+        fused = dict(reciprocal_rank_fusion([vector_ids, lexical_ids]))
+        assert {doc.id: score for doc, score in results} == pytest.approx({key: fused[key] * (RRF_K + 1) / 2 for key in (doc.id for doc, _ in results)})
+
+    def test_filter(self):
+        store = make_filings_store()
+        assert [doc.id for doc in store.hybrid_search("azure revenue", k=5, filter={"source": "cloud.pdf"})] == ["cloud"]
+
+    def test_without_bm25_index(self):
+        store = make_filings_store(lexical=False)
+        with pytest.raises(ValueError):
+            store.hybrid_search("azure")
+
+    def test_retriever_score_threshold(self):
+        store = make_filings_store()
+        retriever = store.as_retriever(search_type="hybrid_score_threshold", search_kwargs={"k": 5, "score_threshold": 0.9})
+        assert [doc.id for doc in retriever.invoke("azure revenue")] == ["azure"]
+        retriever = store.as_retriever(search_type="hybrid_score_threshold", search_kwargs={"k": 5, "score_threshold": 0.0})
+        assert len(retriever.invoke("azure revenue")) == 5
+        assert [doc.id for doc in store.as_retriever(search_type="hybrid", search_kwargs={"k": 2}).invoke("azure revenue")] == ["azure", "cloud"]
+
+    def test_bm25_index_saved_with_the_store(self, tmp_path):
+        store = make_filings_store(folder=str(tmp_path / "store"))
+        store.delete(["costs"])
+        store.save()
+        loaded = LocalVectorStore.load(str(tmp_path / "store"), topic_embedding)
+        assert loaded.hybrid_search_with_score("azure revenue", k=5) == store.hybrid_search_with_score("azure revenue", k=5)
+        assert loaded.lexical_index.search("expenses") == []
@@ -0,0 +1,124 @@
+import sys
+import os
+
+import pymupdf
+import pytest
+from langchain_openai import AzureOpenAIEmbeddings
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'benchmarks')))
+
+from fake_services import FakeAzureServices
+from its_a_rag.indexing import ChunkManifest
+from its_a_rag.doc_intelligence import AzureAIDocumentIntelligenceParser, VisionClient
+from its_a_rag.local_store import LocalVectorStore
+from its_a_rag.pipeline import IngestionPipeline, list_files
+
+API_VERSION = "2024-10-21"
+
+
+def make_report(path, company, pages=2):
+    # A title, paragraphs and one bar chart (vector drawing) per page
+    doc = pymupdf.open()
+    for n in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"{company} annual report part {n}", fontsize=20)
+        page.insert_text((72, 110), f"The revenue of {company} grew in year {2020 + n}.", fontsize=10)
+        page.insert_text((72, 124), "Operating expenses were stable over the period.", fontsize=10)
+        page.draw_rect(pymupdf.Rect(90, 180, 290, 360), color=(0, 0, 0))
+        for bar in range(4):
+            page.draw_rect(pymupdf.Rect(100 + 40 * bar, 350 - 30 * (bar + n), 130 + 40 * bar, 350), color=(0, 0, 0), fill=(0.2 * bar, 0.4, 0.8))
+        page.insert_text((72, 400), f"Details of the {company} segments follow.", fontsize=10)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+@pytest.fixture
+def services():
+    with FakeAzureServices(di_latency=0, vision_latency=0, embedding_latency=0, embedding_dimensions=64, analysis_cache_folder=None) as services:
+        yield services
+
+
+def make_pipeline(services, folder, save_images=True, **kwargs):
+    vision_client = VisionClient("fake", services.endpoint, API_VERSION, "gpt-4o")
+    parser = AzureAIDocumentIntelligenceParser(api_endpoint=services.endpoint, api_key="fake", vision_client=vision_client, save_images=save_images)
+    embeddings = AzureOpenAIEmbeddings(azure_endpoint=services.endpoint, api_key="fake", api_version=API_VERSION, azure_deployment="embedding", check_embedding_ctx_length=False)
+    vector_store = LocalVectorStore(embeddings, folder=str(folder / "vector_store"))
+    pipeline = IngestionPipeline(parser, vector_store, analysis_workers=2, crop_workers=1, description_workers=2, output_folder=str(folder / "images"), progress=lambda result: None, embeddings=embeddings, **kwargs)
+    return pipeline, vision_client
+
+
+class TestIngestionPipeline:
+    def test_files_are_analyzed_described_and_indexed(self, services, tmp_path):
+        files = [make_report(str(tmp_path / f"{company}.pdf"), company) for company in ("contoso", "fabrikam", "northwind")]
+        pipeline, vision_client = make_pipeline(services, tmp_path)
+        try:
+            results = pipeline.run(files)
+        finally:
+            vision_client.close()
+        assert [result.file_path for result in results] == files
+        assert all(result.status == "indexed" and result.error is None for result in results), results
+        assert all(result.figures == 2 and result.chunks > 0 and result.added == result.chunks for result in results)
+        assert all(set(result.timings) == {"analyze", "crop", "describe", "split", "index"} for result in results)
+        assert services.counters["analyze"] == 3 and services.counters["chat"] == 6
+
+        # The local store is saved at the end of the run
+        vector_store = LocalVectorStore.load_or_create(str(tmp_path / "vector_store"), pipeline.vector_store.embedding_function)
+        assert len(vector_store) == sum(result.chunks for result in results)
+        docs = vector_store.similarity_search("revenue of fabrikam", k=1)
+        assert docs[0].metadata["source"] == "fabrikam.pdf"
+        figure_chunks = [doc for doc in vector_store.similarity_search("bar chart of the revenue", k=20) if doc.metadata.get("image")]
+        assert figure_chunks and all(doc.metadata["image"].startswith("data:image/png;base64,") for doc in figure_chunks)
+
+    def test_failed_file_does_not_stop_the_others(self, services, tmp_path):
+        good = make_report(str(tmp_path / "contoso.pdf"), "contoso")
+        missing = str(tmp_path / "missing.pdf")
+        pipeline, vision_client = make_pipeline(services, tmp_path)
+        try:
+            results = pipeline.run([missing, good])
+        finally:
+            vision_client.close()
+        assert results[0].status == "failed" and results[0].stage == "analyze" and "FileNotFoundError" in results[0].error
+        assert results[1].status == "indexed"
+
+    def test_nothing_is_written_to_the_output_folder_without_save_images(self, services, tmp_path):
+        files = [make_report(str(tmp_path / f"{company}.pdf"), company) for company in ("contoso", "fabrikam")]
+        pipeline, vision_client = make_pipeline(services, tmp_path, save_images=False)
+        try:
+            results = pipeline.run(files)
+        finally:
+            vision_client.close()
+        assert all(result.status == "indexed" and result.figures == 2 for result in results)
+        assert not (tmp_path / "images").exists()
+
+    def test_incremental_indexing_with_the_manifest(self, services, tmp_path):
+        # Two filings with the same file name in different folders
+        os.makedirs(tmp_path / "2023")
+        os.makedirs(tmp_path / "2024")
+        files = [make_report(str(tmp_path / "2023" / "report.pdf"), "contoso"), make_report(str(tmp_path / "2024" / "report.pdf"), "fabrikam")]
+        manifest = ChunkManifest(str(tmp_path / "manifest.sqlite"))
+        pipeline, vision_client = make_pipeline(services, tmp_path, manifest=manifest, source_root=str(tmp_path))
+        try:
+            results = pipeline.run(files)
+            assert all(result.status == "indexed" and result.added == result.chunks for result in results)
+            assert manifest.sources() == ["2023/report.pdf", "2024/report.pdf"]
+            assert len(pipeline.vector_store) == sum(result.chunks for result in results)
+
+            # Unchanged files are skipped
+            assert [result.status for result in pipeline.run(files)] == ["unchanged", "unchanged"]
+
+            # A changed file only replaces its own chunks
+            make_report(files[1], "fabrikam", pages=1)
+            results = pipeline.run(files)
+        finally:
+            vision_client.close()
+        assert [result.status for result in results] == ["unchanged", "indexed"]
+        assert results[1].deleted > 0
+        assert set(pipeline.vector_store._ids) == set(manifest.chunks("2023/report.pdf")) | set(manifest.chunks("2024/report.pdf"))
+
+    def test_list_files(self, tmp_path):
+        for name in ("b.pdf", "a.pdf", "notes.txt"):
+            (tmp_path / name).write_bytes(b"")
+        assert list_files([str(tmp_path)]) == [str(tmp_path / "a.pdf"), str(tmp_path / "b.pdf")]
+        assert list_files([str(tmp_path / "*.txt"), str(tmp_path / "a.pdf")]) == [str(tmp_path / "a.pdf"), str(tmp_path / "notes.txt")]
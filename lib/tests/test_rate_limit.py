@@ -0,0 +1,145 @@
+import sys
+import os
+import email.utils
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.rate_limit import BULK, INTERACTIVE, RateLimiter, TokenBucket, get_rate_limiter, retry_after
+
+
+class FakeError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = type("Response", (), {"headers": headers or {}, "status_code": status_code})()
+
+
+def queue_requests(limiter, requests):
+    # Start the requests one by one, each queued before the next one starts
+    granted = []
+    threads = []
+    for name, priority in requests:
+        def run(name=name, priority=priority):
+            limiter.acquire(priority=priority)
+            granted.append(name)
+        queued = len(limiter._queue)
+        thread = threading.Thread(target=run)
+        thread.start()
+        while len(limiter._queue) == queued:
+            time.sleep(0.001)
+        threads.append(thread)
+    for thread in threads:
+        thread.join(timeout=10)
+    return granted
+
+
+class TestRateLimiter:
+    def test_interactive_lane_first_then_arrival_order(self):
+        # One request every 50 ms, held while the requests are queued
+        limiter = RateLimiter(requests_per_minute=1200, burst_seconds=0.05)
+        limiter.acquire()
+        limiter.pause(0.5)
+        granted = queue_requests(limiter, [("bulk 1", BULK), ("bulk 2", BULK), ("interactive 1", INTERACTIVE), ("bulk 3", BULK), ("interactive 2", INTERACTIVE)])
+        assert granted == ["interactive 1", "interactive 2", "bulk 1", "bulk 2", "bulk 3"]
+        assert limiter.granted == 6
+
+    def test_requests_are_spaced_by_the_quota(self):
+        limiter = RateLimiter(requests_per_minute=1200, burst_seconds=0.05)
+        start = time.monotonic()
+        for _ in range(5):
+            limiter.acquire()
+        # The first request is in the bucket, the next ones come every 50 ms
+        assert time.monotonic() - start >= 0.19
+
+    def test_retries_throttled_requests(self):
+        limiter = RateLimiter(backoff_base=0.001, seed=0)
+        attempts = []
+
+        def request():
+            attempts.append(time.monotonic())
+            if len(attempts) < 3:
+                raise FakeError(429, {"retry-after-ms": "20"})
+            return "ok"
+
+        assert limiter.call(request) == "ok"
+        assert len(attempts) == 3 and limiter.throttled == 2
+        assert attempts[1] - attempts[0] >= 0.02
+
+    def test_does_not_retry_client_errors(self):
+        limiter = RateLimiter(backoff_base=0.001)
+        attempts = []
+
+        def request():
+            attempts.append(1)
+            raise FakeError(400)
+
+        with pytest.raises(FakeError):
+            limiter.call(request)
+        assert len(attempts) == 1
+
+    def test_gives_up_after_max_retries(self):
+        limiter = RateLimiter(max_retries=2, backoff_base=0.001)
+        attempts = []
+
+        def request():
+            attempts.append(1)
+            raise FakeError(503)
+
+        with pytest.raises(FakeError):
+            limiter.call(request)
+        assert len(attempts) == 3
+
+
+class TestTokenBucket:
+    def test_request_larger_than_the_bucket_leaves_it_in_debt(self):
+        bucket = TokenBucket(per_minute=600, burst_seconds=1)
+        now = bucket.updated
+        assert bucket.wait_time(50, now) == 0
+        bucket.take(50)
+        assert bucket.level == -40
+        assert bucket.wait_time(1, now) == pytest.approx(4.1)
+
+
+class TestRetryAfter:
+    def test_milliseconds_first(self):
+        assert retry_after(FakeError(429, {"retry-after-ms": "1500", "retry-after": "9"})) == 1.5
+        assert retry_after(FakeError(429, {"x-ms-retry-after-ms": "250"})) == 0.25
+
+    def test_seconds(self):
+        assert retry_after(FakeError(429, {"retry-after": "3"})) == 3.0
+
+    def test_http_date(self):
+        delay = retry_after(FakeError(429, {"retry-after": email.utils.formatdate(time.time() + 30, usegmt=True)}))
+        assert 28 <= delay <= 30
+        assert retry_after(FakeError(429, {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0.0
+
+    @pytest.mark.parametrize("headers", [{}, {"retry-after": "soon"}, {"retry-after": "Wed, 99 Foo 2015"}, {"retry-after-ms": "x"}])
+    def test_missing_or_malformed(self, headers):
+        assert retry_after(FakeError(429, headers)) is None
+
+    def test_without_response(self):
+        assert retry_after(ValueError("no response")) is None
+
+    def test_malformed_header_falls_back_to_the_backoff(self):
+        limiter = RateLimiter(requests_per_minute=6000, max_retries=2, backoff_base=0.01)
+        attempts = []
+
+        def request():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise FakeError(429, {"retry-after": "not a date"})
+            return "ok"
+
+        assert limiter.call(request) == "ok" and len(attempts) == 2
+
+
+class TestGetRateLimiter:
+    def test_one_limiter_per_deployment(self):
+        limiter = get_rate_limiter("test-deployment-a", "600", None)
+        assert limiter is not None and get_rate_limiter("test-deployment-a") is limiter
+        assert get_rate_limiter("test-deployment-b", 600) is not limiter
+        assert get_rate_limiter("test-deployment-c") is None
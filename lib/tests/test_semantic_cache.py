@@ -0,0 +1,106 @@
+import sys
+import os
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.indexing import INDEX_VERSION_ENV, publish_index_version
+from its_a_rag.semantic_cache import SemanticCache, index_version_from_env, question_numbers
+
+# Embeddings of the test questions: the first two are similar, the third is not
+EMBEDDINGS = {
+    "what is the revenue of nvidia?": [1.0, 0.0, 0.0],
+    "what's nvidia's revenue?": [0.99, 0.1, 0.0],
+    "who is the ceo of nvidia?": [0.0, 1.0, 0.0],
+    "what is the revenue of nvidia in 2022?": [1.0, 0.0, 0.01],
+    "what is the revenue of nvidia in 2023?": [1.0, 0.0, 0.02],
+}
+
+
+class Embedder:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, question):
+        self.calls += 1
+        return EMBEDDINGS[question.lower()]
+
+
+class TestSemanticCache:
+    def test_exact_and_similar_questions(self):
+        embedder = Embedder()
+        cache = SemanticCache(embedder)
+        assert cache.get("What is the revenue of NVIDIA?") is None
+        cache.put("What is the revenue of NVIDIA?", "60 billion")
+        # The embedding of the miss is reused by put
+        assert embedder.calls == 1
+        assert cache.get("  what is the revenue of   nvidia? ") == "60 billion"
+        assert cache.get("What's NVIDIA's revenue?") == "60 billion"
+        assert cache.get("Who is the CEO of NVIDIA?") is None
+
+    def test_questions_with_different_numbers_do_not_match(self):
+        cache = SemanticCache(Embedder())
+        cache.put("What is the revenue of NVIDIA in 2022?", "27 billion")
+        assert question_numbers("What is the revenue of NVIDIA in 2023?") == ("2023",)
+        assert cache.get("What is the revenue of NVIDIA in 2023?") is None
+
+    def test_cleared_when_the_index_version_changes(self):
+        version = [1]
+        cache = SemanticCache(Embedder(), index_version=lambda: version[0])
+        cache.put("What is the revenue of NVIDIA?", "60 billion")
+        assert cache.get("What is the revenue of NVIDIA?") == "60 billion"
+        version[0] = 2
+        assert cache.get("What is the revenue of NVIDIA?") is None
+        assert len(cache) == 0
+
+    def test_expired_answers_are_not_returned(self):
+        cache = SemanticCache(Embedder(), ttl=0)
+        cache.put("What is the revenue of NVIDIA?", "60 billion")
+        assert cache.get("What is the revenue of NVIDIA?") is None
+
+    def test_least_recently_used_evicted(self):
+        cache = SemanticCache(Embedder(), max_entries=2)
+        cache.put("What is the revenue of NVIDIA?", "60 billion")
+        cache.put("Who is the CEO of NVIDIA?", "Jensen Huang")
+        cache.get("What is the revenue of NVIDIA?")
+        cache.put("What is the revenue of NVIDIA in 2022?", "27 billion")
+        assert len(cache) == 2
+        assert cache.get("Who is the CEO of NVIDIA?") is None
+        assert cache.get("What is the revenue of NVIDIA?") == "60 billion"
+
+    def test_streamed_answer_is_cached_and_replayed(self):
+        cache = SemanticCache(Embedder())
+
+        async def stream():
+            for chunk in ["Jensen ", "Huang"]:
+                yield chunk
+
+        async def collect():
+            return "".join([chunk async for chunk in cache.astream("Who is the CEO of NVIDIA?", stream)])
+
+        assert asyncio.run(collect()) == "Jensen Huang"
+        assert cache.get("Who is the CEO of NVIDIA?") == "Jensen Huang"
+        assert asyncio.run(collect()) == "Jensen Huang"
+        assert cache.hits == 2
+
+
+class TestIndexVersionFromEnv:
+    def test_not_configured(self, monkeypatch):
+        monkeypatch.delenv(INDEX_VERSION_ENV, raising=False)
+        assert index_version_from_env() is None
+
+    def test_missing_file(self, monkeypatch, tmp_path):
+        monkeypatch.setenv(INDEX_VERSION_ENV, str(tmp_path / "index_version.json"))
+        assert index_version_from_env() is None
+
+    def test_cache_cleared_when_a_version_is_published(self, monkeypatch, tmp_path):
+        path = str(tmp_path / "index_version.json")
+        monkeypatch.setenv(INDEX_VERSION_ENV, path)
+        publish_index_version(path, "index")
+        cache = SemanticCache(Embedder(), index_version=index_version_from_env())
+        cache.put("What is the revenue of NVIDIA?", "60 billion")
+        assert cache.get("What is the revenue of NVIDIA?") == "60 billion"
+        publish_index_version(path, "index")
+        assert cache.get("What is the revenue of NVIDIA?") is None
@@ -0,0 +1,120 @@
+import sys
+import os
+import json
+import random
+from types import SimpleNamespace
+
+import pytest
+from langchain.schema import Document
+from langchain_text_splitters import MarkdownHeaderTextSplitter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.doc_intelligence import PAGE_BREAK, find_stream_sections
+from its_a_rag.ingestion import HEADERS_TO_SPLIT_ON, CustomCharacterTextSplitter, advanced_text_splitter, find_figure_indices
+
+
+# Lines the random documents are made of: headers of every level, code fences, blank lines and figures
+FRAGMENTS = [
+    "# A", "## B", "### C", "#### D", "######## eight", "######### nine", "#", "##", "#nospace", "  # indented",
+    "```", "```py```", "~~~", "text", "more text", "", "", "  ", "\t",
+    "<figure>", "</figure>", "<figure>x</figure>", "![](figures/0)", "![](figures/1) and ![](figures/2)",
+    "<figure>\n![](figures/3)\n</figure>", "text <figure>![](figures/4)", "y</figure> tail",
+]
+IMAGES = {idx: f"image {idx}" for idx in range(5)}
+
+
+def random_markdown(seed, lines=60):
+    rnd = random.Random(seed)
+    return "\n".join(rnd.choice(FRAGMENTS) for _ in range(rnd.randint(0, lines)))
+
+
+# Implementation of advanced_text_splitter before the single-pass splitter
+def reference_text_splitter(docs, pdf_file_name):
+    text_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=HEADERS_TO_SPLIT_ON)
+    docs_result = text_splitter.split_text(docs[0].page_content)
+    text_splitter = CustomCharacterTextSplitter(separator=r'(<figure>.*?</figure>)', is_separator_regex=True)
+    lst_docs = []
+    for doc in text_splitter.split_documents(docs_result):
+        figure_indices = find_figure_indices(doc.page_content)
+        for figure_indice in figure_indices or [None]:
+            image = docs[0].metadata['images'][figure_indice] if figure_indice is not None else None
+            lst_docs.append(Document(page_content=doc.page_content, metadata={"header": json.dumps(doc.metadata), "source": pdf_file_name, "image": image}))
+    return lst_docs
+
+
+def random_sections_markdown(seed):
+    rnd = random.Random(seed)
+    return "\n\n".join(f"{'#' * rnd.randint(1, 3)} Section {n}\n\n" + "lorem ipsum " * rnd.randint(1, 20) for n in range(rnd.randint(1, 30)))
+
+
+def section_documents(md, sections):
+    return [Document(page_content=md[start:end], metadata={"images": {}, "headers": headers}) for start, end, headers in sections]
+
+
+def paged_result(md):
+    # Analysis result whose pages start after each page break
+    offsets = [0]
+    while (offset := md.find(PAGE_BREAK, offsets[-1])) != -1:
+        offsets.append(offset + len(PAGE_BREAK))
+    return SimpleNamespace(pages=[SimpleNamespace(spans=[SimpleNamespace(offset=offset, length=0)]) for offset in offsets])
+
+
+class TestStreamedSections:
+    @pytest.mark.parametrize("seed", range(50))
+    def test_same_chunks_as_the_whole_document(self, seed):
+        # Sections cut at the safe header boundaries give the chunks of the whole document
+        md = random_sections_markdown(seed)
+        sections = find_stream_sections(md, SimpleNamespace(pages=[]), "section", section_size=random.Random(seed).randint(1, 200))
+        docs = section_documents(md, sections)
+        whole = [Document(page_content=md, metadata={"images": {}})]
+        assert "".join(doc.page_content for doc in docs) == md
+        assert advanced_text_splitter(docs, "f.pdf") == advanced_text_splitter(whole, "f.pdf")
+
+    @pytest.mark.parametrize("seed", range(50))
+    def test_each_section_split_as_it_arrives(self, seed):
+        # Splitting the sections one at a time gives the chunks of the whole document, with the enclosing headers
+        md = random_sections_markdown(seed)
+        sections = find_stream_sections(md, SimpleNamespace(pages=[]), "section", section_size=random.Random(seed).randint(1, 200))
+        chunks = [chunk for doc in section_documents(md, sections) for chunk in advanced_text_splitter([doc], "f.pdf")]
+        assert chunks == advanced_text_splitter([Document(page_content=md, metadata={"images": {}})], "f.pdf")
+
+    def test_mid_document_section_keeps_the_enclosing_headers(self):
+        md = "# Annual report\n\nintro\n\n## Revenue\n\nfirst part\n\n### By segment\n\ncloud\n\n## Costs\n\nstable"
+        start = md.index("### By segment")
+        end = md.index("## Costs")
+        sections = find_stream_sections(md, SimpleNamespace(pages=[]), "section", section_size=1)
+        assert (start, end, {"Header 1": "Annual report", "Header 2": "Revenue"}) in sections
+        doc = Document(page_content=md[start:end], metadata={"images": {}, "headers": {"Header 1": "Annual report", "Header 2": "Revenue"}})
+        chunks = advanced_text_splitter([doc], "f.pdf")
+        assert [(chunk.page_content, json.loads(chunk.metadata["header"])) for chunk in chunks] == [
+            ("cloud", {"Header 1": "Annual report", "Header 2": "Revenue", "Header 3": "By segment"}),
+        ]
+
+    def test_page_start_cut_without_header(self):
+        # Pages of text without any header: cut every max_pages pages
+        md = PAGE_BREAK.join(f"text of page {n}" for n in range(7))
+        result = paged_result(md)
+        sections = find_stream_sections(md, result, "section", section_size=1, max_pages=3)
+        page_offsets = [page.spans[0].offset for page in result.pages]
+        assert [(start, end) for start, end, _ in sections] == [(0, page_offsets[3]), (page_offsets[3], page_offsets[6]), (page_offsets[6], len(md))]
+
+    def test_page_mode_cuts_at_every_page(self):
+        md = "# Title\n\n" + PAGE_BREAK.join(f"text of page {n}" for n in range(3))
+        result = paged_result(md)
+        sections = find_stream_sections(md, result, "page")
+        assert [start for start, _, _ in sections] == [page.spans[0].offset for page in result.pages]
+        assert all(headers == ({} if start == 0 else {"Header 1": "Title"}) for start, _, headers in sections)
+
+
+class TestAdvancedTextSplitter:
+    @pytest.mark.parametrize("seed", range(300))
+    def test_same_chunks_as_reference(self, seed):
+        docs = [Document(page_content=random_markdown(seed), metadata={"images": IMAGES})]
+        assert advanced_text_splitter(docs, "f.pdf") == reference_text_splitter(docs, "f.pdf")
+
+    def test_figure_chunks_reference_their_image(self):
+        md = "# Title\n\nintro\n<figure>\n![](figures/1)\nchart\n</figure>\nafter"
+        chunks = advanced_text_splitter([Document(page_content=md, metadata={"images": IMAGES})], "f.pdf")
+        assert [chunk.metadata["image"] for chunk in chunks] == [None, "image 1", None]
+        assert all(json.loads(chunk.metadata["header"]) == {"Header 1": "Title"} for chunk in chunks)
@@ -0,0 +1,82 @@
+import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.telemetry import MemorySink, OpenTelemetrySink, set_telemetry_sink, span
+
+
+class StartRecordingSink(MemorySink):
+    def __init__(self):
+        super().__init__()
+        self.started = []
+
+    def start(self, record):
+        self.started.append(record)
+
+
+@pytest.fixture
+def sink():
+    sink = StartRecordingSink()
+    previous = set_telemetry_sink(sink)
+    yield sink
+    set_telemetry_sink(previous)
+
+
+class TestSpans:
+    def test_nested_spans(self, sink):
+        with span("file", file="a.pdf") as file_span:
+            with span("analyze") as analyze_span:
+                analyze_span.set(pages=3)
+        records = {record["name"]: record for record in sink.spans}
+        assert records["analyze"]["parent"] == file_span.id and records["file"]["parent"] is None
+        assert records["analyze"]["attributes"] == {"pages": 3}
+        # Opened parent first, with the attributes known when they open
+        assert [(record["name"], record["parent"]) for record in sink.started] == [("file", None), ("analyze", file_span.id)]
+        assert sink.started[0]["attributes"] == {"file": "a.pdf"} and sink.started[1]["id"] == analyze_span.id
+
+    def test_parent_in_another_thread(self, sink):
+        with span("describe") as parent:
+            with ThreadPoolExecutor(2) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, lambda: span("figure").__enter__().__exit__(None, None, None)) for _ in range(2)]
+                for future in futures:
+                    future.result()
+        assert [record["parent"] for record in sink.spans if record["name"] == "figure"] == [parent.id, parent.id]
+
+    def test_error(self, sink):
+        with pytest.raises(ValueError):
+            with span("analyze"):
+                raise ValueError("bad file")
+        assert sink.spans[0]["error"] == "ValueError: bad file"
+
+
+class TestOpenTelemetrySink:
+    def test_spans_keep_their_parent(self):
+        sdk_trace = pytest.importorskip("opentelemetry.sdk.trace")
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+        exporter = InMemorySpanExporter()
+        tracer_provider = sdk_trace.TracerProvider()
+        tracer_provider.add_span_processor(SimpleSpanProcessor(exporter))
+        previous = set_telemetry_sink(OpenTelemetrySink(tracer_provider, MeterProvider()))
+        try:
+            with span("file", file="a.pdf"):
+                with span("analyze") as analyze_span:
+                    analyze_span.set(pages=3)
+                with ThreadPoolExecutor(1) as executor:
+                    executor.submit(contextvars.copy_context().run, lambda: span("describe").__enter__().__exit__(None, None, None)).result()
+        finally:
+            set_telemetry_sink(previous)
+        spans = {otel_span.name: otel_span for otel_span in exporter.get_finished_spans()}
+        assert spans["file"].parent is None and spans["file"].attributes["file"] == "a.pdf"
+        for name in ("analyze", "describe"):
+            assert spans[name].parent.span_id == spans["file"].context.span_id
+            assert spans[name].context.trace_id == spans["file"].context.trace_id
+        assert spans["analyze"].attributes["pages"] == 3
+        assert spans["analyze"].start_time >= spans["file"].start_time and spans["analyze"].end_time <= spans["file"].end_time
@@ -0,0 +1,80 @@
+import sys
+import os
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from its_a_rag.cache import EmbeddingDimensionCache
+from its_a_rag.ingestion import LazyVectorStore, create_multimodal_vector_store, get_embedding_dimensions
+
+
+class Probe:
+    def __init__(self, dimensions=3):
+        self.dimensions = dimensions
+        self.calls = 0
+
+    def __call__(self, text):
+        self.calls += 1
+        return [0.0] * self.dimensions
+
+
+class TestGetEmbeddingDimensions:
+    def test_configured_dimension_is_not_probed(self, tmp_path):
+        probe = Probe()
+        cache = EmbeddingDimensionCache(str(tmp_path / "dimensions.json"))
+        assert get_embedding_dimensions(probe, "https://aoai/", "embedding", "1536", cache) == 1536
+        assert probe.calls == 0
+        assert cache.get(cache.key("https://aoai", "embedding")) is None
+
+    def test_probed_once_then_read_from_the_cache(self, tmp_path):
+        path = str(tmp_path / "dimensions.json")
+        probe = Probe(dimensions=5)
+        assert get_embedding_dimensions(probe, "https://aoai/", "embedding", dimensions_cache=EmbeddingDimensionCache(path)) == 5
+        # Another process reading the same file does not probe again
+        assert get_embedding_dimensions(probe, "https://aoai", "embedding", dimensions_cache=EmbeddingDimensionCache(path)) == 5
+        assert probe.calls == 1
+        # Each deployment has its own entry
+        assert get_embedding_dimensions(Probe(dimensions=7), "https://aoai", "other", dimensions_cache=EmbeddingDimensionCache(path)) == 7
+
+    def test_probed_without_a_cache(self):
+        probe = Probe(dimensions=4)
+        assert get_embedding_dimensions(probe, "https://aoai", "embedding") == 4
+        assert get_embedding_dimensions(probe, "https://aoai", "embedding") == 4
+        assert probe.calls == 2
+
+
+class TestLazyVectorStore:
+    def test_built_on_first_use_only_once(self):
+        builds = []
+
+        def factory():
+            time.sleep(0.01)
+            builds.append(1)
+            return type("Store", (), {"name": "index"})()
+
+        store = LazyVectorStore(factory)
+        assert builds == []
+        names = []
+        threads = [threading.Thread(target=lambda: names.append(store.name)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert names == ["index"] * 8
+        assert len(builds) == 1
+
+    def test_private_attributes_are_not_forwarded(self):
+        store = LazyVectorStore(lambda: pytest.fail("the store must not be built"))
+        with pytest.raises(AttributeError):
+            store._missing
+
+    def test_vector_store_created_without_any_request(self, tmp_path):
+        # Neither the embedding deployment nor the search service is called before the first use
+        vector_store, embeddings = create_multimodal_vector_store(
+            "index", "key", "http://127.0.0.1:9", "2024-02-01", "embedding", "http://127.0.0.1:9", "key",
+            dimensions_cache=EmbeddingDimensionCache(str(tmp_path / "dimensions.json")), lazy=True)
+        assert isinstance(vector_store, LazyVectorStore)
+        assert vector_store._store is None
@@ -1,13 +1,54 @@
 import os
+import sys
+import threading
+from operator import itemgetter
 from dotenv import load_dotenv
 load_dotenv()
 
-from langchain_openai import AzureChatOpenAI
+from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema import StrOutputParser
 
+# Add the its_a_rag module to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../lib')))
+
+from its_a_rag.context import CONTEXT_TOKEN_BUDGET
+from its_a_rag.ingestion import multimodal_rag_chain
+from its_a_rag.rate_limit import INTERACTIVE, RateLimitedEmbeddings, get_rate_limiter
+from its_a_rag.semantic_cache import SemanticCache, index_version_from_env
+
+# Semantic cache shared by all the chat sessions, built on first use
+_shared_cache = None
+_shared_cache_built = False
+_shared_cache_lock = threading.Lock()
+
+
+# One cache and one embeddings client per process, so an answer cached in a chat session is reused by the others
+# (None when there is no embedding deployment or the index version cannot be resolved: the answers are not cached)
+def get_shared_cache():
+    global _shared_cache, _shared_cache_built
+    with _shared_cache_lock:
+        if not _shared_cache_built:
+            # Cleared when the index version published by the ingestion changes
+            index_version = index_version_from_env() if os.getenv('AZURE_OPENAI_EMBEDDING') else None
+            if index_version is not None:
+                embeddings = AzureOpenAIEmbeddings(
+                    api_version=os.getenv('AZURE_OPENAI_API_VERSION'),
+                    azure_deployment=os.getenv('AZURE_OPENAI_EMBEDDING')
+                    )
+                # The questions go in the interactive lane of the embedding quota
+                limiter = get_rate_limiter(os.getenv('AZURE_OPENAI_EMBEDDING'), os.getenv('AZURE_OPENAI_EMBEDDING_RPM'), os.getenv('AZURE_OPENAI_EMBEDDING_TPM'))
+                if limiter is not None:
+                    embeddings = RateLimitedEmbeddings(embeddings, limiter, query_priority=INTERACTIVE)
+                _shared_cache = SemanticCache(embeddings, index_version=index_version)
+            _shared_cache_built = True
+        return _shared_cache
+
+
 class Assistant:
-    def __init__(self):
+    # With a retriever of the multimodal vector store, the answers use the retrieved documents,
+    # packed in the prompt within token_budget (the question goes straight to the model otherwise)
+    def __init__(self, cache=None, retriever=None, token_budget=CONTEXT_TOKEN_BUDGET):
         model = AzureChatOpenAI(
                 streaming=True,
                 api_version=os.getenv('AZURE_OPENAI_API_VERSION'),
@@ -22,10 +63,23 @@ class Assistant:
                 ("human", "{question}"),
             ]
         )
-        self.runnable = prompt | model | StrOutputParser()
+        if retriever is None:
+            self.runnable = prompt | model | StrOutputParser()
+        else:
+            self.runnable = itemgetter("question") | multimodal_rag_chain(retriever, model, token_budget)
+        # Repeated questions are answered from the semantic cache shared by all the chat sessions
+        self.cache = cache if cache is not None else get_shared_cache()
         
     def astream(self, content, config):
-        return self.runnable.astream({ "question": content }, config)
+        if self.cache is None:
+            return self.runnable.astream({ "question": content }, config)
+        return self.cache.astream(content, lambda: self.runnable.astream({ "question": content }, config))
 
     def invoke(self, content):
-        return self.runnable.invoke({ "question": content })
\ No newline at end of file
+        if self.cache is None:
+            return self.runnable.invoke({ "question": content })
+        answer = self.cache.get(content)
+        if answer is None:
+            answer = self.runnable.invoke({ "question": content })
+            self.cache.put(content, answer)
+        return answer
@@ -6,7 +6,12 @@ from pprint import pformat
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import assistant as assistant_module
 from assistant import Assistant
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableLambda
+from its_a_rag.indexing import INDEX_VERSION_ENV, publish_index_version
+from its_a_rag.semantic_cache import SemanticCache
 
 @pytest.fixture(scope="class")
 def assistant():
@@ -16,4 +21,48 @@ class TestAssistant:
     @pytest.mark.asyncio
     async def test_ceo_of_intel(self, assistant):
         answer = assistant.invoke("Who is the CEO of Nvidia?")
-        assert re.match(r".*(Jensen|Jen-Hsun) Huang.*", answer)
\ No newline at end of file
+        assert re.match(r".*(Jensen|Jen-Hsun) Huang.*", answer)
+
+class FakeEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return [1.0, float(len(text))]
+
+
+@pytest.fixture
+def shared_cache_env(monkeypatch, tmp_path):
+    # A published index version, an embedding deployment and no shared cache built yet
+    path = str(tmp_path / "index_version.json")
+    publish_index_version(path, "index")
+    monkeypatch.setenv(INDEX_VERSION_ENV, path)
+    monkeypatch.setenv("AZURE_OPENAI_EMBEDDING", "embedding")
+    monkeypatch.delenv("AZURE_OPENAI_EMBEDDING_RPM", raising=False)
+    monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "https://example.openai.azure.com")
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY", "fake")
+    monkeypatch.setenv("AZURE_OPENAI_API_VERSION", "2024-10-21")
+    monkeypatch.setattr(assistant_module, "AzureOpenAIEmbeddings", lambda **kwargs: FakeEmbeddings())
+    monkeypatch.setattr(assistant_module, "_shared_cache", None)
+    monkeypatch.setattr(assistant_module, "_shared_cache_built", False)
+
+
+class TestSharedCache:
+    def test_answer_cached_by_one_session_reused_by_another(self, shared_cache_env):
+        first, second = Assistant(), Assistant()
+        assert first.cache is not None and first.cache is second.cache
+        answers = []
+        first.runnable = RunnableLambda(lambda data: answers.append(data["question"]) or "Jensen Huang")
+        second.runnable = RunnableLambda(lambda data: pytest.fail("the answer must come from the cache"))
+        assert first.invoke("Who is the CEO of Nvidia?") == "Jensen Huang"
+        assert second.invoke("Who is the CEO of Nvidia?") == "Jensen Huang"
+        assert answers == ["Who is the CEO of Nvidia?"] and second.cache.hits == 1
+
+    def test_given_cache_is_used(self, shared_cache_env):
+        cache = SemanticCache(FakeEmbeddings())
+        assert Assistant(cache=cache).cache is cache
+        assert Assistant().cache is not cache
+
+    def test_no_cache_without_index_version(self, shared_cache_env, monkeypatch):
+        monkeypatch.delenv(INDEX_VERSION_ENV)
+        assert Assistant().cache is None and Assistant().cache is None